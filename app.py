@@ -1,36 +1,148 @@
-from flask import Flask, render_template, request, jsonify, session, send_file, flash, redirect, url_for
+from flask import Blueprint, Flask, Response, g, render_template, request, jsonify, session, send_file, send_from_directory, flash, redirect, url_for
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
 import requests
-import io, os
-from PIL import Image
+import os
 from dotenv import load_dotenv
 from flask_session import Session
 import uuid
-from openai import OpenAI
-import traceback
+import json
+import time
+from openai import APIStatusError, OpenAI
 import random
+import re
 import string
 import logging
+import threading
 import replicate
+import metrics
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from auth_cache import TokenCache
+from http_client import HttpClient
+from media import (IMAGE_EXTENSIONS, InvalidImage, decode_base64_to_file, inspect_image_file, parse_image_format,
+                   prepare_image, transcode_image_file)
+from media_store import MediaStore
+from storage import LocalStorage, S3Storage
+from derivatives import DerivativeGenerator
+from reaper import MediaReaper
+from conversation_store import ConversationStore
+from result_cache import ResultCache, cache_key, normalize_prompt
+from scheduler import BackendScheduler, RateLimited, parse_retry_after
+from generators import Generator, GeneratorRegistry, GeneratorUnavailable, ModelLoading
+from replicate_versions import VersionCache
+from db import connect
+from jobs import ACTIVE_STATUSES, JobFailed, JobLimitExceeded, JobManager, JobStore, run_prediction
 
 # Load environment variables from the .env file to make sensitive information (like API keys) accessible
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Debug logging formats a line per step of every request, so it is opt-in
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 logger = logging.getLogger(__name__)
 
-# Initialize the Flask application
-app = Flask(__name__)
+# Every route lives on this blueprint; create_app() builds the Flask application around it
+bp = Blueprint("main", __name__)
 
-# Configure the Flask session to store session data on the filesystem
-app.config["SESSION_TYPE"] = "filesystem"
-# Set a secret key for session encryption, defaulting to 'supersecretkey' if not found in the environment variables
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "supersecretkey")
-# Initialize the Flask session
-Session(app)
+# Set once the process starts shutting down, so /ready takes it out of the load balancer
+draining = threading.Event()
+# Session interface of the app running in this process, used by the reaper to check for live sessions
+session_interface = None
 
 API_URL = os.getenv("API_URL")
 
+# Images are stored exactly as the backend returned them unless a format (png, jpeg, gif, webp) is forced here;
+# an unknown format stops the app at startup rather than failing every image it stores
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT") or None
+if IMAGE_OUTPUT_FORMAT is not None:
+    IMAGE_OUTPUT_FORMAT = parse_image_format(IMAGE_OUTPUT_FORMAT, "IMAGE_OUTPUT_FORMAT")
+
+# Directory for the app's own state (job database, media index, caches); never served directly
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+# Postgres shared by every host for the media index, conversations, jobs and the result cache. Without
+# it they are SQLite files under DATA_DIR, which only this host sees: running several hosts then needs
+# DATABASE_URL together with S3 media storage and Redis sessions.
+DATABASE_URL = os.getenv("DATABASE_URL") or None
+
+def database(filename):
+    """Target for one of the stores: the shared database if there is one, else a file in DATA_DIR."""
+    return DATABASE_URL or os.path.join(DATA_DIR, filename)
+
+# Where media bytes live: "local" (MEDIA_DIR on this host) or "s3", a bucket every host shares. With S3,
+# clients are redirected to presigned URLs, and MEDIA_DIR only holds temp files.
+MEDIA_STORAGE = os.getenv("MEDIA_STORAGE", "local").lower()
+MEDIA_DIR = os.getenv("MEDIA_DIR", os.path.join(DATA_DIR, "media"))
+if MEDIA_STORAGE == "s3":
+    media_storage = S3Storage(
+        os.environ["S3_BUCKET"],
+        prefix=os.getenv("S3_PREFIX", ""),
+        temp_dir=MEDIA_DIR,
+        url_ttl=int(os.getenv("S3_URL_TTL", 3600)),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        region_name=os.getenv("S3_REGION") or None,
+    )
+    if DATABASE_URL is None:
+        logger.warning("MEDIA_STORAGE=s3 without DATABASE_URL: the media index stays on this host, "
+                       "so other hosts can't resolve its media names")
+else:
+    media_storage = LocalStorage(MEDIA_DIR)
+
+# Content-addressed store for generated images and videos, served through /media/<name>
+media_store = MediaStore(MEDIA_DIR, database("media.sqlite3"), storage=media_storage)
+
+# Conversation history lives here; the session only keeps a conversation id pointing into it
+conversation_store = ConversationStore(database("conversations.sqlite3"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 50))
+
+# Results of deterministic (seeded) requests, pinned in the media store up to a byte budget; 0 disables it
+result_cache = ResultCache(
+    media_store,
+    database("result_cache.sqlite3"),
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+)
+DEFAULT_IMAGE_SIZE = "1024x1024"
+IMAGE_SIZE_PATTERN = re.compile(r"^(\d{2,4})x(\d{2,4})$")
+MAX_SEED = 2**32 - 1
+
+# Thumbnails/previews rendered off the request path after an image is stored
+derivative_generator = DerivativeGenerator(
+    media_store,
+    image_format=parse_image_format(os.getenv("DERIVATIVE_FORMAT", "webp"), "DERIVATIVE_FORMAT"),
+    max_workers=int(os.getenv("DERIVATIVE_WORKERS", 2)),
+)
+def session_exists(session_key):
+    """Whether a server-side session is still stored, i.e. it was neither cleared nor expired."""
+    interface = session_interface
+    # Without an app there is no way to tell, so treat every session as live
+    if interface is None:
+        return True
+    store_id = interface.key_prefix + session_key
+    cache = getattr(interface, "cache", None)
+    if cache is not None:
+        return cache.has(store_id)
+    return interface._retrieve_session_data(store_id) is not None
+
+# Background garbage collection of the media store; quotas/max age of 0 disable that rule
+media_reaper = MediaReaper(
+    media_store,
+    session_exists,
+    total_quota_bytes=int(os.getenv("MEDIA_QUOTA_BYTES", 0)),
+    user_quota_bytes=int(os.getenv("MEDIA_USER_QUOTA_BYTES", 0)),
+    max_age_seconds=float(os.getenv("MEDIA_MAX_AGE_DAYS", 0)) * 24 * 3600,
+    orphan_grace_seconds=float(os.getenv("MEDIA_ORPHAN_GRACE_SECONDS", 3600)),
+    batch_size=int(os.getenv("REAPER_BATCH_SIZE", 500)),
+    interval=float(os.getenv("REAPER_INTERVAL", 300)),
+    dry_run=os.getenv("REAPER_DRY_RUN", "").lower() in ("1", "true", "yes"),
+)
+
+# Derivative URLs are keyed by content hash, so browsers may keep them for a year
+DERIVATIVE_MAX_AGE = int(os.getenv("DERIVATIVE_MAX_AGE", 365 * 24 * 3600))
+# A media name never changes content, but it can be released, so originals are cached for less
+MEDIA_MAX_AGE = int(os.getenv("MEDIA_MAX_AGE", 24 * 3600))
+
 # Setup API tokens for Hugging Face and OpenAI, retrieved from environment variables
 api_token = os.getenv("HUGGINGFACEHUB_API_TOKEN")
 openai_key = os.getenv("OPENAI_API_KEY")
@@ -40,31 +152,83 @@ hf_headers = {"Authorization": f"Bearer {api_token}"}
 
 # Initialize the OpenAI client with the retrieved API key
 openai_client = OpenAI(api_key=openai_key)
-
-# URLs for various Hugging Face models (Stability AI, Boreal, Flux, and Phantasma Anime)
-stability_api_url = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
-boreal_api_url = "https://api-inference.huggingface.co/models/kudzueye/Boreal"
-flux_api_url = "https://api-inference.huggingface.co/models/black-forest-labs/FLUX.1-dev"
-phantasma_anime_api_url = "https://api-inference.huggingface.co/models/alvdansen/phantasma-anime"
+# Image model and defaults for OpenAI; dall-e-3 only returns one image per call, dall-e-2/gpt-image-1 up to 10
+OPENAI_IMAGE_MODEL = os.getenv("OPENAI_IMAGE_MODEL", "dall-e-3")
+OPENAI_IMAGE_SIZE = os.getenv("OPENAI_IMAGE_SIZE", DEFAULT_IMAGE_SIZE)
+# Quality values differ per model (standard/hd for dall-e-3, low/medium/high for gpt-image), so it is
+# only sent when configured and otherwise left to the model's default
+OPENAI_IMAGE_QUALITY = os.getenv("OPENAI_IMAGE_QUALITY")
+OPENAI_MAX_IMAGES = int(os.getenv("OPENAI_MAX_IMAGES", 1 if OPENAI_IMAGE_MODEL == "dall-e-3" else 4))
+
+# Pooled HTTP client shared by every outbound call (auth backend, Hugging Face, output downloads)
+http_client = HttpClient(
+    connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", 120)),
+    retries=int(os.getenv("HTTP_RETRIES", 2)),
+    pool_maxsize=int(os.getenv("HTTP_POOL_MAXSIZE", 32)),
+)
+# Model outputs (videos, upscales) are streamed to disk; anything larger than this is refused
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", 1024 * 1024 * 1024))
+# The auth backend should answer quickly; don't hold a request thread for the full read timeout
+auth_timeout = (float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)), float(os.getenv("AUTH_READ_TIMEOUT", 10)))
+
+# URLs for various Hugging Face models (Stability AI, Boreal, Flux, and Phantasma Anime). The base can be
+# pointed elsewhere, e.g. at a dedicated endpoint or the stub servers of the benchmark suite.
+HF_INFERENCE_URL = os.getenv("HF_INFERENCE_URL", "https://api-inference.huggingface.co/models").rstrip("/")
+stability_api_url = f"{HF_INFERENCE_URL}/stabilityai/stable-diffusion-xl-base-1.0"
+boreal_api_url = f"{HF_INFERENCE_URL}/kudzueye/Boreal"
+flux_api_url = f"{HF_INFERENCE_URL}/black-forest-labs/FLUX.1-dev"
+phantasma_anime_api_url = f"{HF_INFERENCE_URL}/alvdansen/phantasma-anime"
+
+# Cache of authentication check results keyed by a hash of the access token. Valid
+# tokens are trusted for AUTH_CACHE_TTL seconds, rejected ones for AUTH_CACHE_NEGATIVE_TTL.
+auth_cache = TokenCache(
+    ttl=float(os.getenv("AUTH_CACHE_TTL", 60)),
+    negative_ttl=float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", 5)),
+    max_size=int(os.getenv("AUTH_CACHE_MAX_SIZE", 10000)),
+)
+
+# Cache of {"user_id", "premium", "premium_checked"} per access token, so the generate path does not pay
+# two extra auth backend round trips. It is warmed in the background after a
+# successful authentication check.
+user_cache = TokenCache(
+    ttl=float(os.getenv("USER_CACHE_TTL", 300)),
+    negative_ttl=float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", 5)),
+    max_size=int(os.getenv("AUTH_CACHE_MAX_SIZE", 10000)),
+)
+user_prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="user-prefetch")
 
 # Utility functions
+def fetch_auth_status(access_token):
+    """Asks the auth backend whether the access token is valid and returns the HTTP status code."""
+    headers = {'Authorization': f'Bearer {access_token}'}
+    response = http_client.get(f"{API_URL}/user_history", headers=headers, timeout=auth_timeout)
+    logger.debug(f"Authentication check response status: {response.status_code}")
+    if response.status_code not in (200, 401):
+        logger.error(f"Authentication check failed: {response.text}")
+    return response.status_code
+
 def check_authentication():
     logger.debug("Checking authentication status...")
     access_token = session.get('access_token')
     if access_token:
-        headers = {'Authorization': f'Bearer {access_token}'}
         try:
-            response = requests.get(f"{API_URL}/user_history", headers=headers)
-            logger.debug(f"Authentication check response status: {response.status_code}")
-            if response.status_code == 200:
+            status_code = auth_cache.get_or_load(
+                access_token,
+                lambda: fetch_auth_status(access_token),
+                is_positive=lambda status: status == 200,
+            )
+            if status_code == 200:
+                prefetch_user_info(access_token)
                 return True
-            elif response.status_code == 401:
+            elif status_code == 401:
                 logger.error("Access token is invalid or expired.")
+                user_cache.invalidate(access_token)
                 session.pop('access_token', None)
                 flash('Session expired, please login again', 'danger')
                 return False
             else:
-                logger.error(f"Authentication check failed: {response.text}")
+                user_cache.invalidate(access_token)
                 session.pop('access_token', None)
                 flash('Authentication check failed, please login again.', 'danger')
                 return False
@@ -78,103 +242,514 @@ def check_authentication():
         flash('You need to login first.', 'danger')
         return False
 
+# Endpoints reachable without logging in; the probes are polled by the load balancer
+AUTH_EXEMPT_ENDPOINTS = ('main.login', 'main.register', 'main.healthz', 'main.ready', 'main.metrics_endpoint', 'static')
+
 # Before requests are made
-@app.before_request
+@bp.before_request
 def before_request():
     logger.debug(f"Before request: {request.endpoint}")
-    if request.endpoint not in ('login', 'register', 'static'):
-        if not check_authentication():
-            return redirect(url_for('login'))
+    if request.endpoint not in AUTH_EXEMPT_ENDPOINTS:
+        with metrics.timed_stage("auth"):
+            authenticated = check_authentication()
+        if not authenticated:
+            return redirect(url_for('main.login'))
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.request_endpoint = request.endpoint or "unmatched"
+    metrics.REQUESTS_IN_FLIGHT.labels(g.request_endpoint).inc()
+
+@bp.after_app_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@bp.teardown_app_request
+def record_request_latency(exc=None):
+    """Observes the time to produce the response; for streamed responses the stream itself is not included."""
+    if "request_start" not in g:
+        return
+    metrics.REQUESTS_IN_FLIGHT.labels(g.request_endpoint).dec()
+    status = g.get("response_status", 500)
+    metrics.REQUEST_LATENCY.labels(g.request_endpoint, request.method, status).observe(
+        time.perf_counter() - g.request_start)
 
 def random_sig():
     """Generates a 3-character random signature, which can be a combination of letters or digits."""
     return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(3))
 
-def log_debug(message):
-    """Helper function to print debug messages to the console."""
-    print(f"[DEBUG]: {message}")
-
-def query_image(prompt, api_url):
+def query_image(prompt, api_url, parameters=None, wait_for_model=False):
     """
     Generic function to query a Hugging Face API for generating images based on a prompt.
-    The function sends a POST request to the specified API URL with the prompt data.
+    The function sends a POST request to the specified API URL with the prompt data and
+    optional generation parameters (seed, width, height).
     Returns the binary content of the generated image or None if an error occurred.
+    A model that is still loading raises ModelLoading, unless wait_for_model asks the API
+    to hold the request until the model is ready.
     """
+    # Errors are counted per model, e.g. black-forest-labs/FLUX.1-dev
+    backend = api_url.removeprefix(f"{HF_INFERENCE_URL}/")
     try:
-        log_debug(f"Querying {api_url} with prompt: {prompt}")
-        response = requests.post(api_url, headers=hf_headers, json={"inputs": prompt})
+        logger.debug(f"Querying {api_url} with prompt: {prompt}")
+        payload = {"inputs": prompt}
+        if parameters:
+            payload["parameters"] = parameters
+        headers = {**hf_headers, "x-wait-for-model": "true"} if wait_for_model else hf_headers
+        response = http_client.post(api_url, headers=headers, json=payload)
+        if response.status_code == 503 and "json" in response.headers.get("Content-Type", ""):
+            estimated_time = response.json().get("estimated_time")
+            if estimated_time is not None:
+                metrics.count_backend_error(backend, "loading")
+                raise ModelLoading(f"{api_url} is loading", float(estimated_time))
+        if response.status_code >= 400:
+            metrics.count_backend_error(backend, response.status_code)
+        if response.status_code in (429, 503):
+            raise RateLimited(f"{api_url} is rate limited", parse_retry_after(response.headers.get("Retry-After")))
         response.raise_for_status()  # Raise an error for bad responses (4xx, 5xx)
-        log_debug(f"Received response with status code {response.status_code}")
+        logger.debug(f"Received response with status code {response.status_code}")
         return response.content  # Return the image content as bytes
     except requests.exceptions.RequestException as e:
-        log_debug(f"Error querying {api_url}: {e}")
-        traceback.print_exc()
+        if e.response is None:
+            metrics.count_backend_error(backend, type(e).__name__)
+        logger.exception(f"Error querying {api_url}: {e}")
         return None
 
-def query_openai_image(prompt):
+def query_openai_image(prompt, size=None, count=1):
     """
-    Query OpenAI's DALL-E 3 model to generate an image based on a given prompt.
+    Query OpenAI's image model to generate count images for a prompt. The images come back inline
+    as base64 strings, so no second download is needed; returns the list of strings or None.
+    DALL-E 3 takes no seed, so deterministic requests only differ by cache key there.
     """
+    logger.debug(f"Querying OpenAI with prompt: {prompt}")
+    options = {"model": OPENAI_IMAGE_MODEL, "prompt": prompt, "size": size or OPENAI_IMAGE_SIZE, "n": count}
+    if OPENAI_IMAGE_QUALITY:
+        options["quality"] = OPENAI_IMAGE_QUALITY
+    # gpt-image models always answer with base64 and reject the parameter
+    if OPENAI_IMAGE_MODEL.startswith("dall-e"):
+        options["response_format"] = "b64_json"
     try:
-        log_debug(f"Querying OpenAI with prompt: {prompt}")
-        response = openai_client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1
+        response = openai_client.images.generate(**options)
+    except APIStatusError as e:
+        metrics.count_backend_error("openai", e.status_code)
+        if e.status_code in (429, 503):
+            raise RateLimited("OpenAI is rate limited", parse_retry_after(e.response.headers.get("Retry-After")))
+        raise
+    images = [image.b64_json for image in (response.data or []) if image.b64_json]
+    logger.debug(f"Received {len(images)} image(s) from OpenAI")
+    return images or None
+
+def query_flux_image(prompt, parameters=None, wait_for_model=False):
+    return query_image(prompt, flux_api_url, parameters, wait_for_model)
+
+def query_boreal_image(prompt, parameters=None, wait_for_model=False):
+    return query_image(prompt, boreal_api_url, parameters, wait_for_model)
+
+def query_stability_image(prompt, parameters=None, wait_for_model=False):
+    return query_image(prompt, stability_api_url, parameters, wait_for_model)
+
+def query_phantasma_anime_image(prompt, parameters=None, wait_for_model=False):
+    return query_image(prompt, phantasma_anime_api_url, parameters, wait_for_model)
+
+def hf_parameters(seed=None, size=None):
+    """Hugging Face generation parameters; seed and size are only sent when the request set them."""
+    parameters = {}
+    if seed is not None:
+        parameters["seed"] = seed
+    if size is not None:
+        width, height = IMAGE_SIZE_PATTERN.match(size).groups()
+        parameters.update(width=int(width), height=int(height))
+    return parameters
+
+def openai_backend(prompt, seed, size, count, wait_for_model):
+    return query_openai_image(prompt, size, count)
+
+def hf_backend(query):
+    def call(prompt, seed, size, count, wait_for_model):
+        return query(prompt, hf_parameters(seed, size), wait_for_model)
+    return call
+
+# Image generators with health tracking. Fallbacks are similar general-purpose models and are
+# only used when the request opts in; OpenAI is never a fallback since it is billed differently.
+generator_registry = GeneratorRegistry(
+    [
+        Generator("openai", openai_backend, max_images=OPENAI_MAX_IMAGES),
+        Generator("flux", hf_backend(query_flux_image), fallbacks=("stability", "boreal"), hedge=True),
+        Generator("stability", hf_backend(query_stability_image), fallbacks=("flux", "boreal"), hedge=True),
+        Generator("boreal", hf_backend(query_boreal_image), fallbacks=("flux", "stability"), hedge=True),
+        Generator("phantasma-anime", hf_backend(query_phantasma_anime_image), hedge=True),
+    ],
+    max_wait_for_model=float(os.getenv("MAX_WAIT_FOR_MODEL", 60)),
+    hedging=os.getenv("HEDGE_REQUESTS", "").lower() in ("1", "true", "yes"),
+    hedge_percentile=float(os.getenv("HEDGE_PERCENTILE", 0.95)),
+)
+IMAGE_GENERATORS = generator_registry.names()
+
+def backend_scheduler(generator, max_concurrency, rate_per_minute, burst):
+    """
+    Batch scheduler for one generator. The defaults can be overridden per generator with
+    <GENERATOR>_MAX_CONCURRENCY, <GENERATOR>_RATE_PER_MINUTE (0 = unlimited) and <GENERATOR>_BURST,
+    e.g. PHANTASMA_ANIME_RATE_PER_MINUTE.
+    """
+    prefix = generator.upper().replace("-", "_")
+    return BackendScheduler(
+        generator,
+        max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", max_concurrency)),
+        rate_per_minute=float(os.getenv(f"{prefix}_RATE_PER_MINUTE", rate_per_minute)),
+        burst=float(os.getenv(f"{prefix}_BURST", burst)),
+        max_attempts=int(os.getenv("BATCH_MAX_ATTEMPTS", 3)),
+    )
+
+# Per-backend concurrency caps and rate limits for /generate-batch. Rate limit answers seen on
+# any route pause the backend here too.
+batch_schedulers = {
+    "openai": backend_scheduler("openai", 2, 5, 1),
+    "flux": backend_scheduler("flux", 2, 30, 3),
+    "stability": backend_scheduler("stability", 2, 30, 3),
+    "boreal": backend_scheduler("boreal", 2, 30, 3),
+    "phantasma-anime": backend_scheduler("phantasma-anime", 2, 30, 3),
+}
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
+
+def parse_generation_options(data):
+    """
+    Validates the optional seed, size and image count (n) of a generate request and returns them;
+    raises ValueError on bad input.
+    """
+    seed = data.get("seed")
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or not 0 <= seed <= MAX_SEED):
+        raise ValueError(f"seed must be an integer between 0 and {MAX_SEED}.")
+    size = data.get("size")
+    if size is not None and (not isinstance(size, str) or not IMAGE_SIZE_PATTERN.match(size)):
+        raise ValueError("size must look like 1024x1024.")
+    count = data.get("n", 1)
+    if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+        raise ValueError("n must be a positive integer.")
+    return seed, size, count
+
+def check_image_count(generator, count):
+    """Raises ValueError if a generator can't return count images in one call."""
+    max_images = generator_registry.generators[generator].max_images
+    if count > max_images:
+        raise ValueError(f"{generator} returns at most {max_images} image(s) per request.")
+
+def fetch_user_info(access_token):
+    """
+    Resolves the user id and premium status for an access token from the auth backend.
+    premium_checked is False unless the premium status came from a 200 answer; such a
+    result counts as not premium, but is only cached for the negative TTL.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    user_id_response = http_client.get(f"{API_URL}/user/id", headers=headers, timeout=auth_timeout)
+    if user_id_response.status_code != 200:
+        return {"user_id": None, "premium": False, "premium_checked": False}
+    user_id = user_id_response.json().get('user_id')
+    response = http_client.get(f"{API_URL}/user/{user_id}/premium/status", headers=headers, timeout=auth_timeout)
+    if response.status_code != 200:
+        logger.warning(f"Premium status lookup failed with status {response.status_code}")
+        return {"user_id": user_id, "premium": False, "premium_checked": False}
+    premium = bool(response.json().get('premium_status', False))
+    return {"user_id": user_id, "premium": premium, "premium_checked": True}
+
+def get_user_info(access_token=None):
+    """Returns the cached user info for the current (or given) access token, loading it on a miss."""
+    access_token = access_token or session.get('access_token')
+    if not access_token:
+        return {"user_id": None, "premium": False}
+    with metrics.timed_stage("user_info"):
+        return user_cache.get_or_load(
+            access_token,
+            lambda: fetch_user_info(access_token),
+            is_positive=lambda info: info["user_id"] is not None and info["premium_checked"],
         )
-        if response and response.data:
-            image_url = response.data[0].url
-            log_debug(f"Received image URL: {image_url}")
-            image_response = requests.get(image_url)
-            image_response.raise_for_status()
-            return image_response.content
-    except requests.exceptions.RequestException as e:
-        log_debug(f"Error querying OpenAI: {e}")
-        traceback.print_exc()
-    return None
 
-def query_flux_image(prompt):
-    return query_image(prompt, flux_api_url)
+def prefetch_user_info(access_token):
+    """Warms the user info cache off the request thread; a later lookup joins the in-flight load."""
+    if user_cache.get(access_token) is not None:
+        return
 
-def query_boreal_image(prompt):
-    return query_image(prompt, boreal_api_url)
+    def load():
+        try:
+            get_user_info(access_token)
+        except requests.RequestException as e:
+            logger.warning(f"Background user info lookup failed: {e}")
 
-def query_stability_image(prompt):
-    return query_image(prompt, stability_api_url)
+    user_prefetch_executor.submit(load)
 
-def query_phantasma_anime_image(prompt):
-    return query_image(prompt, phantasma_anime_api_url)
+def invalidate_user_caches(access_token):
+    """Drops everything cached for an access token, e.g. on logout or after a premium upgrade."""
+    if access_token:
+        auth_cache.invalidate(access_token)
+        user_cache.invalidate(access_token)
 
 def is_premium_user():
-    token = session.get('access_token')
-    headers = {'Authorization': f'Bearer {token}'}
-    user_id_url = f"{API_URL}/user/id"
-    user_id_response = requests.get(user_id_url, headers=headers)
-    if user_id_response.status_code == 200:
-        user_id = user_id_response.json().get('user_id')
-        premium_status_url = f"{API_URL}/user/{user_id}/premium/status"
-        response = requests.get(premium_status_url, headers=headers)
-        if response.status_code == 200:
-            return response.json().get('premium_status', False)
-    return False
+    return get_user_info()["premium"]
+
+class OwnerUnavailable(Exception):
+    """The user id behind the session's access token can't be resolved right now."""
+
+def current_owner():
+    """
+    Stable identifier for the logged-in user (their user id), used to scope media and background
+    jobs. Raises OwnerUnavailable when the auth backend can't resolve it, rather than falling back
+    to an identifier that would split the user's media, jobs and quota in two.
+    """
+    try:
+        user_id = get_user_info()["user_id"]
+    except requests.RequestException as e:
+        raise OwnerUnavailable(f"User lookup failed: {e}") from e
+    if user_id is None:
+        raise OwnerUnavailable("User lookup returned no user id")
+    return str(user_id)
+
+@bp.app_errorhandler(OwnerUnavailable)
+def owner_unavailable(e):
+    logger.warning(f"Can't resolve the owner of the request: {e}")
+    retry_after = max(1, round(user_cache.negative_ttl))
+    return jsonify({"error": "Your account can't be verified right now, please retry later."}), 503, \
+        {"Retry-After": str(retry_after)}
+
+def current_conversation_id():
+    """
+    Returns the session's pointer into the conversation store, creating it on first use.
+    History kept in the session by older versions is moved into the store once.
+    """
+    conversation_id = session.get("conversation_id")
+    if conversation_id is None:
+        # Resolved first, so a failed lookup doesn't leave the old history behind unmigrated
+        owner = current_owner()
+        conversation_id = uuid.uuid4().hex
+        session["conversation_id"] = conversation_id
+        for entry in session.pop("conversation", []):
+            conversation_store.append(conversation_id, owner, "image", entry.get("prompt"), entry.get("generator"),
+                                      entry["image_url"])
+        for video in session.pop("videos", []):
+            conversation_store.append(conversation_id, owner, "video", "Generated Video", "video", video)
+    return conversation_id
+
+def store_image(image_bytes, name_prefix, owner, generator, prompt, target_format=None, session_key=None):
+    """Validates image bytes and adds them to the media store, returning the new media record."""
+    data, image_format, width, height = prepare_image(image_bytes, target_format)
+    record = media_store.put_bytes(data, IMAGE_EXTENSIONS[image_format], name_prefix=name_prefix, owner=owner,
+                                   generator=generator, prompt=prompt, width=width, height=height,
+                                   session_key=session_key)
+    derivative_generator.schedule(record)
+    return record
+
+def reuse_cached_image(key, generator, prompt, owner, session_key):
+    """Gives a user a new name for a cached result, or returns None on a cache miss."""
+    cached_name = result_cache.get(key)
+    if cached_name is None:
+        return None
+    record = media_store.add_reference(cached_name, name_prefix=f"{generator}_image", owner=owner,
+                                       generator=generator, prompt=prompt, session_key=session_key)
+    return record["name"] if record is not None else None
+
+class GenerationError(Exception):
+    """A generation failed; the message is meant for the user."""
+
+def store_generated_output(output, generator, owner, prompt, session_key, timings):
+    """
+    Stores one image from a backend (bytes, or a base64 string decoded straight to a temp file)
+    and returns its media name, adding the decode and write time to timings.
+    """
+    if isinstance(output, bytes):
+        start = time.perf_counter()
+        record = store_image(output, f"{generator}_image", owner, generator, prompt,
+                             target_format=IMAGE_OUTPUT_FORMAT, session_key=session_key)
+        timings["write_ms"] += (time.perf_counter() - start) * 1000
+        return record["name"]
+
+    tmp_path = media_store.temp_path()
+    try:
+        start = time.perf_counter()
+        digest = decode_base64_to_file(output, tmp_path)
+        decoded = time.perf_counter()
+        record = store_image_file(tmp_path, f"{generator}_image", owner, generator, prompt,
+                                  target_format=IMAGE_OUTPUT_FORMAT, session_key=session_key, digest=digest)
+        timings["decode_ms"] += (decoded - start) * 1000
+        timings["write_ms"] += (time.perf_counter() - decoded) * 1000
+        return record["name"]
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def generate_and_store(generator, prompt, owner, session_key, seed=None, size=None, allow_fallback=False, count=1):
+    """
+    Generates count images and adds them to the media store, returning {"image_url", "images",
+    "cached", "prompt", "generator", "timings"} where image_url is the first of images, prompt is
+    what was sent to the backend, generator is the one that produced the images (a fallback if
+    allow_fallback was needed) and timings splits the time into api/decode/write milliseconds.
+    Needs no request context, so worker threads can call it. Raises GenerationError when the
+    backend or storing fails, and RateLimited (or its ModelLoading/GeneratorUnavailable
+    subclasses) when the backend can't take the request now.
+    """
+    # A request with an explicit seed is deterministic: the prompt is sent without a random
+    # signature and a single-image result is cached by (generator, normalized prompt, seed, size, backend settings)
+    deterministic = seed is not None
+    if deterministic:
+        unique_prompt = normalize_prompt(prompt)
+    else:
+        unique_prompt = f"{prompt} - {random_sig()}"
+    logger.debug(f"Unique prompt: {unique_prompt}")
+
+    timings = {"api_ms": 0.0, "decode_ms": 0.0, "write_ms": 0.0}
+    use_cache = deterministic and count == 1
+    if generator == "openai":
+        default_size = OPENAI_IMAGE_SIZE
+        options = {"model": OPENAI_IMAGE_MODEL, "quality": OPENAI_IMAGE_QUALITY}
+    else:
+        default_size, options = DEFAULT_IMAGE_SIZE, None
+    key = cache_key(generator, prompt, seed, size or default_size, options) if use_cache else None
+    # Identical deterministic requests in flight wait for the first one instead of calling the backend again
+    with result_cache.lock(key) if use_cache else nullcontext():
+        image_name = reuse_cached_image(key, generator, unique_prompt, owner, session_key) if use_cache else None
+        if image_name is not None:
+            logger.info(f"Served {generator} image from the result cache: {image_name}")
+            metrics.GENERATIONS.labels(generator, "cached").inc()
+            return {"image_url": image_name, "images": [image_name], "cached": True, "prompt": unique_prompt,
+                    "generator": generator, "timings": timings}
+
+        requested = generator
+        start = time.perf_counter()
+        try:
+            with metrics.GENERATIONS_IN_FLIGHT.labels(requested).track_inprogress():
+                output, generator = generator_registry.generate(requested, unique_prompt, seed, size, allow_fallback,
+                                                                count)
+        except RateLimited:
+            metrics.GENERATIONS.labels(requested, "unavailable").inc()
+            raise
+        except Exception:
+            metrics.GENERATIONS.labels(requested, "failed").inc()
+            raise
+        timings["api_ms"] = (time.perf_counter() - start) * 1000
+        if not output:
+            logger.error("Failed to generate image from the selected API.")
+            metrics.GENERATIONS.labels(requested, "failed").inc()
+            raise GenerationError("Failed to generate image from the selected API.")
+
+        logger.debug(f"Saving {generator} image to the media store")
+        image_names = []
+        try:
+            for item in output if isinstance(output, list) else [output]:
+                image_names.append(store_generated_output(item, generator, owner, unique_prompt, session_key,
+                                                          timings))
+            logger.info(f"Image saved successfully: {', '.join(image_names)}")
+        except Exception as e:
+            logger.error(f"Error saving image: {e}")
+            for image_name in image_names:
+                media_store.release(image_name)
+            metrics.GENERATIONS.labels(generator, "failed").inc()
+            raise GenerationError("Error saving image")
+
+        # A fallback's image must not be served later as the requested generator's result
+        if use_cache and generator == requested:
+            result_cache.put(key, image_names[0], generator)
+    metrics.observe_generation(generator, timings)
+    metrics.GENERATIONS.labels(generator, "generated").inc()
+    return {"image_url": image_names[0], "images": image_names, "cached": False, "prompt": unique_prompt,
+            "generator": generator, "timings": {phase: round(ms, 1) for phase, ms in timings.items()}}
+
+def store_image_file(tmp_path, name_prefix, owner, generator, prompt, target_format=None, session_key=None,
+                     digest=None):
+    """
+    File-based store_image for downloaded outputs: validates the image from its header and trailer,
+    transcodes only if a target format is configured, and moves the file into the media store.
+    """
+    image_format, width, height = inspect_image_file(tmp_path)
+    if target_format and target_format != image_format:
+        transcoded_path = media_store.temp_path()
+        try:
+            transcode_image_file(tmp_path, transcoded_path, target_format)
+        except Exception:
+            os.remove(transcoded_path)
+            raise
+        os.remove(tmp_path)
+        tmp_path, image_format, digest = transcoded_path, target_format, None
+    record = media_store.put_file(tmp_path, IMAGE_EXTENSIONS[image_format], digest=digest, name_prefix=name_prefix,
+                                  owner=owner, generator=generator, prompt=prompt, width=width, height=height,
+                                  session_key=session_key)
+    derivative_generator.schedule(record)
+    return record
+
+@contextmanager
+def downloaded_output(url):
+    """
+    Streams a model output into a temp file inside the media store and yields (path, sha256).
+    The temp file is removed afterwards unless it was moved into the store.
+    """
+    tmp_path = media_store.temp_path()
+    try:
+        digest = http_client.download(url, tmp_path, max_bytes=MAX_DOWNLOAD_BYTES)
+        yield tmp_path, digest
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def media_variant_url(name, variant):
+    if variant is None:
+        return url_for('main.media', name=name)
+    return url_for('main.media_variant', name=name, variant=variant)
+
+def with_image_variants(entry):
+    """Adds thumbnail/preview URLs and a srcset to a conversation entry with an indexed image."""
+    record = media_store.resolve(entry["image_url"]) if entry.get("image_url") else None
+    if record is None:
+        return entry
+    candidates = derivative_generator.srcset(record, media_variant_url)
+    return {
+        **entry,
+        "thumbnail_url": media_variant_url(record["name"], "thumb"),
+        "preview_url": media_variant_url(record["name"], "preview"),
+        "srcset": ", ".join(f"{url} {width}w" for url, width in candidates),
+    }
+
+def resolve_job_image(name, owner):
+    """
+    Maps a media name sent by a client to the job payload fields locating it: the media name
+    for indexed media, or for files saved to static/ before the index existed, their path
+    (found through a safe join). Returns None if the user has no such image.
+    """
+    record = media_store.resolve(name)
+    if record is not None:
+        return {"image_name": name} if record["owner"] == owner else None
+    legacy_path = safe_join("static", name)
+    if legacy_path and os.path.isfile(legacy_path):
+        return {"image_path": legacy_path}
+    return None
+
+@contextmanager
+def job_image_input(payload):
+    """
+    Yields a job's image as a Replicate file input: a presigned URL when the storage backend has
+    one (Replicate then fetches the bytes itself), otherwise the open file.
+    """
+    record = media_store.resolve(payload["image_name"]) if payload.get("image_name") else None
+    if record is None:
+        if not payload.get("image_path"):
+            raise JobFailed("The image no longer exists")
+        with open(payload["image_path"], "rb") as image_file:
+            yield image_file
+        return
+    url = media_store.url(record)
+    if url is not None:
+        yield url
+        return
+    with media_store.local_file(record["key"]) as path, open(path, "rb") as image_file:
+        yield image_file
 
 # Routes
-@app.route("/", methods=["GET"])
+@bp.route("/", methods=["GET"])
 def index():
-    if "conversation" not in session:
-        session["conversation"] = []
+    current_conversation_id()
     return render_template("index.html")
 
-@app.route("/generate-image", methods=["POST"])
+@bp.route("/generate-image", methods=["POST"])
 def generate_image():
     try:
         logger.debug("Received request to generate image")
 
-        if "conversation" not in session:
-            session["conversation"] = []
-
         data = request.get_json()
         prompt = data.get('prompt')
         generator = data.get('generator')
@@ -185,109 +760,383 @@ def generate_image():
             logger.error("Prompt and generator type are required.")
             return jsonify({"error": "Prompt and generator type are required."}), 400
 
-        unique_prompt = f"{prompt} - {random_sig()}"
-        logger.debug(f"Unique prompt: {unique_prompt}")
+        if not isinstance(prompt, str):
+            return jsonify({"error": "The prompt must be a string."}), 400
+
+        if generator not in IMAGE_GENERATORS:
+            logger.error("Invalid generator selected")
+            return jsonify({"error": "Invalid generator selected"}), 400
+
+        try:
+            seed, size, count = parse_generation_options(data)
+            check_image_count(generator, count)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         if not is_premium_user() and generator != "openai":
             logger.warning("Non-premium user trying to access non-OpenAI generator")
             return jsonify({"error": "Only OpenAI is available for non-premium users."}), 403
 
-        image_bytes = None
-        if generator == "openai":
-            image_bytes = query_openai_image(unique_prompt)
-        elif generator == "flux":
-            image_bytes = query_flux_image(unique_prompt)
-        elif generator == "stability":
-            image_bytes = query_stability_image(unique_prompt)
-        elif generator == "boreal":
-            image_bytes = query_boreal_image(unique_prompt)
-        elif generator == "phantasma-anime":
-            image_bytes = query_phantasma_anime_image(unique_prompt)
-        else:
-            logger.error("Invalid generator selected")
-            return jsonify({"error": "Invalid generator selected"}), 400
-
-        if not image_bytes:
-            logger.error("Failed to generate image from the selected API.")
-            return jsonify({"error": "Failed to generate image from the selected API."}), 500
+        owner = current_owner()
+        try:
+            result = generate_and_store(generator, prompt, owner, session.sid, seed, size,
+                                        allow_fallback=bool(data.get('allow_fallback')), count=count)
+        except GenerationError as e:
+            return jsonify({"error": str(e)}), 500
+        except (ModelLoading, GeneratorUnavailable) as e:
+            retry_after = round(e.retry_after or 1)
+            return jsonify({"error": f"{generator} is starting up or unavailable, please retry later."}), 503, \
+                {"Retry-After": str(retry_after)}
+        except RateLimited as e:
+            batch_schedulers[generator].back_off(e.retry_after)
+            retry_after = round(e.retry_after or batch_schedulers[generator].default_retry_after)
+            return jsonify({"error": f"{generator} is busy, please retry later."}), 429, {"Retry-After": str(retry_after)}
+
+        conversation_id = current_conversation_id()
+        for image_name in result["images"]:
+            conversation_store.append(conversation_id, owner, "image", result["prompt"], result["generator"], image_name)
+
+        response = {"image_url": result["image_url"], "images": result["images"], "cached": result["cached"],
+                    "generator": result["generator"], "timings": result["timings"]}
+        if result["generator"] != generator:
+            response["fallback_from"] = generator
+        if seed is not None:
+            response["seed"] = seed
+        return jsonify(response), 200
+
+    except OwnerUnavailable:
+        raise
+    except Exception as e:
+        logger.exception(f"Unexpected error: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        image_name = f"{generator}_image_{uuid.uuid4().hex}.png"
-        image_path = f"static/{image_name}"
-        logger.debug(f"Saving image to: {image_path}")
+# Shared pool for fan-out requests; it bounds how many backend calls they make at once in this process
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", 8))
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
 
+@bp.route("/generate-fanout", methods=["POST"])
+def generate_fanout():
+    """
+    Sends one prompt to several generators concurrently and streams each result as soon as it is
+    stored: NDJSON by default, Server-Sent Events when the client accepts text/event-stream. A
+    generator that fails is reported in its own line; a final line summarizes the batch. n asks for
+    several images from generators that can return them in one call.
+    """
+    data = request.get_json(silent=True) or {}
+    prompt = data.get('prompt')
+    generators = data.get('generators') or list(IMAGE_GENERATORS)
+    if not prompt or not isinstance(generators, list) or not all(isinstance(generator, str) for generator in generators):
+        return jsonify({"error": "A prompt and a list of generator names are required."}), 400
+    if not isinstance(prompt, str):
+        return jsonify({"error": "The prompt must be a string."}), 400
+    generators = list(dict.fromkeys(generators))
+    unknown = [generator for generator in generators if generator not in IMAGE_GENERATORS]
+    if unknown:
+        return jsonify({"error": f"Invalid generators selected: {', '.join(map(str, unknown))}"}), 400
+    try:
+        seed, size, count = parse_generation_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Workers have no request context, so everything they need from the session is read here
+    premium = is_premium_user()
+    owner = current_owner()
+    session_key = session.sid
+    conversation_id = current_conversation_id()
+    start = time.monotonic()
+
+    def run(generator):
+        generator_start = time.monotonic()
         try:
-            image = Image.open(io.BytesIO(image_bytes))
-            image.save(image_path)
-            logger.info(f"Image saved successfully: {image_name}")
+            # n is capped per generator at what its backend returns in one call
+            result = generate_and_store(generator, prompt, owner, session_key, seed, size,
+                                        count=min(count, generator_registry.generators[generator].max_images))
+        except GenerationError as e:
+            return {"generator": generator, "error": str(e)}
+        except RateLimited as e:
+            batch_schedulers[generator].back_off(e.retry_after)
+            return {"generator": generator, "error": f"{generator} is busy, please retry later."}
         except Exception as e:
-            logger.error(f"Error saving image: {e}")
-            return jsonify({"error": "Error saving image"}), 500
+            logger.error(f"Fan-out generation with {generator} failed: {e}")
+            return {"generator": generator, "error": "Unexpected error while generating the image."}
+        for image_name in result["images"]:
+            conversation_store.append(conversation_id, owner, "image", result["prompt"], generator, image_name)
+        return {"generator": generator, "image_url": result["image_url"], "images": result["images"],
+                "cached": result["cached"], "timings": result["timings"],
+                "elapsed": round(time.monotonic() - generator_start, 3)}
+
+    results = []
+    futures = []
+    for generator in generators:
+        if not premium and generator != "openai":
+            results.append({"generator": generator, "error": "Only OpenAI is available for non-premium users."})
+        else:
+            futures.append(fanout_executor.submit(run, generator))
 
-        session["conversation"].append({
-            "prompt": unique_prompt,
-            "generator": generator,
-            "image_url": image_name  # Store only the image name
-        })
-        session.modified = True
+    def results_in_completion_order():
+        yield from results
+        for future in as_completed(futures):
+            yield future.result()
 
-        return jsonify({"image_url": image_name}), 200
+    if request.accept_mimetypes.best_match(["application/x-ndjson", "text/event-stream"]) == "text/event-stream":
+        mimetype = "text/event-stream"
 
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        def encode(event, payload):
+            return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+    else:
+        mimetype = "application/x-ndjson"
 
-@app.route("/conversation-history", methods=["GET"])
-def conversation_history():
-    conversation = session.get("conversation", [])
-    videos = session.get("videos", [])
-    
-    # Combine images and videos into a single list
-    for video in videos:
-        conversation.append({
-            "prompt": "Generated Video",
-            "generator": "video",
-            "video_url": video
-        })
-    
-    return jsonify(conversation)
+        def encode(event, payload):
+            return json.dumps(payload) + "\n"
 
-@app.route("/download-image/<filename>", methods=["GET"])
-def download_image(filename):
-    image_path = os.path.join("static", filename)
-    if os.path.exists(image_path):
-        return send_file(image_path, as_attachment=True)
-    else:
+    def stream():
+        succeeded = failed = 0
+        for result in results_in_completion_order():
+            if "error" in result:
+                failed += 1
+                yield encode("error", result)
+            else:
+                succeeded += 1
+                yield encode("image", result)
+        yield encode("done", {"done": True, "succeeded": succeeded, "failed": failed,
+                              "elapsed": round(time.monotonic() - start, 3)})
+
+    return Response(stream(), mimetype=mimetype, headers={"Cache-Control": "no-cache"})
+
+@bp.route("/generate-batch", methods=["POST"])
+def generate_batch():
+    """
+    Runs a list of {"prompt", "generator", "seed"?, "size"?, "n"?, "allow_fallback"?} items through the
+    per-backend schedulers and streams an NDJSON line per item as it finishes (with its index in the
+    request), ending with a summary line. Items that fail, including ones still rate limited after
+    the retries, are reported inline.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "A non-empty list of items is required."}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"A batch can hold at most {BATCH_MAX_ITEMS} items."}), 400
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('prompt') or item.get('generator') not in IMAGE_GENERATORS:
+            return jsonify({"error": f"Item {index} needs a prompt and a valid generator."}), 400
+        if not isinstance(item['prompt'], str):
+            return jsonify({"error": f"Item {index}: the prompt must be a string."}), 400
+        try:
+            seed, size, count = parse_generation_options(item)
+            check_image_count(item['generator'], count)
+        except ValueError as e:
+            return jsonify({"error": f"Item {index}: {e}"}), 400
+        parsed.append((index, item['prompt'], item['generator'], seed, size, count, bool(item.get('allow_fallback'))))
+
+    # Workers have no request context, so everything they need from the session is read here
+    premium = is_premium_user()
+    owner = current_owner()
+    session_key = session.sid
+    conversation_id = current_conversation_id()
+    start = time.monotonic()
+
+    def run(index, prompt, generator, seed, size, count, allow_fallback):
+        result = generate_and_store(generator, prompt, owner, session_key, seed, size, allow_fallback, count)
+        for image_name in result["images"]:
+            conversation_store.append(conversation_id, owner, "image", result["prompt"], result["generator"],
+                                      image_name)
+        return {"index": index, "generator": result["generator"], "image_url": result["image_url"],
+                "images": result["images"], "cached": result["cached"], "timings": result["timings"]}
+
+    rejected = []
+    futures = {}
+    for index, prompt, generator, seed, size, count, allow_fallback in parsed:
+        if not premium and generator != "openai":
+            rejected.append({"index": index, "generator": generator,
+                             "error": "Only OpenAI is available for non-premium users."})
+        else:
+            future = batch_schedulers[generator].submit(run, index, prompt, generator, seed, size, count,
+                                                        allow_fallback)
+            futures[future] = (index, generator)
+
+    def outcome(future):
+        index, generator = futures[future]
+        try:
+            return future.result()
+        except GenerationError as e:
+            return {"index": index, "generator": generator, "error": str(e)}
+        except RateLimited:
+            return {"index": index, "generator": generator, "error": f"{generator} is rate limiting requests."}
+        except Exception as e:
+            logger.error(f"Batch item {index} ({generator}) failed: {e}")
+            return {"index": index, "generator": generator, "error": "Unexpected error while generating the image."}
+
+    def results_in_completion_order():
+        yield from rejected
+        for future in as_completed(futures):
+            yield outcome(future)
+
+    def stream():
+        succeeded = failed = 0
+        for result in results_in_completion_order():
+            if "error" in result:
+                failed += 1
+            else:
+                succeeded += 1
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"done": True, "succeeded": succeeded, "failed": failed,
+                          "elapsed": round(time.monotonic() - start, 3)}) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+
+def history_entry_view(entry):
+    """Shapes a stored conversation entry the way the frontend renders it."""
+    if entry["kind"] == "video":
+        return {"id": entry["id"], "prompt": entry["prompt"], "generator": "video", "video_url": entry["media_name"]}
+    return with_image_variants({
+        "id": entry["id"],
+        "prompt": entry["prompt"],
+        "generator": entry["generator"],
+        "image_url": entry["media_name"],
+    })
+
+@bp.route("/conversation-history", methods=["GET"])
+def conversation_history():
+    """
+    Pages through the conversation, newest page first (entries within a page are oldest first).
+    ?before=<next_cursor> fetches the previous page and ?since=<id> returns only newer entries.
+    Responses carry an ETag, so an unchanged history costs a 304.
+    """
+    conversation_id = current_conversation_id()
+    before = request.args.get("before", type=int)
+    since = request.args.get("since", type=int)
+    limit = max(1, min(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 200))
+
+    latest_id = conversation_store.latest_id(conversation_id)
+    etag = f"{conversation_id}-{latest_id}-{before}-{since}-{limit}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    entries, next_cursor = conversation_store.page(conversation_id, before=before, since=since, limit=limit)
+    response = jsonify({
+        "entries": [history_entry_view(entry) for entry in entries],
+        "next_cursor": next_cursor,
+        "latest_id": latest_id,
+    })
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def send_media(record, as_attachment=False):
+    """
+    Serves an indexed media file with a strong ETag (its content hash) and Last-Modified, so
+    clients get 304s on revalidation and can fetch byte ranges (e.g. video seeking) without
+    downloading the whole file again.
+    """
+    url = media_store.url(record, download_name=record["name"], as_attachment=as_attachment)
+    if url is not None:
+        return redirect_to_storage(url, MEDIA_MAX_AGE)
+    response = send_file(media_storage.path(record["key"]), mimetype=record["content_type"],
+                         as_attachment=as_attachment, download_name=record["name"], conditional=True,
+                         etag=record["hash"], last_modified=record["created_at"], max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+def redirect_to_storage(url, max_age):
+    """
+    Redirects to a presigned URL, so the bytes come from the bucket instead of this worker. The
+    redirect may be cached by the browser, but only for part of the URL's lifetime.
+    """
+    response = redirect(url, code=302)
+    response.cache_control.private = True
+    response.cache_control.max_age = min(max_age, media_storage.url_ttl // 2)
+    return response
+
+@bp.route("/media/<name>", methods=["GET"])
+def media(name):
+    record = media_store.resolve(name)
+    if record is None:
+        # Files generated before the media index existed
+        try:
+            return send_from_directory("static", name)
+        except NotFound:
+            return jsonify({"error": "File not found"}), 404
+    media_store.touch(name)
+    return send_media(record)
+
+@bp.route("/media/<name>/<variant>", methods=["GET"])
+def media_variant(name, variant):
+    record = media_store.resolve(name)
+    if record is None or variant not in derivative_generator.sizes:
         return jsonify({"error": "File not found"}), 404
+    media_store.touch(name)
+    derivative = media_store.get_derivative(record["hash"], variant)
+    if derivative is None:
+        # Not rendered yet (or stored before derivatives existed): serve the original uncached
+        derivative_generator.schedule(record)
+        url = media_store.url(record)
+        if url is not None:
+            response = redirect(url, code=302)
+        else:
+            response = send_file(media_storage.path(record["key"]), mimetype=record["content_type"],
+                                 etag=record["hash"])
+        response.cache_control.no_store = True
+        return response
+    url = media_store.url(derivative)
+    if url is not None:
+        return redirect_to_storage(url, DERIVATIVE_MAX_AGE)
+    response = send_file(media_storage.path(derivative["key"]), mimetype=derivative["content_type"], conditional=True,
+                         etag=f"{record['hash']}-{variant}", max_age=DERIVATIVE_MAX_AGE)
+    response.cache_control.immutable = True
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@bp.route("/download-image/<filename>", methods=["GET"])
+def download_image(filename):
+    record = media_store.resolve(filename)
+    if record is None:
+        try:
+            return send_from_directory("static", filename, as_attachment=True)
+        except NotFound:
+            return jsonify({"error": "File not found"}), 404
+    media_store.touch(filename)
+    return send_media(record, as_attachment=True)
 
-@app.route("/clear-session", methods=["POST"])
+@bp.route("/clear-session", methods=["POST"])
 def clear_session():
+    owner = current_owner()
     try:
-        conversation = session.get("conversation", [])
-        for entry in conversation:
-            image_path = entry.get("image_url")
-            if image_path and os.path.exists(image_path):
-                os.remove(image_path)
+        names = conversation_store.clear(current_conversation_id())
+        for name in names:
+            record = media_store.resolve(name) if name else None
+            if record and record["owner"] == owner:
+                media_store.release(name)
 
+        invalidate_user_caches(session.get('access_token'))
         session.clear()
         return jsonify({"message": "Session and files cleared successfully!"}), 200
     except Exception as e:
-        traceback.print_exc()
+        logger.exception(f"Error clearing the session: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
 
         try:
-            response = requests.post(f"{API_URL}/login", json={'email': email, 'password': password})
+            response = http_client.post(f"{API_URL}/login", json={'email': email, 'password': password}, timeout=auth_timeout)
             if response.status_code == 200:
                 access_token = response.json().get('access_token')
                 session['access_token'] = access_token
+                # A freshly issued token has just been validated by the backend
+                invalidate_user_caches(access_token)
+                auth_cache.set(access_token, 200)
+                prefetch_user_info(access_token)
                 flash('Logged in successfully!', 'success')
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
             else:
                 message = response.json().get('message', 'Login failed')
                 flash(message, 'danger')
@@ -296,130 +1145,210 @@ def login():
 
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     return redirect('https://sourcebox-official-website-9f3f8ae82f0b.herokuapp.com/sign_up')
 
-@app.route('/generate-video', methods=['POST'])
-def generate_video():
+# Replicate models used by the background jobs, pinned to a version. The version handles are resolved
+# the first time a job runs and cached on disk, so starting a worker makes no Replicate calls.
+VIDEO_MODEL = ("sunfjun/stable-video-diffusion", "d68b6e09eedbac7a49e3d8644999d93579c386a083768235cabca88796d70d82")
+UPSCALE_MODEL = ("batouresearch/magic-image-refiner", "507ddf6f977a7e30e46c0daefd30de7d563c72322f9e4cf7cbac52ef0f667b13")
+replicate_versions = VersionCache(
+    replicate,
+    os.path.join(DATA_DIR, "replicate_versions.json"),
+    ttl=float(os.getenv("REPLICATE_VERSION_TTL", 24 * 3600)),
+)
+
+VIDEO_PREDICTION_INPUT = {
+    "cond_aug": 0.05,
+    "decoding_t": 14,
+    "video_length": "14_frames_with_svd",
+    "sizing_strategy": "maintain_aspect_ratio",
+    "motion_bucket_id": 127,
+    "frames_per_second": 6
+}
+
+UPSCALE_PREDICTION_INPUT = {
+    "hdr": 0,
+    "steps": 20,
+    "prompt": "UHD 4k",
+    "scheduler": "DDIM",
+    "creativity": 0.25,
+    "guess_mode": False,
+    "resolution": "original",
+    "resemblance": 0.75,
+    "guidance_scale": 7,
+    "negative_prompt": "teeth, tooth, open mouth, longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, mutant"
+}
+
+def run_video_job(job, report):
+    """Job handler: runs the stable video diffusion prediction and downloads the resulting video."""
     try:
-        logger.info("Starting video generation process")
-        
-        # Load environment variables
-        load_dotenv()
-        api_token = os.getenv("REPLICATE_API_TOKEN")
-        if not api_token:
-            logger.error("API Token not found. Please check your .env file.")
-            return jsonify({"error": "API Token not found"}), 500
-
-        # Get the model and version
-        logger.debug("Fetching model and version")
-        try:
-            model = replicate.models.get("sunfjun/stable-video-diffusion")
-            version = model.versions.get("d68b6e09eedbac7a49e3d8644999d93579c386a083768235cabca88796d70d82")
-        except Exception as e:
-            logger.error(f"Error fetching model or version: {e}")
-            return jsonify({"error": "Error fetching model or version"}), 500
-
-        # Extract input image path from request
-        data = request.get_json()
-        image_path = data.get('image_url')  # This is actually a path in the static folder
-        if not image_path:
-            logger.error("No image path provided")
-            return jsonify({"error": "Image path is required"}), 400
-
-        # Construct the full path to the image
-        full_image_path = os.path.join('static', image_path)
-        logger.debug(f"Full image path: {full_image_path}")
-
-        # Open the image file
-        with open(full_image_path, 'rb') as image_file:
-            logger.info(f"Creating prediction for image file: {full_image_path}")
-            try:
-                # Create a prediction
-                prediction = replicate.predictions.create(
-                    version=version,
-                    input={
-                        "input_image": image_file,
-                        "cond_aug": 0.05,
-                        "decoding_t": 14,
-                        "video_length": "14_frames_with_svd",
-                        "sizing_strategy": "maintain_aspect_ratio",
-                        "motion_bucket_id": 127,
-                        "frames_per_second": 6
-                    }
+        def create_prediction():
+            video_version = replicate_versions.get(*VIDEO_MODEL)
+            with job_image_input(job["payload"]) as image_input:
+                logger.info(f"Creating video prediction for job {job['id']}")
+                return replicate.predictions.create(
+                    version=video_version,
+                    input={"input_image": image_input, **VIDEO_PREDICTION_INPUT}
                 )
-            except Exception as e:
-                logger.error(f"Error creating prediction: {e}")
-                return jsonify({"error": "Error creating prediction"}), 500
-
-            # Wait for the prediction to complete
-            logger.info("Waiting for prediction to complete")
-            prediction.wait()
-
-            # Check the status and get the output
-            if prediction.status == 'succeeded':
-                output_url = prediction.output
-                logger.info(f"Prediction succeeded, video URL: {output_url}")
-
-                # Download the video
-                video_response = requests.get(output_url)
-                video_response.raise_for_status()
-
-                # Save the video to the static directory
-                video_name = f"video_{uuid.uuid4().hex}.mp4"
-                video_path = os.path.join('static', video_name)
-                with open(video_path, 'wb') as video_file:
-                    video_file.write(video_response.content)
-
-                logger.info(f"Video saved successfully at {video_path}")
-
-                # Save the video URL in the session
-                if "videos" not in session:
-                    session["videos"] = []
-                session["videos"].append(video_name)
-                session.modified = True
-
-                return jsonify({"video_url": video_name}), 200
-            else:
-                logger.error(f"Prediction failed with status: {prediction.status}, detail: {prediction.error}")
-                return jsonify({"error": f"Prediction failed with status: {prediction.status}"}), 500
 
+        prediction = run_prediction(replicate, job, report, create_prediction, poll_interval=JOB_POLL_INTERVAL,
+                                    stop=job_manager.stopping)
+        if prediction.status != 'succeeded':
+            logger.error(f"Prediction failed with status: {prediction.status}, detail: {prediction.error}")
+            raise JobFailed(f"Prediction failed with status: {prediction.status}")
+
+        output_url = prediction.output
+        logger.info(f"Prediction succeeded, video URL: {output_url}")
+
+        # Stream the video to disk and move it into the media store
+        with downloaded_output(output_url) as (tmp_path, digest):
+            video_name = media_store.put_file(tmp_path, ".mp4", digest=digest, name_prefix="video", owner=job["owner"],
+                                              generator="video", prompt="Generated Video",
+                                              session_key=job["payload"].get("session_key"))["name"]
+        logger.info(f"Video saved successfully as {video_name}")
+        conversation_store.append(job["payload"]["conversation_id"], job["owner"], "video", "Generated Video",
+                                  "video", video_name)
+        return {"video_url": video_name}
     except replicate.exceptions.ReplicateError as e:
         logger.error(f"Replicate API error during video generation: {e}")
-        return jsonify({"error": "An error occurred with the Replicate API"}), 500
-    except Exception as e:
-        logger.error(f"Unexpected error during video generation: {e}")
-        traceback.print_exc()
-        return jsonify({"error": "An unexpected error occurred"}), 500
+        raise JobFailed("An error occurred with the Replicate API")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"HTTP request error: {e}")
+        raise JobFailed("An error occurred while making an HTTP request")
 
-@app.route('/get-videos', methods=['GET'])
-def get_videos():
-    videos = session.get("videos", [])
-    return jsonify({"videos": videos})
+def run_upscale_job(job, report):
+    """Job handler: runs the magic-image-refiner prediction and downloads the upscaled image."""
+    try:
+        def create_prediction():
+            upscale_version = replicate_versions.get(*UPSCALE_MODEL)
+            with job_image_input(job["payload"]) as image_input:
+                logger.info("Creating prediction for image upscaling")
+                return replicate.predictions.create(
+                    version=upscale_version,
+                    input={"image": image_input, **UPSCALE_PREDICTION_INPUT}
+                )
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+        prediction = run_prediction(replicate, job, report, create_prediction, poll_interval=JOB_POLL_INTERVAL,
+                                    stop=job_manager.stopping)
+        if not (prediction.status == 'succeeded' and isinstance(prediction.output, list) and len(prediction.output) > 0):
+            logger.error(f"Prediction failed with status: {prediction.status}, detail: {prediction.error}")
+            raise JobFailed(f"Prediction failed with status: {prediction.status}")
+
+        output_url = prediction.output[0]
+        logger.info(f"Prediction succeeded, output URL: {output_url}")
+
+        # Stream the upscaled image to disk and move it into the media store
+        with downloaded_output(output_url) as (tmp_path, digest):
+            upscaled_image_name = store_image_file(tmp_path, "upscaled_image", job["owner"], "upscale",
+                                                   "Upscaled Image", session_key=job["payload"].get("session_key"),
+                                                   digest=digest)["name"]
+        logger.info(f"Upscaled image saved successfully as {upscaled_image_name}")
+        conversation_store.append(job["payload"]["conversation_id"], job["owner"], "image", "Upscaled Image",
+                                  "upscale", upscaled_image_name)
+        return {"output_url": upscaled_image_name}
+    except replicate.exceptions.ReplicateError as e:
+        logger.error(f"Replicate API error during prediction: {e}")
+        raise JobFailed("An error occurred with the Replicate API")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"HTTP request error: {e}")
+        raise JobFailed("An error occurred while making an HTTP request")
+    except InvalidImage as e:
+        logger.error(f"Upscaled output is not a valid image: {e}")
+        raise JobFailed("The upscaled image could not be saved")
+
+# Background jobs for the slow Replicate endpoints, persisted so a restart doesn't lose them
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2))
+# A /jobs/<id>/events stream holds a request thread for as long as its job runs, so streams are capped
+# per process and per user; past a cap clients get a 429 and poll status_url instead, as the page does
+JOB_EVENT_STREAMS = int(os.getenv("JOB_EVENT_STREAMS", 4))
+JOB_EVENT_STREAMS_PER_USER = int(os.getenv("JOB_EVENT_STREAMS_PER_USER", 1))
+job_event_streams = {}
+job_event_streams_lock = threading.Lock()
+job_manager = JobManager(
+    JobStore(database("jobs.sqlite3")),
+    handlers={"video": run_video_job, "upscale": run_upscale_job},
+    max_workers=int(os.getenv("JOB_WORKERS", 4)),
+    max_per_user=int(os.getenv("JOB_MAX_PER_USER", 2)),
+    max_active=int(os.getenv("JOB_MAX_ACTIVE", 100)),
+    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", 60)),
+)
+
+def submit_job(kind, image_name):
+    """Queues a job for one of the user's images and returns the 202 response for it."""
+    owner = current_owner()
+    image = resolve_job_image(image_name, owner)
+    logger.debug(f"Resolved {image_name} to {image}")
+    if image is None:
+        logger.error(f"Image not found: {image_name}")
+        return jsonify({"error": "Image file not found"}), 404
 
-# Load environment variables
-load_dotenv()
-api_token = os.getenv("REPLICATE_API_TOKEN")
-if not api_token:
-    logger.error("API Token not found. Please check your .env file.")
-    exit(1)
-
-# Initialize the model and version
-try:
-    model = replicate.models.get("batouresearch/magic-image-refiner")
-    version = model.versions.get("507ddf6f977a7e30e46c0daefd30de7d563c72322f9e4cf7cbac52ef0f667b13")
-except Exception as e:
-    logger.error(f"Error fetching model or version: {e}")
-    exit(1)
-
-@app.route('/upscale-image', methods=['POST'])
+    try:
+        job = job_manager.submit(kind, owner, {
+            **image,
+            "session_key": session.sid,
+            "conversation_id": current_conversation_id(),
+        })
+    except JobLimitExceeded as e:
+        logger.warning(f"Rejected {kind} job: {e}")
+        return jsonify({"error": str(e)}), 429
+
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": url_for('main.get_job', job_id=job["id"]),
+        "events_url": url_for('main.job_events', job_id=job["id"]),
+    }), 202
+
+def open_event_stream(owner):
+    """Counts a new events stream against the caps; returns False if either is reached."""
+    with job_event_streams_lock:
+        if (sum(job_event_streams.values()) >= JOB_EVENT_STREAMS
+                or job_event_streams.get(owner, 0) >= JOB_EVENT_STREAMS_PER_USER):
+            return False
+        job_event_streams[owner] = job_event_streams.get(owner, 0) + 1
+        return True
+
+def close_event_stream(owner):
+    with job_event_streams_lock:
+        job_event_streams[owner] -= 1
+        if not job_event_streams[owner]:
+            del job_event_streams[owner]
+
+def job_view(job):
+    return {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "result": job["result"],
+        "error": job["error"],
+    }
+
+@bp.route('/generate-video', methods=['POST'])
+def generate_video():
+    logger.info("Starting video generation process")
+    if not os.getenv("REPLICATE_API_TOKEN"):
+        logger.error("API Token not found. Please check your .env file.")
+        return jsonify({"error": "API Token not found"}), 500
+
+    # Extract input image path from request
+    data = request.get_json()
+    image_path = data.get('image_url')  # This is actually a media name
+    if not image_path:
+        logger.error("No image path provided")
+        return jsonify({"error": "Image path is required"}), 400
+
+    return submit_job("video", image_path)
+
+@bp.route('/upscale-image', methods=['POST'])
 def upscale_image():
     logger.debug("Received request to upscale image")
+    if not os.getenv("REPLICATE_API_TOKEN"):
+        logger.error("API Token not found. Please check your .env file.")
+        return jsonify({"error": "API Token not found"}), 500
+
     data = request.get_json()
     image_path = data.get('image_path')
 
@@ -427,80 +1356,178 @@ def upscale_image():
         logger.error("Image path not provided in the request")
         return jsonify({"error": "Image path is required"}), 400
 
-    try:
-        # Construct the full path to the image
-        full_image_path = os.path.join('static', image_path)
-        logger.debug(f"Full image path: {full_image_path}")
-
-        # Open the image file
-        with open(full_image_path, 'rb') as image_file:
-            logger.info("Creating prediction for image upscaling")
-            prediction = replicate.predictions.create(
-                version=version,
-                input={
-                    "hdr": 0,
-                    "image": image_file,
-                    "steps": 20,
-                    "prompt": "UHD 4k",
-                    "scheduler": "DDIM",
-                    "creativity": 0.25,
-                    "guess_mode": False,
-                    "resolution": "original",
-                    "resemblance": 0.75,
-                    "guidance_scale": 7,
-                    "negative_prompt": "teeth, tooth, open mouth, longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, mutant"
-                }
-            )
-            logger.debug("Waiting for prediction to complete")
-            prediction.wait()
-
-            if prediction.status == 'succeeded' and isinstance(prediction.output, list) and len(prediction.output) > 0:
-                output_url = prediction.output[0]
-                logger.info(f"Prediction succeeded, output URL: {output_url}")
-
-                # Download the upscaled image
-                upscaled_image_response = requests.get(output_url)
-                upscaled_image_response.raise_for_status()
-
-                # Save the upscaled image to the static directory
-                upscaled_image_name = f"upscaled_image_{uuid.uuid4().hex}.png"
-                upscaled_image_path = os.path.join('static', upscaled_image_name)
-                with open(upscaled_image_path, 'wb') as upscaled_image_file:
-                    upscaled_image_file.write(upscaled_image_response.content)
-
-                logger.info(f"Upscaled image saved successfully at {upscaled_image_path}")
-
-                # Add the upscaled image to the session's conversation
-                if "conversation" not in session:
-                    session["conversation"] = []
-
-                session["conversation"].append({
-                    "prompt": "Upscaled Image",
-                    "generator": "upscale",
-                    "image_url": upscaled_image_name
-                })
-                session.modified = True
-
-                # Return the path of the saved upscaled image
-                return jsonify({"output_url": upscaled_image_name}), 200
-            else:
-                logger.error(f"Prediction failed with status: {prediction.status}, detail: {prediction.error}")
-                return jsonify({"error": f"Prediction failed with status: {prediction.status}"}), 500
+    return submit_job("upscale", image_path)
 
-    except FileNotFoundError:
-        logger.error(f"Image file not found at path: {full_image_path}")
-        return jsonify({"error": "Image file not found"}), 404
-    except replicate.exceptions.ReplicateError as e:
-        logger.error(f"Replicate API error during prediction: {e}")
-        return jsonify({"error": "An error occurred with the Replicate API"}), 500
-    except requests.exceptions.RequestException as e:
-        logger.error(f"HTTP request error: {e}")
-        return jsonify({"error": "An error occurred while making an HTTP request"}), 500
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None or job["owner"] != current_owner():
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_view(job))
+
+@bp.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Server-Sent Events stream of a job's progress, closed once the job finishes. Answers 429 when
+    too many streams are open (see JOB_EVENT_STREAMS); the job can still be polled then.
+    """
+    job = job_manager.get(job_id)
+    owner = current_owner()
+    if job is None or job["owner"] != owner:
+        return jsonify({"error": "Job not found"}), 404
+    if not open_event_stream(owner):
+        return jsonify({"error": "Too many open event streams, poll status_url instead.",
+                        "status_url": url_for('main.get_job', job_id=job_id)}), 429, \
+            {"Retry-After": str(max(1, round(JOB_POLL_INTERVAL)))}
+
+    def stream():
+        last_update = None
+        last_sent = time.monotonic()
+        current = job
+        while True:
+            if current["updated_at"] != last_update:
+                last_update = current["updated_at"]
+                last_sent = time.monotonic()
+                yield f"event: {current['status']}\ndata: {json.dumps(job_view(current))}\n\n"
+                if current["status"] not in ACTIVE_STATUSES:
+                    return
+            elif time.monotonic() - last_sent > 15:
+                # Keep intermediaries from closing an idle connection
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(1)
+            current = job_manager.get(job_id)
+
+    response = Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    # Runs however the stream ends, even when the client leaves before the first event
+    response.call_on_close(lambda: close_event_stream(owner))
+    return response
+
+@bp.route('/get-videos', methods=['GET'])
+def get_videos():
+    entries, _ = conversation_store.page(current_conversation_id(), kind="video", limit=HISTORY_PAGE_SIZE)
+    return jsonify({"videos": [entry["media_name"] for entry in entries]})
+
+@bp.route('/stats', methods=['GET'])
+def stats():
+    """Internal counters for the caches and pools in front of the backends."""
+    with job_event_streams_lock:
+        event_streams = sum(job_event_streams.values())
+    return jsonify({
+        "auth_cache": auth_cache.stats(),
+        "user_cache": user_cache.stats(),
+        "http": http_client.stats(),
+        "jobs": job_manager.stats(),
+        "job_event_streams": event_streams,
+        "media": media_store.stats(),
+        "result_cache": result_cache.stats(),
+        "batch": {name: scheduler.stats() for name, scheduler in batch_schedulers.items()},
+        "generators": generator_registry.stats(),
+        "derivatives": derivative_generator.stats(),
+        "reaper": media_reaper.stats(),
+        "replicate_versions": replicate_versions.stats(),
+    })
+
+# Bearer token a scraper must send to read /metrics; without it the endpoint is open
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Latency histograms, error counters and in-flight gauges in the Prometheus text format."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Unauthorized"}), 401
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@bp.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness probe: the process is up and serving requests."""
+    return jsonify({"status": "ok"})
+
+@bp.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe: 503 once the process is draining or when its databases can't be opened,
+    so the load balancer stops routing new requests here.
+    """
+    if draining.is_set():
+        return jsonify({"status": "draining"}), 503
+    try:
+        for path in {media_store.index_path, job_manager.store.path, conversation_store.path}:
+            with connect(path) as conn:
+                conn.execute("SELECT 1")
     except Exception as e:
-        logger.error(f"Unexpected error during prediction: {e}")
-        traceback.print_exc()
-        return jsonify({"error": "An unexpected error occurred"}), 500
+        logger.error(f"Readiness check failed: {e}")
+        return jsonify({"status": "unavailable"}), 503
+    return jsonify({"status": "ready", "pid": os.getpid()})
+
+_started_pid = None
+
+def start_services():
+    """Starts this process's background threads (media reaper, job maintenance) once per process."""
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    media_reaper.start()
+    job_manager.start()
+
+def shutdown_services():
+    """
+    Drains this process before it exits: lets in-flight generations and derivative renders finish
+    and stops taking jobs. Queued jobs and jobs still waiting on their prediction are handed back,
+    and another worker resumes them right away from the recorded prediction; jobs already
+    downloading their output finish here, before the derivative pool and HTTP client they use close.
+    """
+    draining.set()
+    logger.info(f"Draining worker {os.getpid()}")
+    media_reaper.stop()
+    job_manager.shutdown(wait=False)
+    fanout_executor.shutdown(wait=True)
+    for scheduler in batch_schedulers.values():
+        scheduler.shutdown(wait=True)
+    generator_registry.shutdown(wait=True)
+    job_manager.shutdown(wait=True)
+    derivative_generator.shutdown(wait=True)
+    user_prefetch_executor.shutdown(wait=False)
+    http_client.close()
+
+def create_app(config=None):
+    """
+    Application factory. Flask configuration comes from FLASK_* environment variables
+    (FLASK_SECRET_KEY, FLASK_SESSION_TYPE, ...) and then from the config mapping; background
+    services are started for the calling process. config only reaches app.config: DATA_DIR, media
+    storage, the stores, backend clients and pools are module globals read from the environment
+    when this module is imported, so they have to be set there beforehand. Being built per
+    process, they also mean a pre-fork server must import this module in each worker (no preloading).
+    """
+    global session_interface
+    app = Flask(__name__)
+    # The session is stored on the filesystem unless configured otherwise; 'supersecretkey' is only for development
+    app.config.update(SESSION_TYPE="filesystem", SECRET_KEY="supersecretkey")
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
+    # With several hosts the sessions must be shared too: FLASK_SESSION_TYPE=redis and SESSION_REDIS_URL
+    if app.config["SESSION_TYPE"] == "redis" and "SESSION_REDIS" not in app.config:
+        from redis import Redis
+
+        app.config["SESSION_REDIS"] = Redis.from_url(
+            os.getenv("SESSION_REDIS_URL") or os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    Session(app)
+    app.register_blueprint(bp)
+    session_interface = app.session_interface
+    save_session = session_interface.save_session
+
+    def timed_save_session(*args):
+        with metrics.timed_stage("session_save"):
+            return save_session(*args)
+
+    session_interface.save_session = timed_save_session
+    start_services()
+    return app
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    # Development server only; production runs wsgi:app under gunicorn (see gunicorn.conf.py)
+    app = create_app()
+    app.run(host="0.0.0.0", port=port, debug=app.debug)
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+In-process TTL cache for values derived from an access token (e.g. the result of
+an authentication check). Entries are keyed by a hash of the token so raw tokens
+are never kept in memory longer than the request that carried them.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_token(token):
+    """Returns a stable, non-reversible cache key for an access token."""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class _InFlight:
+    """A load that is currently running; waiters block on the event."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TokenCache:
+    """
+    Bounded LRU cache with separate TTLs for positive and negative results.
+
+    Concurrent lookups for the same token while a load is running are coalesced:
+    only the first caller runs the loader and the others wait for its result.
+    """
+
+    def __init__(self, ttl=60.0, negative_ttl=5.0, max_size=1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get_or_load(self, token, loader, is_positive=bool):
+        """
+        Returns the cached value for the token, calling loader() on a miss.
+        is_positive(value) decides whether the value is kept for the positive or
+        the negative TTL. Exceptions raised by the loader are never cached.
+        """
+        key = hash_token(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _InFlight()
+                self._inflight[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            flight.value = value
+            self._store(key, value, self.ttl if is_positive(value) else self.negative_ttl)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def get(self, token, default=None):
+        """Returns the cached value without loading, or default if absent/expired."""
+        key = hash_token(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, token, value, ttl=None):
+        self._store(hash_token(token), value, self.ttl if ttl is None else ttl)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(hash_token(token), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+            }
+
+    def _store(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
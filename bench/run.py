@@ -0,0 +1,388 @@
+"""
+Offline load test: starts the stub backends and the app against them, drives a
+set of endpoints at a fixed concurrency and reports throughput, latency
+percentiles and the server's peak RSS. No real backend is called.
+
+    python -m bench.run --scenario generate-image --concurrency 16 --requests 400
+    python -m bench.run --scenario all --server gunicorn --latency hf=1.5 --error-rate hf=0.05
+    python -m bench.run --scenario generate-image --compare bench/results/baseline.json
+
+Scenarios: generate-image, conversation-history, upscale-image, generate-video
+(or all). Jobs (upscale, video) are timed from submission until they finish.
+Every run is written as JSON to --output (bench/results/<time>.json by default),
+so a later run can be compared against it with --compare.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.stubs import BACKENDS, StubBackends
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("generate-image", "conversation-history", "upscale-image", "generate-video")
+JOB_SCENARIOS = {"upscale-image": ("/upscale-image", "image_path"), "generate-video": ("/generate-video", "image_url")}
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list, or None when it is empty."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    """Latency summary in milliseconds."""
+    values = sorted(latency * 1000 for latency in latencies)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    return {"p50": round(percentile(values, 0.5), 2), "p95": round(percentile(values, 0.95), 2),
+            "p99": round(percentile(values, 0.99), 2), "mean": round(sum(values) / len(values), 2),
+            "max": round(values[-1], 2)}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RssSampler:
+    """Samples the summed RSS of a process and its children from /proc (Linux only) and keeps the peak."""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="rss-sampler", daemon=True)
+
+    def start(self):
+        if os.path.exists(f"/proc/{self.pid}/status"):
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def reset(self):
+        peak, self.peak = self.peak, 0
+        return peak
+
+    def _loop(self):
+        while not self._stopping.wait(self.interval):
+            self.peak = max(self.peak, sum(_rss_bytes(pid) for pid in _process_tree(self.pid)))
+
+
+def _process_tree(pid):
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as children:
+                pending += [int(child) for child in children.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class AppServer:
+    """The app in a subprocess, either the development server or gunicorn, configured by environment."""
+
+    def __init__(self, server, stub_env, workdir, workers, threads):
+        self.server = server
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.env = {
+            **os.environ,
+            **stub_env,
+            "PORT": str(self.port),
+            "DATA_DIR": os.path.join(workdir, "data"),
+            "FLASK_SESSION_FILE_DIR": os.path.join(workdir, "sessions"),
+            "FLASK_SECRET_KEY": "bench",
+            "FLASK_DEBUG": "0",
+            "LOG_LEVEL": "WARNING",
+            "JOB_POLL_INTERVAL": "0.2",
+            "JOB_MAX_PER_USER": "1000",
+            "JOB_MAX_ACTIVE": "100000",
+            "WEB_CONCURRENCY": str(workers),
+            "GUNICORN_THREADS": str(threads),
+            "GUNICORN_ACCESS_LOG": "",
+        }
+        self.log = open(os.path.join(workdir, "server.log"), "w")
+        self.process = None
+
+    def start(self, timeout=60):
+        if self.server == "gunicorn":
+            command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"]
+        else:
+            command = [sys.executable, "app.py"]
+        self.process = subprocess.Popen(command, cwd=REPO_DIR, env=self.env, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The app exited with {self.process.returncode}, see {self.log.name}")
+            try:
+                if requests.get(f"{self.base_url}/ready", timeout=1).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"The app did not become ready in {timeout}s, see {self.log.name}")
+
+    def stop(self, timeout=30):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+
+class User:
+    """A logged-in browser session; every simulated user gets its own access token from the auth stub."""
+
+    def __init__(self, base_url, pool_size):
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.image_name = None
+
+    def login(self):
+        response = self.session.post(f"{self.base_url}/login", data={"email": "bench", "password": "bench"},
+                                     allow_redirects=False)
+        if response.status_code != 302:
+            raise RuntimeError(f"Login failed with {response.status_code}")
+        return self
+
+    def generate_image(self, generator, timeout=300):
+        response = self.session.post(f"{self.base_url}/generate-image",
+                                     json={"prompt": "a lighthouse on a cliff at dusk", "generator": generator},
+                                     timeout=timeout)
+        if response.status_code == 200:
+            self.image_name = response.json()["image_url"]
+        return response.status_code
+
+    def conversation_history(self, timeout=60):
+        return self.session.get(f"{self.base_url}/conversation-history", timeout=timeout).status_code
+
+    def run_job(self, scenario, poll_interval=0.1, timeout=600):
+        """Submits an upscale/video job and waits for it; returns (status, submit latency in seconds)."""
+        path, field = JOB_SCENARIOS[scenario]
+        start = time.perf_counter()
+        response = self.session.post(f"{self.base_url}{path}", json={field: self.image_name}, timeout=60)
+        submitted = time.perf_counter() - start
+        if response.status_code != 202:
+            return response.status_code, submitted
+        status_url = f"{self.base_url}{response.json()['status_url']}"
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = self.session.get(status_url, timeout=60).json()
+            if job["status"] == "succeeded":
+                return 200, submitted
+            if job["status"] in ("failed", "cancelled"):
+                return job["status"], submitted
+            time.sleep(poll_interval)
+        return "timeout", submitted
+
+
+def run_scenario(scenario, users, args):
+    """Sends args.requests requests from args.concurrency threads, spreading them over the users."""
+    # Untimed setup: history to page through, and an image of each user's to upscale or animate
+    if scenario == "conversation-history":
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(lambda user: [user.generate_image(args.generator) for _ in range(args.history)],
+                              users))
+    elif scenario in JOB_SCENARIOS:
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(lambda user: user.image_name or user.generate_image(args.generator), users))
+
+    latencies, submit_latencies, statuses = [], [], {}
+    lock = threading.Lock()
+
+    def one(index):
+        user = users[index % len(users)]
+        start = time.perf_counter()
+        submitted = None
+        try:
+            if scenario == "generate-image":
+                status = user.generate_image(args.generator)
+            elif scenario == "conversation-history":
+                status = user.conversation_history()
+            else:
+                status, submitted = user.run_job(scenario)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+            if submitted is not None:
+                submit_latencies.append(submitted)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(one, range(args.requests)))
+    duration = time.perf_counter() - start
+
+    result = {
+        "scenario": scenario,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "ok": statuses.get("200", 0),
+        "statuses": statuses,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(statuses.get("200", 0) / duration, 2) if duration else None,
+        "latency_ms": summarize(latencies),
+    }
+    if submit_latencies:
+        result["submit_latency_ms"] = summarize(submit_latencies)
+    return result
+
+
+def parse_backend_values(values, option):
+    """Turns ["hf=1.5", "openai=0.2"] (or a bare "0.5" for every backend) into a dict of floats."""
+    parsed = {}
+    for value in values or []:
+        backend, _, number = value.rpartition("=")
+        for name in ([backend] if backend else BACKENDS):
+            if name not in BACKENDS:
+                raise SystemExit(f"{option}: unknown backend {name!r}, expected one of {', '.join(BACKENDS)}")
+            parsed[name] = float(number)
+    return parsed
+
+
+def compare(results, baseline_path):
+    """Prints the change of throughput and latency percentiles per scenario against an earlier run."""
+    with open(baseline_path) as baseline_file:
+        baseline = {result["scenario"]: result for result in json.load(baseline_file)["scenarios"]}
+    for result in results["scenarios"]:
+        before = baseline.get(result["scenario"])
+        if before is None:
+            continue
+        changes = []
+        for label, old, new in [("throughput", before["throughput_rps"], result["throughput_rps"])] + \
+                [(key, before["latency_ms"][key], result["latency_ms"][key]) for key in ("p50", "p95", "p99")]:
+            if old and new is not None:
+                changes.append(f"{label} {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+        print(f"{result['scenario']}: {', '.join(changes)}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS + ("all",),
+                        help="endpoint to drive; repeat for several (default: generate-image)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=None, help="logged-in sessions (default: --concurrency)")
+    parser.add_argument("--generator", default="flux")
+    parser.add_argument("--history", type=int, default=10,
+                        help="images each user generates before the conversation-history scenario")
+    parser.add_argument("--latency", action="append", metavar="BACKEND=SECONDS",
+                        help="stub latency, e.g. hf=1.5 (backends: auth, hf, openai, replicate)")
+    parser.add_argument("--error-rate", action="append", metavar="BACKEND=FRACTION",
+                        help="share of stub calls that fail, e.g. openai=0.05")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of injected errors")
+    parser.add_argument("--image-size", type=int, default=512, help="side of the generated stub images")
+    parser.add_argument("--server", choices=("dev", "gunicorn"), default="dev")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=16, help="gunicorn threads per worker")
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument("--compare", metavar="RESULTS_JSON", help="earlier results to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the app's data directory and log")
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or ["generate-image"]
+    scenarios = list(SCENARIOS) if "all" in scenarios else list(dict.fromkeys(scenarios))
+    stubs = StubBackends(latency=parse_backend_values(args.latency, "--latency"),
+                         error_rate=parse_backend_values(args.error_rate, "--error-rate"),
+                         error_status=args.error_status, image_size=args.image_size).start()
+    workdir = tempfile.mkdtemp(prefix="imagegen-bench-")
+    server = AppServer(args.server, stubs.environ(), workdir, args.workers, args.threads)
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep")},
+        "scenarios": [],
+    }
+    keep = args.keep
+    try:
+        server.start()
+        sampler = RssSampler(server.process.pid).start()
+        users = [User(server.base_url, args.concurrency).login() for _ in range(args.users or args.concurrency)]
+        for scenario in scenarios:
+            sampler.reset()
+            result = run_scenario(scenario, users, args)
+            result["peak_rss_mb"] = round(sampler.reset() / 2**20, 1) or None
+            results["scenarios"].append(result)
+            latency = result["latency_ms"]
+            print(f"{scenario}: {result['ok']}/{result['requests']} ok, {result['throughput_rps']} req/s, "
+                  f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+                  f"peak RSS {result['peak_rss_mb']} MB")
+        sampler.stop()
+    except BaseException:
+        # Keep the server log around to see what went wrong
+        keep = True
+        raise
+    finally:
+        server.stop()
+        stubs.stop()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # The largest resident set any finished child reached (KiB on Linux, bytes on macOS)
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    results["server_peak_rss_mb"] = round(max_rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+    results["stubs"] = stubs.stats()
+
+    output = args.output or os.path.join(REPO_DIR, "bench", "results",
+                                         time.strftime("%Y%m%d-%H%M%S", time.gmtime()) + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Local stand-ins for every backend the app calls, for load tests that must not
+spend real credits. One threaded HTTP server answers, by path prefix:
+
+    /auth/...       the auth API (API_URL): /login, /user_history, /user/id, premium status
+    /hf/models/...  Hugging Face inference (HF_INFERENCE_URL)
+    /openai/v1/...  OpenAI images (OPENAI_BASE_URL)
+    /replicate/...  Replicate models, file uploads and predictions (REPLICATE_BASE_URL)
+    /files/...      the outputs Replicate predictions point at
+
+Each backend has its own latency (seconds) and error rate (0..1); an injected
+error answers with error_status, and a Replicate prediction fails instead.
+"""
+import base64
+import io
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+BACKENDS = ("auth", "hf", "openai", "replicate")
+
+
+def noise_png(size):
+    """A PNG of random pixels, so it is about as large as a real generation of that size."""
+    pixels = os.urandom(size * size * 3)
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (size, size), pixels).save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class StubBackends:
+    def __init__(self, latency=None, error_rate=None, error_status=500, image_size=512, video_bytes=2 * 1024 * 1024,
+                 host="127.0.0.1", port=0):
+        self.latency = {backend: 0.0 for backend in BACKENDS}
+        self.latency.update(latency or {})
+        self.error_rate = {backend: 0.0 for backend in BACKENDS}
+        self.error_rate.update(error_rate or {})
+        self.error_status = error_status
+        self.image = noise_png(image_size)
+        self.video = os.urandom(video_bytes)
+        self.predictions = {}
+        self.calls = {backend: 0 for backend in BACKENDS}
+        self.errors = {backend: 0 for backend in BACKENDS}
+        self._lock = threading.Lock()
+        self._tokens = itertools.count(1)
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environ(self):
+        """Environment variables that point the app at these stubs."""
+        return {
+            "API_URL": f"{self.base_url}/auth",
+            "HF_INFERENCE_URL": f"{self.base_url}/hf/models",
+            "HUGGINGFACEHUB_API_TOKEN": "bench",
+            "OPENAI_BASE_URL": f"{self.base_url}/openai/v1",
+            "OPENAI_API_KEY": "bench",
+            "REPLICATE_BASE_URL": f"{self.base_url}/replicate",
+            "REPLICATE_API_TOKEN": "bench",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bench-stubs", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "injected_errors": dict(self.errors)}
+
+    def begin_call(self, backend, wait=True):
+        """Counts a call, sleeps for the backend's latency if wait is set and returns whether to inject an error."""
+        failed = random.random() < self.error_rate[backend]
+        with self._lock:
+            self.calls[backend] += 1
+            if failed:
+                self.errors[backend] += 1
+        if wait and self.latency[backend]:
+            time.sleep(self.latency[backend])
+        return failed
+
+    def new_token(self):
+        return f"bench-token-{next(self._tokens)}"
+
+    def create_prediction(self, version, inputs, failed):
+        prediction_id = uuid.uuid4().hex
+        # The video model (input_image) returns one URL, the upscaler a list of them
+        if "input_image" in inputs:
+            output = f"{self.base_url}/files/{prediction_id}.mp4"
+        else:
+            output = [f"{self.base_url}/files/{prediction_id}.png"]
+        prediction = {"id": prediction_id, "model": "bench/stub", "version": version, "status": "starting",
+                      "input": inputs, "output": None, "logs": "", "error": None, "metrics": {},
+                      "created_at": _timestamp(),
+                      "urls": {"get": f"{self.base_url}/replicate/v1/predictions/{prediction_id}"},
+                      "_ready_at": time.monotonic() + self.latency["replicate"], "_failed": failed, "_output": output}
+        with self._lock:
+            self.predictions[prediction_id] = prediction
+        return prediction
+
+    def get_prediction(self, prediction_id):
+        """The prediction as the API would show it now: processing until its latency has passed."""
+        with self._lock:
+            prediction = self.predictions.get(prediction_id)
+            if prediction is None:
+                return None
+            if prediction["status"] in ("starting", "processing"):
+                if time.monotonic() < prediction["_ready_at"]:
+                    prediction["status"] = "processing"
+                elif prediction["_failed"]:
+                    prediction.update(status="failed", error="Injected error", completed_at=_timestamp())
+                else:
+                    prediction.update(status="succeeded", output=prediction["_output"], completed_at=_timestamp())
+            return {key: value for key, value in prediction.items() if not key.startswith("_")}
+
+
+def _timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def _handler(stubs):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, body=b"", content_type="application/json", headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def fail(self):
+            self.send(stubs.error_status, {"error": "Injected error"}, headers={"Retry-After": "1"})
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path.startswith("/auth/"):
+                if stubs.begin_call("auth"):
+                    return self.fail()
+                if path == "/auth/user_history":
+                    return self.send(200, {"history": []})
+                if path == "/auth/user/id":
+                    token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+                    return self.send(200, {"user_id": token.rsplit("-", 1)[-1]})
+                if path.endswith("/premium/status"):
+                    return self.send(200, {"premium_status": True})
+            elif path.startswith("/replicate/v1/models/"):
+                # The version handle lookup; it is cached by the app, so no latency or errors here
+                match = re.match(r"^/replicate/v1/models/([^/]+)/([^/]+)(?:/versions/([^/]+))?$", path)
+                if match:
+                    owner, name, version = match.groups()
+                    if version:
+                        return self.send(200, {"id": version, "created_at": _timestamp(), "cog_version": "0.9",
+                                               "openapi_schema": {}})
+                    return self.send(200, {"url": f"https://replicate.com/{owner}/{name}", "owner": owner,
+                                           "name": name, "visibility": "public", "run_count": 0})
+            elif path.startswith("/replicate/v1/predictions/"):
+                prediction = stubs.get_prediction(path.rsplit("/", 1)[-1])
+                if prediction is not None:
+                    return self.send(200, prediction)
+            elif path.startswith("/files/"):
+                if path.endswith(".mp4"):
+                    return self.send(200, stubs.video, "video/mp4")
+                return self.send(200, stubs.image, "image/png")
+            self.send(404, {"error": "Not found"})
+
+        def do_POST(self):
+            path = self.path.split("?", 1)[0]
+            body = self.read_body()
+            if path == "/auth/login":
+                if stubs.begin_call("auth"):
+                    return self.fail()
+                return self.send(200, {"access_token": stubs.new_token()})
+            if path.startswith("/hf/models/"):
+                if stubs.begin_call("hf"):
+                    return self.fail()
+                return self.send(200, stubs.image, "image/png")
+            if path == "/openai/v1/images/generations":
+                if stubs.begin_call("openai"):
+                    return self.fail()
+                count = json.loads(body or b"{}").get("n", 1)
+                encoded = base64.b64encode(stubs.image).decode()
+                return self.send(200, {"created": int(time.time()), "data": [{"b64_json": encoded}] * count})
+            if path == "/replicate/v1/files":
+                file_id = uuid.uuid4().hex
+                return self.send(201, {"id": file_id, "name": "input", "content_type": "application/octet-stream",
+                                       "size": len(body), "etag": file_id, "checksums": {}, "metadata": {},
+                                       "created_at": _timestamp(),
+                                       "urls": {"get": f"{stubs.base_url}/files/{file_id}.png"}})
+            if path == "/replicate/v1/predictions":
+                # A prediction spends its latency processing, so creating it answers at once
+                failed = stubs.begin_call("replicate", wait=False)
+                request_body = json.loads(body or b"{}")
+                prediction = stubs.create_prediction(request_body.get("version", ""), request_body.get("input", {}),
+                                                     failed)
+                return self.send(201, stubs.get_prediction(prediction["id"]))
+            self.send(404, {"error": "Not found"})
+
+    return Handler
+
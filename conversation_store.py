@@ -0,0 +1,87 @@
+"""
+Append-only store for conversation history.
+
+The session only keeps a conversation id; entries (generated images, upscales,
+videos) are appended here and read back in pages, so session size stays
+constant no matter how much a user generates.
+"""
+import time
+
+from db import connect, ensure_parent_dir, is_database_url
+
+
+class ConversationStore:
+    def __init__(self, path):
+        self.path = path
+        ensure_parent_dir(path)
+        with connect(path) as conn:
+            if not is_database_url(path):
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id TEXT NOT NULL,
+                    owner TEXT,
+                    kind TEXT NOT NULL,
+                    prompt TEXT,
+                    generator TEXT,
+                    media_name TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_conversation ON entries (conversation_id, id)")
+
+    def append(self, conversation_id, owner, kind, prompt, generator, media_name):
+        """Adds an entry ('image' or 'video') and returns its id."""
+        with connect(self.path) as conn:
+            cursor = conn.execute(
+                "INSERT INTO entries (conversation_id, owner, kind, prompt, generator, media_name, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id",
+                (conversation_id, owner, kind, prompt, generator, media_name, time.time()))
+            return cursor.fetchone()[0]
+
+    def page(self, conversation_id, before=None, since=None, limit=50, kind=None):
+        """
+        Returns (entries oldest first, next_cursor). Without since, this is the newest `limit`
+        entries older than `before`; next_cursor pages further back and is None at the start of
+        the history. With since, it is the entries newer than that id (a delta).
+        """
+        clauses, params = ["conversation_id = ?"], [conversation_id]
+        if kind is not None:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if since is not None:
+            clauses.append("id > ?")
+            params.append(since)
+            order = "ASC"
+        else:
+            if before is not None:
+                clauses.append("id < ?")
+                params.append(before)
+            order = "DESC"
+        with connect(self.path) as conn:
+            rows = conn.execute(
+                f"SELECT * FROM entries WHERE {' AND '.join(clauses)} ORDER BY id {order} LIMIT ?",
+                (*params, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        entries = [dict(row) for row in rows[:limit]]
+        if order == "DESC":
+            entries.reverse()
+            next_cursor = entries[0]["id"] if has_more else None
+        else:
+            next_cursor = entries[-1]["id"] if has_more else None
+        return entries, next_cursor
+
+    def latest_id(self, conversation_id):
+        with connect(self.path) as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM entries WHERE conversation_id = ?",
+                                (conversation_id,)).fetchone()[0]
+
+    def clear(self, conversation_id):
+        """Deletes a conversation and returns the media names it referenced."""
+        with connect(self.path) as conn:
+            names = [row[0] for row in conn.execute(
+                "SELECT media_name FROM entries WHERE conversation_id = ?", (conversation_id,))]
+            conn.execute("DELETE FROM entries WHERE conversation_id = ?", (conversation_id,))
+        return names
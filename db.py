@@ -0,0 +1,136 @@
+"""
+Small database helpers shared by the app's stores (jobs, media index, ...).
+
+A store's target is either a SQLite file path, local to this host, or a postgres://
+URL (DATABASE_URL) for a database every host shares. The stores are written in
+SQLite's dialect; for Postgres, connect() translates the few differences they rely
+on (? placeholders, column types, BEGIN IMMEDIATE as the write lock). psycopg2 is
+only needed for Postgres.
+"""
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+# Advisory lock taken for BEGIN IMMEDIATE, so writers serialize like they do on one SQLite file
+WRITE_LOCK_KEY = 0x6d656469
+
+# Idle Postgres connections kept per process for reuse
+MAX_IDLE_CONNECTIONS = 8
+
+POSTGRES_TYPES = (
+    (re.compile(r"\bINTEGER PRIMARY KEY( AUTOINCREMENT)?\b"), "BIGSERIAL PRIMARY KEY"),
+    (re.compile(r"\bINTEGER\b"), "BIGINT"),
+    (re.compile(r"\bREAL\b"), "DOUBLE PRECISION"),
+)
+
+_idle = {}
+_idle_lock = threading.Lock()
+
+
+def is_database_url(target):
+    return target.startswith(("postgres://", "postgresql://"))
+
+
+def ensure_parent_dir(path):
+    if is_database_url(path):
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+@contextmanager
+def connect(target):
+    """
+    Opens a short-lived connection that commits on success, rolls back on error and
+    is always closed (or, for Postgres, returned to the idle pool). Using one
+    connection per operation keeps the stores thread safe.
+    """
+    if is_database_url(target):
+        with _connect_postgres(target) as conn:
+            yield conn
+        return
+    conn = sqlite3.connect(target, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def _connect_postgres(url):
+    if psycopg2 is None:
+        raise RuntimeError("DATABASE_URL needs psycopg2 (pip install psycopg2-binary)")
+    # Connections must not cross a fork, so the pool is per process
+    pool_key = (os.getpid(), url)
+    with _idle_lock:
+        idle = _idle.setdefault(pool_key, [])
+        raw = idle.pop() if idle else None
+    if raw is None:
+        raw = psycopg2.connect(url)
+        # SUM() over integers comes back as numeric; the stores expect plain numbers
+        psycopg2.extensions.register_type(
+            psycopg2.extensions.new_type(psycopg2.extensions.DECIMAL.values, "NUMBER", _number), raw)
+    conn = PostgresConnection(raw)
+    try:
+        with raw:
+            yield conn
+    except BaseException:
+        raw.close()
+        raise
+    with _idle_lock:
+        idle = _idle.setdefault(pool_key, [])
+        if not raw.closed and len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(raw)
+            raw = None
+    if raw is not None:
+        raw.close()
+
+
+def _number(value, cursor):
+    if value is None:
+        return None
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+class PostgresConnection:
+    """The part of sqlite3.Connection the stores use, over a psycopg2 connection."""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def execute(self, sql, params=()):
+        cursor = self.raw.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        statement = sql.strip().upper()
+        if statement.startswith("PRAGMA"):
+            raise ValueError(f"PRAGMA is SQLite only: {sql}")
+        if statement == "BEGIN IMMEDIATE":
+            # psycopg2 has already opened the transaction; the lock is held until it ends
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (WRITE_LOCK_KEY,))
+            return cursor
+        cursor.execute(self._translate(sql), params)
+        return cursor
+
+    def executemany(self, sql, seq_of_params):
+        cursor = self.raw.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.executemany(self._translate(sql), list(seq_of_params))
+        return cursor
+
+    @staticmethod
+    def _translate(sql):
+        if sql.lstrip().upper().startswith("CREATE TABLE"):
+            for pattern, replacement in POSTGRES_TYPES:
+                sql = pattern.sub(replacement, sql)
+        return sql.replace("%", "%%").replace("?", "%s")
@@ -0,0 +1,92 @@
+"""
+Thumbnails and mid-size previews for stored images.
+
+Derivatives are rendered on a small background thread pool right after an image
+is stored, so the request that produced the image never waits for them. They
+are keyed by the blob hash, which makes them immutable and safe to cache forever.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from media import IMAGE_EXTENSIONS, PIL_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# Variant name -> longest edge in pixels
+DERIVATIVE_SIZES = {"thumb": 256, "preview": 768}
+
+
+def scaled_size(width, height, max_edge):
+    """Size of an image after fitting it into a max_edge square (never upscaled)."""
+    scale = min(1.0, max_edge / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class DerivativeGenerator:
+    def __init__(self, store, sizes=None, image_format="webp", quality=80, max_workers=2):
+        self.store = store
+        self.sizes = sizes or DERIVATIVE_SIZES
+        self.image_format = image_format
+        self.ext = IMAGE_EXTENSIONS[image_format]
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="derivatives")
+        self._lock = threading.Lock()
+        self.generated = 0
+        self.failed = 0
+
+    def schedule(self, record):
+        """Queues rendering of all variants for a stored image record; videos are ignored."""
+        if not record["content_type"].startswith("image/"):
+            return
+        self._executor.submit(self._generate, record["hash"], record["key"])
+
+    def _generate(self, digest, key):
+        try:
+            missing = [(variant, size) for variant, size in self.sizes.items()
+                       if self.store.get_derivative(digest, variant) is None]
+            if not missing:
+                return
+            with self.store.local_file(key) as path, Image.open(path) as source:
+                # Largest variant first, so each smaller one is resized from the previous result
+                missing.sort(key=lambda item: item[1], reverse=True)
+                largest = missing[0][1]
+                source.draft("RGB", (largest, largest))  # lets JPEG decode at reduced scale
+                image = source.convert("RGBA" if source.mode in ("RGBA", "LA", "P") else "RGB")
+            for variant, size in missing:
+                image.thumbnail((size, size), Image.LANCZOS)
+                output = image.convert("RGB") if self.image_format == "jpeg" else image
+                tmp_path = self.store.temp_path()
+                output.save(tmp_path, format=PIL_FORMATS[self.image_format], quality=self.quality)
+                self.store.put_derivative(digest, variant, tmp_path, self.ext, *image.size)
+            with self._lock:
+                self.generated += len(missing)
+        except Exception as e:
+            logger.error(f"Failed to render derivatives for {digest}: {e}")
+            with self._lock:
+                self.failed += 1
+
+    def srcset(self, record, variant_url):
+        """
+        Returns [(url, width), ...] for a record, smallest first and ending with the original.
+        Widths are computed from the original's dimensions, so this works before rendering finishes.
+        """
+        width, height = record["width"], record["height"]
+        if not width or not height:
+            return []
+        candidates = []
+        for variant, size in sorted(self.sizes.items(), key=lambda item: item[1]):
+            variant_width = scaled_size(width, height, size)[0]
+            if variant_width < width:
+                candidates.append((variant_url(record["name"], variant), variant_width))
+        candidates.append((variant_url(record["name"], None), width))
+        return candidates
+
+    def stats(self):
+        with self._lock:
+            return {"generated": self.generated, "failed": self.failed}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
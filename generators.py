@@ -0,0 +1,290 @@
+"""
+Registry of image generators with per-backend health tracking.
+
+Every generator keeps a circuit breaker, a rolling latency histogram and its
+cold-start state. A Hugging Face model that is still loading answers 503 with an
+estimated_time; the registry then either waits for it (asking the API to hold the
+request with x-wait-for-model) or, when the caller opted in, moves on to an
+equivalent generator that is warm. Slow calls can optionally be hedged: once a
+call outlives the generator's usual latency, an identical second call is started
+and whichever finishes first wins.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from scheduler import RateLimited
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, float("inf"))
+
+
+class ModelLoading(RateLimited):
+    """The backend is loading the model; retry_after is its estimated_time."""
+
+
+class GeneratorUnavailable(RateLimited):
+    """The generator's circuit breaker is open; retry_after is when it will be probed again."""
+
+
+class LatencyHistogram:
+    def __init__(self, window=300, buckets=LATENCY_BUCKETS, clock=time.monotonic):
+        """Counts latencies in fixed buckets over the last one to two windows (in seconds)."""
+        self.window = window
+        self.buckets = buckets
+        self.clock = clock
+        self._current = [0] * len(buckets)
+        self._previous = [0] * len(buckets)
+        self._window_start = clock()
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        elapsed = self.clock() - self._window_start
+        if elapsed >= self.window:
+            self._previous = self._current if elapsed < 2 * self.window else [0] * len(self.buckets)
+            self._current = [0] * len(self.buckets)
+            self._window_start = self.clock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._rotate()
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self._current[index] += 1
+                    break
+
+    def count(self):
+        with self._lock:
+            self._rotate()
+            return sum(self._current) + sum(self._previous)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of recent calls, or None without data."""
+        with self._lock:
+            self._rotate()
+            counts = [current + previous for current, previous in zip(self._current, self._previous)]
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= fraction * total:
+                return bound if bound != float("inf") else self.buckets[-2] * 2
+        return None
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        """Opens after failure_threshold consecutive failures; lets one probe through after reset_timeout."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if self.clock() - self.opened_at >= self.reset_timeout else "open"
+
+    def retry_after(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - self.clock())
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release_probe(self):
+        """Ends a probe that was neither a success nor a failure (the model was loading or rate limited)."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self._probing = False
+
+
+class Generator:
+    def __init__(self, name, call, fallbacks=(), hedge=False, max_images=1, breaker=None, latency=None,
+                 clock=time.monotonic):
+        """
+        call(prompt, seed, size, count, wait_for_model) returns the image output (bytes, or a list of
+        base64 strings for backends that return several images inline) or None, and may raise
+        ModelLoading or RateLimited. fallbacks name equivalent generators, in order of preference;
+        max_images is the largest count the backend accepts in one call.
+        """
+        self.name = name
+        self.call = call
+        self.fallbacks = tuple(fallbacks)
+        self.max_images = max_images
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.latency = latency or LatencyHistogram(clock=clock)
+        self.clock = clock
+        self.cold_until = 0.0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self.metrics = {"calls": 0, "successes": 0, "failures": 0, "cold_starts": 0, "hedged": 0,
+                        "hedge_wins": 0, "fallbacks_taken": 0}
+
+    def is_cold(self):
+        return self.clock() < self.cold_until
+
+    def count(self, metric, amount=1):
+        with self._lock:
+            self.metrics[metric] += amount
+
+    def stats(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+        percentiles = {f"p{round(fraction * 100)}": self.latency.percentile(fraction) for fraction in (0.5, 0.95, 0.99)}
+        return {**metrics, "state": self.breaker.state, "cold_for": round(max(0.0, self.cold_until - self.clock()), 1),
+                "last_error": self.last_error, "latency_samples": self.latency.count(), "latency": percentiles}
+
+
+class GeneratorRegistry:
+    def __init__(self, generators, max_wait_for_model=60, hedging=False, hedge_percentile=0.95,
+                 hedge_min_samples=20, hedge_workers=8):
+        self.generators = {generator.name: generator for generator in generators}
+        self.max_wait_for_model = max_wait_for_model
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge")
+
+    def names(self):
+        return tuple(self.generators)
+
+    def __contains__(self, name):
+        return name in self.generators
+
+    def generate(self, name, prompt, seed=None, size=None, allow_fallback=False, count=1):
+        """
+        Returns (image output or None, name of the generator that produced it). With allow_fallback,
+        a cold, failing or open-circuit generator is replaced by its first usable fallback that can
+        return count images.
+        """
+        primary = self.generators[name]
+        candidates = [primary]
+        if allow_fallback:
+            candidates += [self.generators[fallback] for fallback in primary.fallbacks
+                           if fallback in self.generators and self.generators[fallback].max_images >= count]
+
+        for position, generator in enumerate(candidates):
+            has_next = position + 1 < len(candidates)
+            if generator is not primary:
+                primary.count("fallbacks_taken")
+                logger.info(f"Falling back from {primary.name} to {generator.name}")
+            # Prefer a warm equivalent over waiting for a model that is known to be loading
+            if has_next and generator.is_cold():
+                continue
+            if not generator.breaker.allow():
+                if has_next:
+                    continue
+                raise GeneratorUnavailable(f"{generator.name} is temporarily unavailable",
+                                           generator.breaker.retry_after())
+            try:
+                output = self._call_hedged(generator, prompt, seed, size, count)
+            except ModelLoading as e:
+                if has_next:
+                    continue
+                if e.retry_after is not None and e.retry_after > self.max_wait_for_model:
+                    raise
+                logger.info(f"{generator.name} is loading, waiting for it (estimated {e.retry_after}s)")
+                output = self._call(generator, prompt, seed, size, count, wait_for_model=True)
+            if output or not has_next:
+                return output, generator.name
+        return None, name
+
+    def _call(self, generator, prompt, seed, size, count=1, wait_for_model=False):
+        generator.count("calls")
+        start = time.monotonic()
+        try:
+            output = generator.call(prompt, seed, size, count, wait_for_model)
+        except ModelLoading as e:
+            # Loading is not a fault of the backend, so the breaker is left alone
+            generator.cold_until = generator.clock() + (e.retry_after or 0)
+            generator.count("cold_starts")
+            generator.breaker.release_probe()
+            raise
+        except RateLimited:
+            generator.breaker.release_probe()
+            raise
+        except Exception as e:
+            generator.last_error = str(e)
+            generator.breaker.record_failure()
+            generator.count("failures")
+            raise
+        if not output:
+            generator.last_error = "Empty response"
+            generator.breaker.record_failure()
+            generator.count("failures")
+            return None
+        generator.cold_until = 0.0
+        generator.breaker.record_success()
+        generator.latency.observe(time.monotonic() - start)
+        generator.count("successes")
+        return output
+
+    def _call_hedged(self, generator, prompt, seed, size, count=1):
+        delay = None
+        if self.hedging and generator.hedge and generator.latency.count() >= self.hedge_min_samples:
+            delay = generator.latency.percentile(self.hedge_percentile)
+        if delay is None:
+            return self._call(generator, prompt, seed, size, count)
+
+        first = self._executor.submit(self._call, generator, prompt, seed, size, count)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        generator.count("hedged")
+        second = self._executor.submit(self._call, generator, prompt, seed, size, count)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    output = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if output:
+                    if future is second:
+                        generator.count("hedge_wins")
+                    # The losing call can't be cancelled mid-request; its result is simply dropped
+                    return output
+        if error is not None:
+            raise error
+        return None
+
+    def stats(self):
+        return {name: generator.stats() for name, generator in self.generators.items()}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
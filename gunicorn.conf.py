@@ -0,0 +1,72 @@
+"""
+Gunicorn settings for production. Requests mostly wait on the image backends, so each
+worker process runs a pool of threads; everything can be tuned from the environment.
+"""
+import os
+import shutil
+import signal
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# A few processes for isolation, each with enough threads to cover requests blocked on backends
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+
+# Generations can take minutes (cold models, fan-out, batches), and long-lived SSE streams keep the
+# worker busy, so the worker timeout is generous. On shutdown in-flight requests get graceful_timeout.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 120))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Clients, caches, pools and background threads are created per process when the app module is
+# imported, so every worker must import it itself rather than inherit it from the master
+preload_app = False
+
+# Restart workers now and then to bound memory growth; jitter keeps them from restarting together
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 50))
+
+# Workers write their metrics here so /metrics can report the totals of all of them. It has to be set
+# before a worker imports the app, and is emptied when the server starts so old workers don't linger.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(os.getenv("DATA_DIR", "data"), "metrics"))
+
+# Access lines go to stdout; an empty GUNICORN_ACCESS_LOG turns them off
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-") or None
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+def post_worker_init(worker):
+    """
+    Marks the worker as draining as soon as it gets SIGTERM, so /ready answers 503 while its
+    in-flight requests finish; worker_exit only runs once the serving loop has ended.
+    """
+    from app import draining
+
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def drain_and_exit(signum, frame):
+        draining.set()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_and_exit)
+
+
+def worker_exit(server, worker):
+    """Drains the worker's own pools after gunicorn has finished its in-flight requests."""
+    from app import shutdown_services
+
+    shutdown_services()
+
+
+def on_starting(server):
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that is gone; its counters and histograms still count."""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
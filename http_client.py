@@ -0,0 +1,117 @@
+"""
+Shared HTTP client for all outbound calls (auth backend, Hugging Face inference,
+output downloads). One requests.Session keeps a keep-alive connection pool per
+host, every call gets a connect/read timeout, idempotent requests are retried
+with exponential backoff and latency is recorded per host.
+"""
+import hashlib
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+class DownloadTooLarge(requests.RequestException):
+    """Raised when a download exceeds the allowed size."""
+
+
+class HostStats:
+    """Running latency/error counters for one host."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_ms": round(self.total_seconds / self.requests * 1000, 2) if self.requests else 0.0,
+            "max_ms": round(self.max_seconds * 1000, 2),
+        }
+
+
+class HttpClient:
+    def __init__(self, connect_timeout=5.0, read_timeout=120.0, retries=2, backoff_factor=0.5,
+                 pool_connections=10, pool_maxsize=32):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=IDEMPOTENT_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        # The session is shared by every user of the app, so never carry cookies between calls
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """Sends a request through the pooled session; raises requests.RequestException like requests does."""
+        host = urlsplit(url).netloc
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException:
+            self._record(host, time.perf_counter() - start, error=True)
+            raise
+        self._record(host, time.perf_counter() - start, error=response.status_code >= 500)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def download(self, url, path, chunk_size=256 * 1024, max_bytes=None, timeout=None):
+        """
+        Streams a GET response into the file at path in fixed-size chunks, so memory use does not
+        depend on the size of the body. Returns the SHA-256 hex digest of what was written.
+        """
+        digest = hashlib.sha256()
+        written = 0
+        with self.request("GET", url, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            declared = response.headers.get("Content-Length")
+            if max_bytes and declared and declared.isdigit() and int(declared) > max_bytes:
+                raise DownloadTooLarge(f"{url} is {declared} bytes, more than the {max_bytes} allowed")
+            with open(path, "wb") as output:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    written += len(chunk)
+                    if max_bytes and written > max_bytes:
+                        raise DownloadTooLarge(f"{url} is larger than the {max_bytes} bytes allowed")
+                    digest.update(chunk)
+                    output.write(chunk)
+        return digest.hexdigest()
+
+    def stats(self):
+        with self._lock:
+            return {host: host_stats.as_dict() for host, host_stats in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+
+    def _record(self, host, elapsed, error):
+        with self._lock:
+            host_stats = self._stats.get(host)
+            if host_stats is None:
+                host_stats = self._stats[host] = HostStats()
+            host_stats.requests += 1
+            host_stats.errors += int(error)
+            host_stats.total_seconds += elapsed
+            host_stats.max_seconds = max(host_stats.max_seconds, elapsed)
@@ -0,0 +1,322 @@
+"""
+Background jobs for long-running Replicate predictions (video generation, upscaling).
+
+A POST creates a job and returns immediately; a bounded thread pool runs the
+prediction and the download. Jobs are persisted (see db.py) so a restart (or a
+crashed worker process) doesn't lose them: every process heartbeats the jobs it
+owns and picks up unfinished jobs whose heartbeat has gone stale. A process that
+shuts down hands its queued jobs back and interrupts the ones waiting on a
+prediction, so another process resumes them from the recorded prediction at once.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from db import connect, ensure_parent_dir, is_database_url
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+TERMINAL_PREDICTION_STATUSES = ("succeeded", "failed", "canceled")
+
+
+class JobLimitExceeded(Exception):
+    """Raised when a user (or the whole pool) already has too many jobs in flight."""
+
+
+class JobFailed(Exception):
+    """Raised by a job handler to fail the job with a user-facing message."""
+
+
+class JobInterrupted(Exception):
+    """Raised inside a job when its process is shutting down; the job is handed back unfinished."""
+
+
+class JobStore:
+    """Persistence for jobs. A short-lived connection is used per call, so it is thread safe."""
+
+    def __init__(self, path):
+        self.path = path
+        ensure_parent_dir(path)
+        with self._connect() as conn:
+            if not is_database_url(path):
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    prediction_id TEXT,
+                    worker TEXT,
+                    heartbeat REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_owner_status ON jobs (owner, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_heartbeat ON jobs (status, heartbeat)")
+
+    def _connect(self):
+        return connect(self.path)
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        for key in ("payload", "progress", "result"):
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+    def create(self, owner, kind, payload, worker, max_per_user, max_active):
+        """Inserts a queued job, enforcing the per-user and global caps in the same transaction."""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        placeholders = ",".join("?" * len(ACTIVE_STATUSES))
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            user_active = conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE owner = ? AND status IN ({placeholders})",
+                (owner, *ACTIVE_STATUSES)).fetchone()[0]
+            if user_active >= max_per_user:
+                raise JobLimitExceeded(f"You already have {user_active} jobs in progress.")
+            total_active = conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status IN ({placeholders})", ACTIVE_STATUSES).fetchone()[0]
+            if total_active >= max_active:
+                raise JobLimitExceeded("The job queue is full, please try again later.")
+            conn.execute(
+                "INSERT INTO jobs (id, owner, kind, status, payload, worker, heartbeat, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, owner, kind, json.dumps(payload), worker, now, now, now))
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            return self._to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def update(self, job_id, **fields):
+        now = time.time()
+        fields["updated_at"] = now
+        fields["heartbeat"] = now
+        for key in ("progress", "result"):
+            if key in fields and fields[key] is not None:
+                fields[key] = json.dumps(fields[key])
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def heartbeat(self, job_ids, worker):
+        if not job_ids:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ?",
+                             [(now, job_id, worker) for job_id in job_ids])
+
+    def release(self, job_ids, worker):
+        """Hands unfinished jobs back, so the next claim_stale of any process takes them at once."""
+        if not job_ids:
+            return
+        with self._connect() as conn:
+            conn.executemany("UPDATE jobs SET heartbeat = 0 WHERE id = ? AND worker = ?",
+                             [(job_id, worker) for job_id in job_ids])
+
+    def claim_stale(self, worker, lease_seconds):
+        """Takes ownership of unfinished jobs whose worker stopped heartbeating; returns their ids."""
+        cutoff = time.time() - lease_seconds
+        placeholders = ",".join("?" * len(ACTIVE_STATUSES))
+        claimed = []
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id, heartbeat FROM jobs WHERE status IN ({placeholders}) AND heartbeat < ?",
+                (*ACTIVE_STATUSES, cutoff)).fetchall()
+            for row in rows:
+                cursor = conn.execute("UPDATE jobs SET worker = ?, heartbeat = ? WHERE id = ? AND heartbeat = ?",
+                                      (worker, time.time(), row["id"], row["heartbeat"]))
+                if cursor.rowcount:
+                    claimed.append(row["id"])
+        return claimed
+
+    def counts(self):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded thread pool. handlers maps a job kind to a callable
+    handler(job, report) that returns a JSON-serializable result dict; report(**fields)
+    persists progress (and e.g. the prediction id, so the job can be resumed).
+    """
+
+    def __init__(self, store, handlers, max_workers=4, max_per_user=2, max_active=100, lease_seconds=60):
+        self.store = store
+        self.handlers = handlers
+        self.max_per_user = max_per_user
+        self.max_active = max_active
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._local_jobs = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._maintenance = None
+
+    def start(self):
+        """Starts the heartbeat thread, which also resumes jobs left behind by a dead process."""
+        if self._maintenance is None:
+            self._maintenance = threading.Thread(target=self._maintain, name="job-maintenance", daemon=True)
+            self._maintenance.start()
+
+    def submit(self, kind, owner, payload):
+        job = self.store.create(owner, kind, payload, self.worker_id, self.max_per_user, self.max_active)
+        self._schedule(job["id"])
+        return job
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    @property
+    def stopping(self):
+        """Set by shutdown(); long waits inside handlers (see run_prediction) give up when it is."""
+        return self._stopping
+
+    def shutdown(self, wait=True):
+        """
+        Stops taking jobs: queued ones are handed back to other processes and running ones are
+        interrupted at their next prediction poll. Jobs past their prediction (downloading the
+        output) finish here, and are heartbeated until they do; call again with wait to wait for them.
+        """
+        with self._lock:
+            self._stopping.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            cancelled = [job_id for job_id, future in self._local_jobs.items() if future.cancelled()]
+            for job_id in cancelled:
+                del self._local_jobs[job_id]
+        self.store.release(cancelled, self.worker_id)
+        if cancelled:
+            logger.info(f"Handed back {len(cancelled)} queued jobs")
+        if wait:
+            self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            local = len(self._local_jobs)
+        return {"local": local, "by_status": self.store.counts()}
+
+    def _schedule(self, job_id):
+        with self._lock:
+            if self._stopping.is_set():
+                self.store.release([job_id], self.worker_id)
+                return
+            self._local_jobs[job_id] = self._executor.submit(self._run, job_id)
+
+    def _run(self, job_id):
+        try:
+            job = self.store.get(job_id)
+            if job is None or job["status"] not in ACTIVE_STATUSES:
+                return
+            handler = self.handlers.get(job["kind"])
+            if handler is None:
+                self.store.update(job_id, status="failed", error=f"Unknown job kind: {job['kind']}")
+                return
+            self.store.update(job_id, status="running", worker=self.worker_id)
+            job["status"] = "running"
+
+            def report(**fields):
+                self.store.update(job_id, **fields)
+                job.update(fields)
+
+            try:
+                result = handler(job, report)
+            except JobInterrupted:
+                logger.info(f"Job {job_id} interrupted by shutdown, handing it back")
+                self.store.release([job_id], self.worker_id)
+            except JobFailed as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                self.store.update(job_id, status="failed", error=str(e))
+            except Exception as e:
+                logger.exception(f"Unexpected error in job {job_id}: {e}")
+                self.store.update(job_id, status="failed", error="An unexpected error occurred")
+            else:
+                self.store.update(job_id, status="succeeded", result=result)
+        finally:
+            with self._lock:
+                self._local_jobs.pop(job_id, None)
+
+    def _maintain(self):
+        """Heartbeats this process's jobs and resumes stale ones; once stopping, only heartbeats until its jobs end."""
+        interval = max(self.lease_seconds / 3, 1)
+        last_beat = time.monotonic()
+        while True:
+            if not self._stopping.wait(interval):
+                try:
+                    with self._lock:
+                        local = list(self._local_jobs)
+                    self.store.heartbeat(local, self.worker_id)
+                    last_beat = time.monotonic()
+                    for job_id in self.store.claim_stale(self.worker_id, self.lease_seconds):
+                        logger.info(f"Resuming job {job_id}")
+                        self._schedule(job_id)
+                except Exception as e:
+                    logger.error(f"Job maintenance failed: {e}")
+                continue
+            with self._lock:
+                local = list(self._local_jobs)
+            if not local:
+                return
+            if time.monotonic() - last_beat >= interval:
+                try:
+                    self.store.heartbeat(local, self.worker_id)
+                except Exception as e:
+                    logger.error(f"Job maintenance failed: {e}")
+                last_beat = time.monotonic()
+            time.sleep(0.5)
+
+
+def run_prediction(client, job, report, create, poll_interval=1.0, stop=None):
+    """
+    Creates a Replicate prediction with create() (or re-attaches to the one recorded on the
+    job after a restart), polls it to completion while reporting progress, and returns it.
+    client is anything with a replicate-style `predictions` API, so a fake can be injected.
+    Raises JobInterrupted once the stop event is set; the prediction id is recorded by then,
+    so whoever resumes the job re-attaches to it instead of paying for a new one.
+    """
+    stop = stop or threading.Event()
+    if stop.is_set():
+        raise JobInterrupted()
+    prediction = None
+    if job.get("prediction_id"):
+        try:
+            prediction = client.predictions.get(job["prediction_id"])
+        except Exception as e:
+            logger.warning(f"Could not re-attach to prediction {job['prediction_id']}, recreating: {e}")
+    if prediction is None:
+        prediction = create()
+        report(prediction_id=prediction.id, progress={"status": prediction.status})
+
+    last_progress = None
+    while prediction.status not in TERMINAL_PREDICTION_STATUSES:
+        if stop.wait(poll_interval):
+            raise JobInterrupted()
+        prediction.reload()
+        progress = {"status": prediction.status}
+        parsed = getattr(prediction, "progress", None)
+        if parsed is not None:
+            progress.update(current=parsed.current, total=parsed.total, percentage=parsed.percentage)
+        if progress != last_progress:
+            report(progress=progress)
+            last_progress = progress
+    return prediction
@@ -0,0 +1,143 @@
+"""
+Helpers for persisting generated images without re-encoding them.
+
+Model backends already return a compressed image, so instead of decoding and
+re-saving it with PIL we sniff the container format from its header and check
+that it looks complete; the original bytes are then stored under the matching
+extension. Transcoding only happens when a target format is configured.
+"""
+import base64
+import hashlib
+import io
+import os
+
+from PIL import Image
+
+# (magic prefix, format) pairs, checked in order
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+IMAGE_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "gif": ".gif", "webp": ".webp"}
+
+# Format names accepted by PIL's Image.save for each of our formats
+PIL_FORMATS = {"png": "PNG", "jpeg": "JPEG", "gif": "GIF", "webp": "WEBP"}
+
+# Spellings of a format accepted in configuration, besides its own name
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+
+class InvalidImage(ValueError):
+    """Raised when a backend response is not a complete image in a supported format."""
+
+
+def parse_image_format(value, setting):
+    """Normalizes a configured image format ('PNG', 'jpg', ...); raises ValueError naming the setting if unknown."""
+    image_format = value.strip().lower()
+    image_format = FORMAT_ALIASES.get(image_format, image_format)
+    if image_format not in PIL_FORMATS:
+        raise ValueError(f"{setting} must be one of {', '.join(PIL_FORMATS)}, got {value!r}")
+    return image_format
+
+
+def sniff_image_format(data):
+    """Returns 'png', 'jpeg', 'gif' or 'webp' based on the header bytes, or None."""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    for signature, image_format in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    return None
+
+
+def check_image_bytes(head, tail):
+    """
+    Returns the format of an image from its first and last bytes, raising InvalidImage if it is
+    unsupported or visibly truncated (a cut-off download usually loses the trailer).
+    """
+    image_format = sniff_image_format(head)
+    if image_format is None:
+        raise InvalidImage("Unrecognized image format")
+    if image_format == "png" and b"IEND" not in tail[-16:]:
+        raise InvalidImage("Truncated PNG data")
+    if image_format == "jpeg" and not tail.rstrip(b"\x00").endswith(b"\xff\xd9"):
+        raise InvalidImage("Truncated JPEG data")
+    return image_format
+
+
+def read_image_size(source):
+    """(width, height) from an image path or file object; PIL opens lazily, so only the header is read."""
+    try:
+        with Image.open(source) as image:
+            return image.size
+    except Exception as e:
+        raise InvalidImage(f"Unreadable image header: {e}")
+
+
+def inspect_image(data):
+    """
+    Cheaply validates image bytes and returns (format, width, height).
+    Only the header is parsed (PIL opens images lazily); the pixel data is never decoded.
+    """
+    image_format = check_image_bytes(data[:32], data[-64:])
+    width, height = read_image_size(io.BytesIO(data))
+    return image_format, width, height
+
+
+def inspect_image_file(path):
+    """Same as inspect_image for an image on disk, reading only its first and last bytes."""
+    with open(path, "rb") as image_file:
+        head = image_file.read(32)
+        image_file.seek(max(0, os.path.getsize(path) - 64))
+        tail = image_file.read()
+    image_format = check_image_bytes(head, tail)
+    width, height = read_image_size(path)
+    return image_format, width, height
+
+
+def transcode_image(data, target_format):
+    """Re-encodes image bytes into target_format; only used when a target format is configured."""
+    with Image.open(io.BytesIO(data)) as image:
+        if target_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format=PIL_FORMATS[target_format])
+        return output.getvalue()
+
+
+def transcode_image_file(source_path, target_path, target_format):
+    """File-to-file version of transcode_image."""
+    with Image.open(source_path) as image:
+        if target_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(target_path, format=PIL_FORMATS[target_format])
+
+
+def decode_base64_to_file(encoded, path, chunk_size=1024 * 1024):
+    """
+    Decodes a base64 string (e.g. an inline API payload) into a file a chunk at a time, so the
+    decoded image is never held in memory in full. Returns the SHA-256 hex digest of the output.
+    """
+    chunk_size -= chunk_size % 4  # base64 decodes in 4-character groups
+    digest = hashlib.sha256()
+    with open(path, "wb") as output:
+        for start in range(0, len(encoded), chunk_size):
+            chunk = base64.b64decode(encoded[start:start + chunk_size])
+            digest.update(chunk)
+            output.write(chunk)
+    return digest.hexdigest()
+
+
+def prepare_image(data, target_format=None):
+    """
+    Validates image bytes and returns (data, format, width, height), where data is the
+    original bytes unless target_format names a different format.
+    """
+    image_format, width, height = inspect_image(data)
+    if target_format and target_format != image_format:
+        data = transcode_image(data, target_format)
+        image_format = target_format
+    return data, image_format, width, height
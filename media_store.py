@@ -0,0 +1,453 @@
+"""
+Content-addressed store for generated media.
+
+Blobs are stored once per SHA-256 under sharded directories
+(<root>/ab/cd/<hash><ext>) and reference counted. Every image or video handed to
+a user gets its own public name (e.g. flux_image_<uuid>.png) recorded in an
+index (a SQLite file, or Postgres shared by every host; see db.py) together with
+its owner, generator, prompt, size, dimensions and creation time; names resolve
+to blobs only through that index. Derivatives
+(thumbnails, previews) hang off a blob and are deleted with it. The bytes live in
+a storage backend (see storage.py): on local disk by default, or in a bucket.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from db import connect, ensure_parent_dir, is_database_url
+from storage import LocalStorage
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".mp4": "video/mp4",
+}
+
+# Seconds after which an upload that never finished (its process died) no longer holds deletes back
+UPLOAD_TIMEOUT = 6 * 3600
+
+
+class MediaStore:
+    def __init__(self, root, index_path, storage=None):
+        """
+        root is the local working directory for temp files; it also holds the blobs unless
+        another storage backend is given.
+        """
+        self.root = root
+        self.index_path = index_path
+        self.storage = storage or LocalStorage(root)
+        os.makedirs(root, exist_ok=True)
+        ensure_parent_dir(index_path)
+        with connect(index_path) as conn:
+            if not is_database_url(index_path):
+                conn.execute("PRAGMA journal_mode=WAL")
+            # Hosts starting together would otherwise race to create the tables in a shared database
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    refcount INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS media (
+                    name TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL REFERENCES blobs (hash),
+                    owner TEXT,
+                    generator TEXT,
+                    prompt TEXT,
+                    created_at REAL NOT NULL,
+                    last_accessed REAL,
+                    session_key TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS derivatives (
+                    hash TEXT NOT NULL,
+                    variant TEXT NOT NULL,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    PRIMARY KEY (hash, variant)
+                )
+            """)
+            # Objects released from the index but not yet deleted from storage, and uploads in
+            # progress, whose keys must not be deleted until they are indexed (or given up)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending_deletes (
+                    key TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    id INTEGER PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS uploads_key ON uploads (key)")
+            # Index databases created before access tracking existed (always SQLite files)
+            if not is_database_url(index_path):
+                columns = {row["name"] for row in conn.execute("PRAGMA table_info(media)")}
+                for column, column_type in (("last_accessed", "REAL"), ("session_key", "TEXT")):
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE media ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS media_owner ON media (owner)")
+            conn.execute("CREATE INDEX IF NOT EXISTS media_hash ON media (hash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS media_lru ON media ((COALESCE(last_accessed, created_at)))")
+            conn.execute("CREATE INDEX IF NOT EXISTS media_created ON media (created_at, name)")
+        self._touched = {}
+        self._touch_lock = threading.Lock()
+
+    def blob_key(self, digest, ext):
+        return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+    def derivative_key(self, digest, variant, ext):
+        return f"derivatives/{digest[:2]}/{digest}-{variant}{ext}"
+
+    def local_file(self, key):
+        """Context manager yielding a local path with the bytes of a blob or derivative key."""
+        return self.storage.local_file(key)
+
+    def url(self, item, download_name=None, as_attachment=False):
+        """Direct URL for a record or derivative when the storage backend serves it itself, else None."""
+        return self.storage.url(item["key"], item["content_type"], download_name, as_attachment)
+
+    def temp_path(self):
+        """Returns a fresh temp file path inside the store, so it can be renamed into place."""
+        fd, path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        os.close(fd)
+        return path
+
+    def put_bytes(self, data, ext, **metadata):
+        """Stores bytes (deduplicated) and returns the index record of a new media name."""
+        tmp_path = self.temp_path()
+        try:
+            with open(tmp_path, "wb") as tmp_file:
+                tmp_file.write(data)
+            return self.put_file(tmp_path, ext, digest=hashlib.sha256(data).hexdigest(), **metadata)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put_file(self, tmp_path, ext, digest=None, name_prefix="media", owner=None, generator=None,
+                 prompt=None, width=None, height=None, session_key=None):
+        """
+        Moves a finished temp file into the store and returns the index record of a new media
+        name pointing at it. If the content is already stored, the temp file is discarded and
+        the existing blob gains a reference.
+        """
+        if digest is None:
+            digest = file_sha256(tmp_path)
+        size = os.path.getsize(tmp_path)
+        key = self.blob_key(digest, ext)
+        name = f"{name_prefix}_{uuid.uuid4().hex}{ext}"
+        now = time.time()
+        uploaded = False
+        upload_id = self._start_upload(key)
+        try:
+            while True:
+                # Uploaded before taking the index's write lock, so a slow transfer doesn't block other
+                # writers; keys are content addressed, so storing bytes that are already there is harmless
+                if not uploaded and not self.has_blob(digest):
+                    self.storage.put_file(tmp_path, key, CONTENT_TYPES.get(ext))
+                    uploaded = True
+                with connect(self.index_path) as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    existing = conn.execute("SELECT hash FROM blobs WHERE hash = ?", (digest,)).fetchone()
+                    if existing is None and not uploaded:
+                        # Released since the check above, so its bytes have to be stored after all
+                        continue
+                    if existing is None:
+                        conn.execute(
+                            "INSERT INTO blobs (hash, ext, size, width, height, refcount, created_at) "
+                            "VALUES (?, ?, ?, ?, ?, 1, ?)",
+                            (digest, ext, size, width, height, now))
+                    else:
+                        conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?", (digest,))
+                    conn.execute(
+                        "INSERT INTO media (name, hash, owner, generator, prompt, created_at, session_key) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (name, digest, owner, generator, prompt, now, session_key))
+                    # Indexed again, so a delete left pending by an earlier release is called off
+                    conn.execute("DELETE FROM pending_deletes WHERE key = ?", (key,))
+                    conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+                break
+        except BaseException:
+            self._end_upload(upload_id)
+            raise
+        if not uploaded:
+            os.remove(tmp_path)
+        return self.resolve(name)
+
+    def _start_upload(self, key):
+        """
+        Registers an upload of key that is about to start. Until it ends, pending deletes of the
+        key are held back, so a release racing the upload can't delete the bytes it just stored.
+        """
+        with connect(self.index_path) as conn:
+            return conn.execute("INSERT INTO uploads (key, created_at) VALUES (?, ?) RETURNING id",
+                                (key, time.time())).fetchone()[0]
+
+    def _end_upload(self, upload_id):
+        with connect(self.index_path) as conn:
+            conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+
+    def add_reference(self, name, name_prefix="media", owner=None, generator=None, prompt=None, session_key=None):
+        """Creates a new media name for the blob behind an existing one, without copying bytes."""
+        record = self.resolve(name)
+        if record is None:
+            return None
+        new_name = f"{name_prefix}_{uuid.uuid4().hex}{record['ext']}"
+        with connect(self.index_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            updated = conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?", (record["hash"],))
+            if not updated.rowcount:
+                return None
+            conn.execute(
+                "INSERT INTO media (name, hash, owner, generator, prompt, created_at, session_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (new_name, record["hash"], owner, generator, prompt, time.time(), session_key))
+        return self.resolve(new_name)
+
+    def resolve(self, name):
+        """Returns the index record for a media name (including its blob's storage key), or None."""
+        with connect(self.index_path) as conn:
+            row = conn.execute("""
+                SELECT media.name, media.owner, media.generator, media.prompt, media.created_at,
+                       media.session_key, blobs.hash, blobs.ext, blobs.size, blobs.width, blobs.height
+                FROM media JOIN blobs ON blobs.hash = media.hash
+                WHERE media.name = ?
+            """, (name,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record["key"] = self.blob_key(record["hash"], record["ext"])
+        record["content_type"] = CONTENT_TYPES.get(record["ext"], "application/octet-stream")
+        return record
+
+    def put_derivative(self, digest, variant, tmp_path, ext, width, height):
+        """Stores a rendered derivative; it is dropped if the blob was released meanwhile."""
+        key = self.derivative_key(digest, variant, ext)
+        upload_id = self._start_upload(key)
+        try:
+            if not self.has_blob(digest):
+                os.remove(tmp_path)
+                self._end_upload(upload_id)
+                return None
+            size = os.path.getsize(tmp_path)
+            self.storage.put_file(tmp_path, key, CONTENT_TYPES.get(ext))
+            with connect(self.index_path) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                stored = conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone() is not None
+                if stored:
+                    conn.execute(
+                        "INSERT INTO derivatives (hash, variant, ext, size, width, height) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (hash, variant) DO UPDATE SET ext = excluded.ext, size = excluded.size, "
+                        "width = excluded.width, height = excluded.height",
+                        (digest, variant, ext, size, width, height))
+                    conn.execute("DELETE FROM pending_deletes WHERE key = ?", (key,))
+                else:
+                    conn.execute("INSERT INTO pending_deletes (key, created_at) VALUES (?, ?) "
+                                 "ON CONFLICT (key) DO UPDATE SET created_at = excluded.created_at",
+                                 (key, time.time()))
+                conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        except BaseException:
+            self._end_upload(upload_id)
+            raise
+        if not stored:
+            self.purge_pending_deletes([key])
+            return None
+        return self.get_derivative(digest, variant)
+
+    def get_derivative(self, digest, variant):
+        with connect(self.index_path) as conn:
+            row = conn.execute("SELECT * FROM derivatives WHERE hash = ? AND variant = ?", (digest, variant)).fetchone()
+        if row is None:
+            return None
+        derivative = dict(row)
+        derivative["key"] = self.derivative_key(digest, variant, derivative["ext"])
+        derivative["content_type"] = CONTENT_TYPES.get(derivative["ext"], "application/octet-stream")
+        return derivative
+
+    def release(self, name):
+        """Removes a media name; the blob is deleted once no name references it. Returns bytes freed."""
+        freed = 0
+        keys = []
+        with connect(self.index_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT blobs.hash, blobs.ext, blobs.size, blobs.refcount FROM media "
+                "JOIN blobs ON blobs.hash = media.hash WHERE media.name = ?", (name,)).fetchone()
+            if row is None:
+                return 0
+            conn.execute("DELETE FROM media WHERE name = ?", (name,))
+            if row["refcount"] <= 1:
+                conn.execute("DELETE FROM blobs WHERE hash = ?", (row["hash"],))
+                keys.append(self.blob_key(row["hash"], row["ext"]))
+                freed = row["size"]
+                for derivative in conn.execute("SELECT variant, ext, size FROM derivatives WHERE hash = ?",
+                                               (row["hash"],)).fetchall():
+                    keys.append(self.derivative_key(row["hash"], derivative["variant"], derivative["ext"]))
+                    freed += derivative["size"]
+                conn.execute("DELETE FROM derivatives WHERE hash = ?", (row["hash"],))
+                conn.executemany("INSERT INTO pending_deletes (key, created_at) VALUES (?, ?) "
+                                 "ON CONFLICT (key) DO UPDATE SET created_at = excluded.created_at",
+                                 [(key, time.time()) for key in keys])
+            else:
+                conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (row["hash"],))
+        self.purge_pending_deletes(keys)
+        return freed
+
+    def purge_pending_deletes(self, keys=None, limit=500):
+        """
+        Deletes released objects from storage: the given keys, or the oldest pending ones (e.g. left
+        by a failed delete). Each key is re-checked under the write lock and deleted while holding it,
+        so a key indexed again, or being uploaded, meanwhile is kept. Returns the number deleted.
+        """
+        if keys is None:
+            with connect(self.index_path) as conn:
+                # Uploads of a process that died never end; they stop holding deletes back after a while
+                conn.execute("DELETE FROM uploads WHERE created_at < ?", (time.time() - UPLOAD_TIMEOUT,))
+                keys = [row["key"] for row in conn.execute(
+                    "SELECT key FROM pending_deletes ORDER BY created_at LIMIT ?", (limit,))]
+        deleted = 0
+        for key in keys:
+            try:
+                with connect(self.index_path) as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    pending = conn.execute("SELECT 1 FROM pending_deletes WHERE key = ?", (key,)).fetchone()
+                    uploading = conn.execute("SELECT 1 FROM uploads WHERE key = ? AND created_at >= ?",
+                                             (key, time.time() - UPLOAD_TIMEOUT)).fetchone()
+                    if pending is None or uploading is not None:
+                        continue
+                    self.storage.delete(key)
+                    conn.execute("DELETE FROM pending_deletes WHERE key = ?", (key,))
+                deleted += 1
+            except Exception as e:
+                logger.warning(f"Failed to delete {key}, it stays pending: {e}")
+        return deleted
+
+    def delete_stray(self, key, digest, variant=None):
+        """
+        Deletes an object the index doesn't reference (a crashed write, say), checked under the write
+        lock like purge_pending_deletes. variant names a derivative of digest. Returns whether it was deleted.
+        """
+        with connect(self.index_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if variant:
+                indexed = conn.execute("SELECT 1 FROM derivatives WHERE hash = ? AND variant = ?",
+                                       (digest, variant)).fetchone()
+            else:
+                indexed = conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone()
+            uploading = conn.execute("SELECT 1 FROM uploads WHERE key = ? AND created_at >= ?",
+                                     (key, time.time() - UPLOAD_TIMEOUT)).fetchone()
+            if indexed is not None or uploading is not None:
+                return False
+            self.storage.delete(key)
+            conn.execute("DELETE FROM pending_deletes WHERE key = ?", (key,))
+        return True
+
+    def touch(self, name):
+        """Records an access for LRU eviction; buffered in memory and written by flush_touches()."""
+        with self._touch_lock:
+            self._touched[name] = time.time()
+
+    def flush_touches(self):
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            with connect(self.index_path) as conn:
+                conn.executemany("UPDATE media SET last_accessed = ? WHERE name = ?",
+                                 [(accessed, name) for name, accessed in touched.items()])
+
+    def lru_candidates(self, limit, owner=None, accessed_before=None):
+        """Least recently used media names (with blob size and refcount), oldest first."""
+        clauses, params = [], []
+        if owner is not None:
+            clauses.append("media.owner = ?")
+            params.append(owner)
+        if accessed_before is not None:
+            clauses.append("COALESCE(media.last_accessed, media.created_at) < ?")
+            params.append(accessed_before)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with connect(self.index_path) as conn:
+            rows = conn.execute(f"""
+                SELECT media.name, media.owner, blobs.size, blobs.refcount
+                FROM media JOIN blobs ON blobs.hash = media.hash
+                {where}
+                ORDER BY COALESCE(media.last_accessed, media.created_at)
+                LIMIT ?
+            """, (*params, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def owners_over_quota(self, quota_bytes):
+        """[(owner, bytes)] for owners whose media (counting shared blobs per name) exceeds the quota."""
+        with connect(self.index_path) as conn:
+            return [tuple(row) for row in conn.execute("""
+                SELECT media.owner, SUM(blobs.size) AS used
+                FROM media JOIN blobs ON blobs.hash = media.hash
+                WHERE media.owner IS NOT NULL
+                GROUP BY media.owner HAVING SUM(blobs.size) > ?
+            """, (quota_bytes,))]
+
+    def total_bytes(self):
+        with connect(self.index_path) as conn:
+            return conn.execute(
+                "SELECT (SELECT COALESCE(SUM(size), 0) FROM blobs) + (SELECT COALESCE(SUM(size), 0) FROM derivatives)"
+            ).fetchone()[0]
+
+    def session_names(self, after, limit):
+        """
+        Pages through names created from a session, for checking them against live sessions. after
+        is the (created_at, name) of the last row of the previous page, or None to start over.
+        """
+        clause, params = "", []
+        if after is not None:
+            clause = "AND (created_at > ? OR (created_at = ? AND name > ?))"
+            params = [after[0], after[0], after[1]]
+        with connect(self.index_path) as conn:
+            return [dict(row) for row in conn.execute(
+                f"SELECT name, session_key, created_at FROM media WHERE session_key IS NOT NULL {clause} "
+                "ORDER BY created_at, name LIMIT ?", (*params, limit))]
+
+    def has_blob(self, digest):
+        with connect(self.index_path) as conn:
+            return conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone() is not None
+
+    def has_derivative(self, digest, variant):
+        with connect(self.index_path) as conn:
+            return conn.execute("SELECT 1 FROM derivatives WHERE hash = ? AND variant = ?",
+                                (digest, variant)).fetchone() is not None
+
+    def stats(self):
+        with connect(self.index_path) as conn:
+            blobs, stored_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            names = conn.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+            derivatives, derivative_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM derivatives").fetchone()
+        return {"blobs": blobs, "names": names, "bytes": stored_bytes,
+                "derivatives": derivatives, "derivative_bytes": derivative_bytes}
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,70 @@
+"""
+Prometheus metrics for the request hot path.
+
+Recording a sample is an in-memory update (or an mmap write in multi-process
+mode), so the cost does not depend on whether anyone scrapes /metrics; the
+text exposition is only built when it is requested. Under gunicorn every worker
+writes its samples to PROMETHEUS_MULTIPROC_DIR and a scrape of any worker
+returns the totals of all of them.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Upper bounds (seconds); generations run from under a second (cache hits) to minutes (cold models)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    "imagegen_request_duration_seconds", "Time to produce a response, by endpoint",
+    ["endpoint", "method", "status"], buckets=REQUEST_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge(
+    "imagegen_requests_in_flight", "Requests being handled", ["endpoint"], multiprocess_mode="livesum")
+STAGE_LATENCY = Histogram(
+    "imagegen_request_stage_seconds", "Time spent in one stage of request handling",
+    ["stage"], buckets=STAGE_BUCKETS)
+GENERATION_LATENCY = Histogram(
+    "imagegen_generation_stage_seconds", "Time spent generating and storing images, by generator and stage",
+    ["generator", "stage"], buckets=STAGE_BUCKETS + (300,))
+GENERATIONS_IN_FLIGHT = Gauge(
+    "imagegen_generations_in_flight", "Backend generation calls in progress", ["generator"],
+    multiprocess_mode="livesum")
+GENERATIONS = Counter(
+    "imagegen_generations_total", "Finished generation requests, by generator and outcome", ["generator", "outcome"])
+BACKEND_ERRORS = Counter(
+    "imagegen_backend_errors_total", "Failed backend calls, by backend and HTTP status (or error type)",
+    ["backend", "status"])
+
+
+@contextmanager
+def timed_stage(stage):
+    """Records how long the block took under imagegen_request_stage_seconds{stage}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+
+def observe_generation(generator, timings):
+    """Records a generation's timings dict (api_ms, decode_ms, write_ms) per stage; stages that didn't run are 0."""
+    for phase, ms in timings.items():
+        if ms:
+            GENERATION_LATENCY.labels(generator, phase[:-len("_ms")]).observe(ms / 1000)
+
+
+def count_backend_error(backend, status):
+    BACKEND_ERRORS.labels(backend, str(status)).inc()
+
+
+def render():
+    """Returns (body, content type) of the Prometheus text exposition for this process or all workers."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
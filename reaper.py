@@ -0,0 +1,195 @@
+"""
+Background garbage collector for the media store.
+
+Each pass works from the index rather than the filesystem: it expires
+media past a maximum age, evicts least-recently-used media from owners over
+their quota and then globally until the store fits the total quota, and
+releases media whose originating session no longer exists. Deletes that failed
+after a release stay pending in the index and are retried. Stray files (crashed
+writes, blobs without an index row) are found by listing a single shard of the
+storage backend per pass, so a store with hundreds of thousands of files is
+never listed in one go.
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SHARDS = [f"{i:02x}" for i in range(256)]
+
+
+class MediaReaper:
+    def __init__(self, store, session_exists, total_quota_bytes=0, user_quota_bytes=0, max_age_seconds=0,
+                 orphan_grace_seconds=3600, batch_size=500, interval=300, dry_run=False):
+        """
+        session_exists(session_key) tells whether a session is still live. Quotas and the
+        max age are disabled when set to 0.
+        """
+        self.store = store
+        self.session_exists = session_exists
+        self.total_quota_bytes = total_quota_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.max_age_seconds = max_age_seconds
+        self.orphan_grace_seconds = orphan_grace_seconds
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dry_run = dry_run
+        self._session_cursor = None
+        self._shard_cursor = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.metrics = {
+            "passes": 0,
+            "names_released": 0,
+            "bytes_reclaimed": 0,
+            "bytes_would_reclaim": 0,
+            "stray_files_removed": 0,
+            "last_pass_seconds": 0.0,
+            "last_pass_at": None,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="media-reaper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def stats(self):
+        with self._lock:
+            return {**self.metrics, "dry_run": self.dry_run}
+
+    def _loop(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Media reaper pass failed: {e}")
+
+    def run_once(self):
+        """Runs one collection pass and returns the bytes it reclaimed (or would reclaim in dry-run mode)."""
+        start = time.monotonic()
+        self.store.flush_touches()
+        reclaimed = 0
+        if self.max_age_seconds:
+            reclaimed += self._evict(self.store.lru_candidates(
+                self.batch_size, accessed_before=time.time() - self.max_age_seconds), "expired")
+        if self.user_quota_bytes:
+            for owner, used in self.store.owners_over_quota(self.user_quota_bytes):
+                reclaimed += self._evict_down_to(used - self.user_quota_bytes, owner=owner)
+        if self.total_quota_bytes:
+            used = self.store.total_bytes()
+            if used > self.total_quota_bytes:
+                reclaimed += self._evict_down_to(used - self.total_quota_bytes)
+        reclaimed += self._release_orphans()
+        if not self.dry_run:
+            purged = self.store.purge_pending_deletes(limit=self.batch_size)
+            if purged:
+                logger.info(f"Media reaper deleted {purged} objects left pending by earlier releases")
+        self._scan_next_shard()
+        with self._lock:
+            self.metrics["passes"] += 1
+            self.metrics["last_pass_seconds"] = round(time.monotonic() - start, 3)
+            self.metrics["last_pass_at"] = time.time()
+        return reclaimed
+
+    def _evict_down_to(self, excess_bytes, owner=None):
+        """Evicts LRU names until roughly excess_bytes have been freed (for an owner, or globally)."""
+        candidates = self.store.lru_candidates(self.batch_size, owner=owner)
+        selected, total = [], 0
+        for candidate in candidates:
+            if total >= excess_bytes:
+                break
+            selected.append(candidate)
+            # An owner's quota counts every name, but the disk only frees the last reference
+            total += candidate["size"] if owner is not None or candidate["refcount"] <= 1 else 0
+        return self._evict(selected, f"over quota ({owner or 'total'})")
+
+    def _release_orphans(self):
+        """Releases names whose session is gone, checking one batch of the index per pass."""
+        rows = self.store.session_names(self._session_cursor, self.batch_size)
+        if not rows:
+            self._session_cursor = None
+            return 0
+        self._session_cursor = (rows[-1]["created_at"], rows[-1]["name"])
+        cutoff = time.time() - self.orphan_grace_seconds
+        live = {}
+        orphans = []
+        for row in rows:
+            if row["created_at"] >= cutoff:
+                continue
+            key = row["session_key"]
+            if key not in live:
+                live[key] = self.session_exists(key)
+            if not live[key]:
+                orphans.append(row)
+        return self._evict(orphans, "orphaned")
+
+    def _evict(self, candidates, reason):
+        reclaimed = 0
+        released = 0
+        for candidate in candidates:
+            if self.dry_run:
+                reclaimed += candidate.get("size", 0) if candidate.get("refcount", 1) <= 1 else 0
+                logger.info(f"[dry-run] Would release {candidate['name']} ({reason})")
+            else:
+                reclaimed += self.store.release(candidate["name"])
+            released += 1
+        if released:
+            logger.info(f"Media reaper {'would release' if self.dry_run else 'released'} {released} "
+                        f"{reason} names, {reclaimed} bytes")
+            with self._lock:
+                if self.dry_run:
+                    self.metrics["bytes_would_reclaim"] += reclaimed
+                else:
+                    self.metrics["names_released"] += released
+                    self.metrics["bytes_reclaimed"] += reclaimed
+        return reclaimed
+
+    def _scan_next_shard(self):
+        """Removes stray files in one blob shard, one derivative shard and stale temp files."""
+        shard = SHARDS[self._shard_cursor]
+        self._shard_cursor = (self._shard_cursor + 1) % len(SHARDS)
+        cutoff = time.time() - self.orphan_grace_seconds
+        # (remove function returning whether it removed anything, its argument, description)
+        stray = []
+
+        for key, modified in self.store.storage.list(f"{shard}/"):
+            digest = key.rsplit("/", 1)[-1].split(".", 1)[0]
+            if modified < cutoff and not self.store.has_blob(digest):
+                stray.append((self._delete_stray_object, (key, digest, None), key))
+        for key, modified in self.store.storage.list(f"derivatives/{shard}/"):
+            digest, _, variant = key.rsplit("/", 1)[-1].split(".", 1)[0].partition("-")
+            if modified < cutoff and not self.store.has_derivative(digest, variant):
+                stray.append((self._delete_stray_object, (key, digest, variant), key))
+
+        # Temp files are only ever created at the top of the store's local directory
+        if self._shard_cursor == 0:
+            for entry in os.scandir(self.store.root):
+                if entry.name.startswith(".tmp-") and entry.stat().st_mtime < cutoff:
+                    stray.append((_remove_temp_file, entry.path, entry.path))
+
+        for remove, argument, description in stray:
+            if self.dry_run:
+                logger.info(f"[dry-run] Would remove stray file {description}")
+                continue
+            try:
+                if not remove(argument):
+                    continue
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self.metrics["stray_files_removed"] += 1
+
+    def _delete_stray_object(self, item):
+        key, digest, variant = item
+        return self.store.delete_stray(key, digest, variant)
+
+
+def _remove_temp_file(path):
+    os.remove(path)
+    return True
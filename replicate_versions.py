@@ -0,0 +1,86 @@
+"""
+Lazy, cached resolution of Replicate model versions.
+
+Version handles are fetched the first time a job needs them, memoized for the
+life of the process and persisted to a small JSON file with a TTL, so restarted
+workers don't repeat the lookups. Nothing is fetched at import time. If Replicate
+can't be reached, a stale cached entry is used, and without one the pinned
+version id itself is returned (predictions.create accepts either).
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from replicate.version import Version
+
+from db import ensure_parent_dir
+
+logger = logging.getLogger(__name__)
+
+
+class VersionCache:
+    def __init__(self, client, path, ttl=24 * 3600, clock=time.time):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._memo = {}
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.fetch_errors = 0
+        ensure_parent_dir(path)
+
+    def get(self, model_name, version_id):
+        """Returns the Version for a pinned model version, or version_id if it can't be resolved right now."""
+        key = f"{model_name}:{version_id}"
+        # One lock for all keys: there are only a handful of versions and each is fetched rarely
+        with self._lock:
+            entry = self._memo.get(key) or self._read_entry(key)
+            if entry is not None and self.clock() - entry["fetched_at"] < self.ttl:
+                self._memo[key] = entry
+                return Version(**entry["version"])
+            try:
+                version = self.client.models.get(model_name).versions.get(version_id)
+            except Exception as e:
+                self.fetch_errors += 1
+                if entry is not None:
+                    logger.warning(f"Could not refresh {key} ({e}); using the cached version")
+                    return Version(**entry["version"])
+                logger.warning(f"Could not resolve {key} ({e}); using the pinned version id")
+                return version_id
+            self.fetches += 1
+            entry = {"fetched_at": self.clock(), "version": version.dict()}
+            self._memo[key] = entry
+            self._write_entry(key, entry)
+            return version
+
+    def _read_entries(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _read_entry(self, key):
+        return self._read_entries().get(key)
+
+    def _write_entry(self, key, entry):
+        entries = self._read_entries()
+        entries[key] = entry
+        # Write to a temp file and rename, so concurrent workers never read a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(entries, tmp_file, default=str)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not persist the Replicate version cache: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def stats(self):
+        with self._lock:
+            return {"memoized": len(self._memo), "fetches": self.fetches, "fetch_errors": self.fetch_errors}
@@ -0,0 +1,144 @@
+"""
+Cache of generated images for deterministic requests.
+
+A request that carries an explicit seed is keyed by (generator, normalized
+prompt, seed, size) plus the backend settings that change its output. The first result is pinned in the media store under a
+cache-owned name, and later identical requests get a new name for the same blob
+instead of a paid backend call. Pinned bytes are kept under a budget by evicting
+the least recently used entries.
+"""
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from db import connect, ensure_parent_dir, is_database_url
+
+
+def normalize_prompt(prompt):
+    """Collapses whitespace so trivially different spellings of a prompt share a cache entry."""
+    return " ".join(prompt.split())
+
+
+def cache_key(generator, prompt, seed, size, options=None):
+    """
+    Keyed by the prompt exactly as it is sent to the backend, which treats case as significant.
+    options holds the backend settings that change the image (e.g. the OpenAI model and quality),
+    so a result made under other settings is not served.
+    """
+    # "v2" retires keys from casefolded prompts, which would otherwise hit for a differently cased prompt
+    payload = ["v2", generator, normalize_prompt(prompt), seed, size]
+    if options:
+        payload.append(options)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, store, path, max_bytes, name_prefix="cached"):
+        """Entries are pinned as media names with no owner, so per-user quotas never count them."""
+        self.store = store
+        self.path = path
+        self.max_bytes = max_bytes
+        self.name_prefix = name_prefix
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        ensure_parent_dir(path)
+        with connect(path) as conn:
+            if not is_database_url(path):
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    media_name TEXT NOT NULL,
+                    generator TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    @contextmanager
+    def lock(self, key):
+        """
+        Serializes work on one key inside this process, so concurrent identical requests
+        make a single backend call and the rest are served from the cache.
+        """
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def get(self, key):
+        """Returns the pinned media name for a key, or None (counted as a miss)."""
+        with connect(self.path) as conn:
+            row = conn.execute("SELECT media_name FROM results WHERE key = ?", (key,)).fetchone()
+            # The reaper may have released the pinned name (max age, total quota); forget it then
+            if row is not None and self.store.resolve(row["media_name"]) is None:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row["media_name"] if row is not None else None
+
+    def put(self, key, media_name, generator=None):
+        """Pins the blob behind media_name for key, then evicts entries beyond the byte budget."""
+        if self.max_bytes <= 0:
+            return None
+        record = self.store.add_reference(media_name, name_prefix=self.name_prefix, generator=generator)
+        if record is None:
+            return None
+        now = time.time()
+        with connect(self.path) as conn:
+            previous = conn.execute("SELECT media_name FROM results WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT INTO results (key, media_name, generator, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET media_name = excluded.media_name, "
+                "generator = excluded.generator, size = excluded.size, created_at = excluded.created_at, "
+                "last_used = excluded.last_used",
+                (key, record["name"], generator, record["size"], now, now))
+        if previous is not None:
+            self.store.release(previous["media_name"])
+        self._evict()
+        return record["name"]
+
+    def _evict(self):
+        with connect(self.path) as conn:
+            used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            victims = []
+            if used > self.max_bytes:
+                for row in conn.execute("SELECT key, media_name, size FROM results ORDER BY last_used"):
+                    if used <= self.max_bytes:
+                        break
+                    victims.append(row)
+                    used -= row["size"]
+                conn.executemany("DELETE FROM results WHERE key = ?", [(row["key"],) for row in victims])
+        for row in victims:
+            self.store.release(row["media_name"])
+        if victims:
+            with self._lock:
+                self.evictions += len(victims)
+
+    def stats(self):
+        with connect(self.path) as conn:
+            entries, used = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        with self._lock:
+            return {"entries": entries, "bytes": used, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
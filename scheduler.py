@@ -0,0 +1,135 @@
+"""
+Per-backend scheduling for batch generation.
+
+Each backend gets its own small worker pool, whose size is the backend's
+concurrency cap, and a token bucket that spaces out calls to its configured
+rate. When a backend answers 429/503 the call raises RateLimited; the whole
+backend then pauses for the Retry-After period (so its other queued calls do not
+pile on) and the call is retried a bounded number of times. A slow or throttled
+backend only ever holds its own workers.
+"""
+import email.utils
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    """Raised by a backend call that was refused with 429/503; retry_after is in seconds (or None)."""
+
+    def __init__(self, message="Rate limited by the backend", retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Seconds to wait according to a Retry-After header (delta-seconds or HTTP-date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """rate is in tokens per second; a rate of 0 disables limiting."""
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns how long to wait before using it (0 when one is available)."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Going negative queues callers in order: each one waits for its own token to accrue
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+
+class BackendScheduler:
+    def __init__(self, name, max_concurrency=2, rate_per_minute=0, burst=1, max_attempts=3,
+                 default_retry_after=5, max_retry_after=120, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate_per_minute / 60, burst, clock)
+        self.max_attempts = max_attempts
+        self.default_retry_after = default_retry_after
+        self.max_retry_after = max_retry_after
+        self.clock = clock
+        self.sleep = sleep
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"batch-{name}")
+        self._lock = threading.Lock()
+        self._blocked_until = 0.0
+        self.metrics = {"submitted": 0, "in_flight": 0, "completed": 0, "failed": 0, "rate_limited": 0,
+                        "retries": 0}
+
+    def submit(self, fn, *args):
+        """Queues fn(*args) behind this backend's limits and returns a Future with its result."""
+        with self._lock:
+            self.metrics["submitted"] += 1
+        return self._executor.submit(self._run, fn, args)
+
+    def back_off(self, retry_after=None):
+        """Pauses new calls to this backend, e.g. after a 429 seen outside the scheduler."""
+        delay = min(self.max_retry_after, self.default_retry_after if retry_after is None else retry_after)
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self.clock() + delay)
+            self.metrics["rate_limited"] += 1
+        logger.warning(f"{self.name} is rate limited, pausing it for {delay:.1f}s")
+
+    def _wait_for_turn(self):
+        wait = self.bucket.reserve()
+        with self._lock:
+            wait = max(wait, self._blocked_until - self.clock())
+        if wait > 0:
+            self.sleep(wait)
+
+    def _run(self, fn, args):
+        with self._lock:
+            self.metrics["in_flight"] += 1
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                self._wait_for_turn()
+                try:
+                    result = fn(*args)
+                except RateLimited as e:
+                    self.back_off(e.retry_after)
+                    if attempt == self.max_attempts:
+                        raise
+                    with self._lock:
+                        self.metrics["retries"] += 1
+                    continue
+                with self._lock:
+                    self.metrics["completed"] += 1
+                return result
+        except Exception:
+            with self._lock:
+                self.metrics["failed"] += 1
+            raise
+        finally:
+            with self._lock:
+                self.metrics["in_flight"] -= 1
+
+    def stats(self):
+        with self._lock:
+            return {**self.metrics, "max_concurrency": self.max_concurrency,
+                    "paused_for": round(max(0.0, self._blocked_until - self.clock()), 3)}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -15,6 +15,24 @@ function generateUniqueId() {
     return Math.random().toString(36).substring(7);
 }
 
+// Poll a background job (video/upscale) until it finishes and return its result
+async function waitForJob(job) {
+    if (!job.job_id) {
+        return job; // Not a job response, e.g. a validation error
+    }
+    while (true) {
+        const response = await fetch(`/jobs/${job.job_id}`);
+        const data = await response.json();
+        if (!response.ok || data.status === 'failed') {
+            return { error: data.error || 'Job failed' };
+        }
+        if (data.status === 'succeeded') {
+            return data.result;
+        }
+        await new Promise(resolve => setTimeout(resolve, 2000));
+    }
+}
+
 async function submitPrompt() {
     const promptInput = document.getElementById('promptInput');
     const chatBody = document.getElementById('chatBody');
@@ -47,14 +65,18 @@ async function submitPrompt() {
         const response = await fetch('/generate-image', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ prompt: prompt, generator: selectedGenerator })
+            body: JSON.stringify({
+                prompt: prompt,
+                generator: selectedGenerator,
+                allow_fallback: document.getElementById('allowFallback').checked
+            })
         });
 
         const data = await response.json();
         const uniqueId = generateUniqueId();  // Generate unique ID for the regenerate button and spinner
 
         if (response.ok) {
-            appendToChat('image', data.image_url, selectedGenerator);
+            (data.images || [data.image_url]).forEach(name => appendToChat('image', name, data.generator || selectedGenerator));
         } else {
             chatBody.innerHTML += `
                 <div class="bot-message text-danger">
@@ -84,12 +106,12 @@ function appendToChat(contentType, contentUrl, generator) {
     const uniqueId = generateUniqueId();
     const contentHtml = contentType === 'image' ? `
         <div class="bot-image">
-            <img src="/static/${contentUrl}" alt="Generated Image" style="max-width: 100%; height: auto; border-radius: 5px;">
+            <img src="/media/${contentUrl}" data-name="${contentUrl}" alt="Generated Image" style="max-width: 100%; height: auto; border-radius: 5px;">
         </div>
     ` : `
         <div class="bot-video">
-            <video controls style="max-width: 100%; height: auto; border-radius: 5px;">
-                <source src="/static/${contentUrl}" type="video/mp4">
+            <video controls preload="metadata" style="max-width: 100%; height: auto; border-radius: 5px;">
+                <source src="/media/${contentUrl}" type="video/mp4">
                 Your browser does not support the video tag.
             </video>
         </div>
@@ -102,7 +124,7 @@ function appendToChat(contentType, contentUrl, generator) {
         ${contentHtml}
         <div class="image-actions d-flex justify-content-center">
             <div class="download-icon mx-2">
-                <a href="/static/${contentUrl}" download>
+                <a href="/media/${contentUrl}" download>
                     <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-download" viewBox="0 0 16 16">
                         <path d="M.5 9.9a.5.5 0 0 1 .5.5v2.5a1 1 0 0 0 1 1h12a1 1 0 0 0 1-1v-2.5a.5.5 0 0 1 1 0v2.5a2 2 0 0 1-2 2H2a2 2 0 0 1-2-2v-2.5a.5.5 0 0 1 .5-.5"/>
                         <path d="M7.646 11.854a.5.5 0 0 0 .708 0l3-3a.5.5 0 0 0-.708-.708L8.5 10.293V1.5a.5.5 0 0 0-1 0v8.793L5.354 8.146a.5.5 0 1 0-.708.708z"/>
@@ -147,7 +169,7 @@ document.addEventListener('click', function (event) {
 
     if (event.target.closest('.camera-icon')) {
         const imgElement = event.target.closest('.bot-image').querySelector('img');
-        const imagePath = imgElement.src.split('/').pop(); // Extract the file name from the URL
+        const imagePath = imgElement.dataset.name || imgElement.src.split('/').pop(); // Media name of the full-size image
 
         // Show the video generation modal
         const videoModal = new bootstrap.Modal(document.getElementById('videoModal'));
@@ -160,6 +182,7 @@ document.addEventListener('click', function (event) {
             body: JSON.stringify({ image_url: imagePath })
         })
         .then(response => response.json())
+        .then(waitForJob)
         .then(data => {
             if (data.video_url) {
                 // Append the video to the chat
@@ -184,6 +207,7 @@ document.addEventListener('click', function (event) {
 
         // Set the image URL in all modals
         document.getElementById('upscaleImage').src = imageUrl;
+        document.getElementById('upscaleImage').dataset.name = imgElement.dataset.name || imageUrl.split('/').pop();
         document.getElementById('removeBackgroundImage').src = imageUrl;
         document.getElementById('imageMixerImage').src = imageUrl;
 
@@ -224,78 +248,105 @@ document.getElementById('clearHistoryBtn').addEventListener('click', async funct
     }
 });
 
-// Function to load conversation history
-async function loadConversationHistory() {
+// Oldest history entry rendered so far; older pages are fetched from here
+let historyCursor = null;
+let loadingHistory = false;
+
+// Render one history entry: newer entries go on top, entries from older pages at the bottom
+function renderHistoryEntry({ prompt, generator, image_url, video_url, preview_url, srcset }, older) {
     const chatBody = document.getElementById('chatBody');
-    const response = await fetch('/conversation-history');
-    const conversation = await response.json();
-
-    // Prepend each message to ensure newest at the top
-    conversation.forEach(({ prompt, generator, image_url, video_url }) => {
-        const uniqueId = generateUniqueId();
-
-        if (image_url) {
-            const newMessage = document.createElement('div');
-            newMessage.className = 'bot-message';
-            newMessage.innerHTML = `
-                <strong>${generator.charAt(0).toUpperCase() + generator.slice(1)}:</strong><br>
-                <div class="bot-image">
-                    <img src="/static/${image_url}" alt="Generated Image">
-                    <div class="image-actions d-flex justify-content-center">
-                        <div class="download-icon mx-2">
-                            <a href="/download-image/${image_url.split('/').pop()}" download>
-                                <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-download" viewBox="0 0 16 16">
-                                    <path d="M.5 9.9a.5.5 0 0 1 .5.5v2.5a1 1 0 0 0 1 1h12a1 1 0 0 0 1-1v-2.5a.5.5 0 0 1 1 0v2.5a2 2 0 0 1-2 2H2a2 2 0 0 1-2-2v-2.5a.5.5 0 0 1 .5-.5"/>
-                                    <path d="M7.646 11.854a.5.5 0 0 0 .708 0l3-3a.5.5 0 0 0-.708-.708L8.5 10.293V1.5a.5.5 0 0 0-1 0v8.793L5.354 8.146a.5.5 0 1 0-.708.708z"/>
-                                </svg>
-                            </a>
-                        </div>
-                        <div class="regenerate-icon mx-2">
-                            <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-repeat regenerate-btn" id="regenerateBtn-${uniqueId}" data-prompt="${prompt}" data-generator="${generator}" viewBox="0 0 16 16">
-                                <path d="M11 5.466V4H5a4 4 0 0 0-3.584 5.777.5.5 0 1 1-.896.446A5 5 0 0 1 5 3h6V1.534a.25.25 0 0 1 .41-.192l2.36 1.966c.12.1.12.284 0 .384l-2.36 1.966a.25.25 0 0 1-.41-.192m3.81.086a.5.5 0 0 1 .67.225A5 5 0 0 1 11 13H5v1.466a.25.25 0 0 1-.41.192l-2.36-1.966a.25.25 0 0 1 0-.384l2.36-1.966a.25.25 0 0 1 .41.192V12h6a4 4 0 0 0 3.585-5.777.5.5 0 0 1 .225-.67Z"/>
-                            </svg>
-                            <div class="spinner-border spinner-border-sm text-primary" id="regenerateSpinner-${uniqueId}" role="status" style="display: none;">
-                                <span class="visually-hidden">Loading...</span>
-                            </div>
-                        </div>
-                        <div class="camera-icon mx-2" role="button" tabindex="0" id="generateVideoBtn">
-                            <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-camera-reels" viewBox="0 0 16 16">
-                                <path d="M6 3a3 3 0 1 1-6 0 3 3 0 0 1 6 0M1 3a2 2 0 1 0 4 0 2 2 0 0 0-4 0"/>
-                                <path d="M9 6h.5a2 2 0 0 1 1.983 1.738l3.11-1.382A1 1 0 0 1 16 7.269v7.462a1 1 0 0 1-1.406.913l-3.111-1.382A2 2 0 0 1 9.5 16H2a2 2 0 0 1-2-2V8a2 2 0 0 1 2-2zm6 8.73V7.27l-3.5 1.555v4.35zM1 8v6a1 1 0 0 0 1 1h7.5a1 1 0 0 0 1-1V8a1 1 0 0 0-1-1H2a1 1 0 0 0-1 1"/>
-                                <path d="M9 6a3 3 0 1 0 0-6 3 3 0 0 0 0 6M7 3a2 2 0 1 1 4 0 2 2 0 0 1-4 0"/>
-                            </svg>
-                        </div>
-                        <div class="edit-icon mx-2" role="button" tabindex="0">
-                            <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-pencil-square" viewBox="0 0 16 16">
-                                <path d="M15.502 1.94a.5.5 0 0 1 0 .706L14.459 3.69l-2-2L13.502.646a.5.5 0 0 1 .707 0l1.293 1.293zm-1.75 2.456-2-2L4.939 9.21a.5.5 0 0 0-.121.196l-.805 2.414a.25.25 0 0 0 .316.316l2.414-.805a.5.5 0 0 0 .196-.12l6.813-6.814z"/>
-                                <path fill-rule="evenodd" d="M1 13.5A1.5 1.5 0 0 0 2.5 15h11a1.5 1.5 0 0 0 1.5-1.5v-6a.5.5 0 0 0-1 0v6a.5.5 0 0 1-.5.5h-11a.5.5 0 0 1-.5-.5v-11a.5.5 0 0 1 .5-.5H9a.5.5 0 0 0 0-1H2.5A1.5 1.5 0 0 0 1 2.5z"/>
+    const place = (element) => older ? chatBody.append(element) : chatBody.prepend(element);
+    const uniqueId = generateUniqueId();
+
+    if (image_url) {
+        const newMessage = document.createElement('div');
+        newMessage.className = 'bot-message';
+        newMessage.innerHTML = `
+            <strong>${generator.charAt(0).toUpperCase() + generator.slice(1)}:</strong><br>
+            <div class="bot-image">
+                <img src="${preview_url || `/media/${image_url}`}" srcset="${srcset || ''}" sizes="(max-width: 800px) 100vw, 768px" data-name="${image_url}" loading="lazy" alt="Generated Image">
+                <div class="image-actions d-flex justify-content-center">
+                    <div class="download-icon mx-2">
+                        <a href="/download-image/${image_url.split('/').pop()}" download>
+                            <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-download" viewBox="0 0 16 16">
+                                <path d="M.5 9.9a.5.5 0 0 1 .5.5v2.5a1 1 0 0 0 1 1h12a1 1 0 0 0 1-1v-2.5a.5.5 0 0 1 1 0v2.5a2 2 0 0 1-2 2H2a2 2 0 0 1-2-2v-2.5a.5.5 0 0 1 .5-.5"/>
+                                <path d="M7.646 11.854a.5.5 0 0 0 .708 0l3-3a.5.5 0 0 0-.708-.708L8.5 10.293V1.5a.5.5 0 0 0-1 0v8.793L5.354 8.146a.5.5 0 1 0-.708.708z"/>
                             </svg>
+                        </a>
+                    </div>
+                    <div class="regenerate-icon mx-2">
+                        <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-repeat regenerate-btn" id="regenerateBtn-${uniqueId}" data-prompt="${prompt}" data-generator="${generator}" viewBox="0 0 16 16">
+                            <path d="M11 5.466V4H5a4 4 0 0 0-3.584 5.777.5.5 0 1 1-.896.446A5 5 0 0 1 5 3h6V1.534a.25.25 0 0 1 .41-.192l2.36 1.966c.12.1.12.284 0 .384l-2.36 1.966a.25.25 0 0 1-.41-.192m3.81.086a.5.5 0 0 1 .67.225A5 5 0 0 1 11 13H5v1.466a.25.25 0 0 1-.41.192l-2.36-1.966a.25.25 0 0 1 0-.384l2.36-1.966a.25.25 0 0 1 .41.192V12h6a4 4 0 0 0 3.585-5.777.5.5 0 0 1 .225-.67Z"/>
+                        </svg>
+                        <div class="spinner-border spinner-border-sm text-primary" id="regenerateSpinner-${uniqueId}" role="status" style="display: none;">
+                            <span class="visually-hidden">Loading...</span>
                         </div>
                     </div>
+                    <div class="camera-icon mx-2" role="button" tabindex="0" id="generateVideoBtn">
+                        <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-camera-reels" viewBox="0 0 16 16">
+                            <path d="M6 3a3 3 0 1 1-6 0 3 3 0 0 1 6 0M1 3a2 2 0 1 0 4 0 2 2 0 0 0-4 0"/>
+                            <path d="M9 6h.5a2 2 0 0 1 1.983 1.738l3.11-1.382A1 1 0 0 1 16 7.269v7.462a1 1 0 0 1-1.406.913l-3.111-1.382A2 2 0 0 1 9.5 16H2a2 2 0 0 1-2-2V8a2 2 0 0 1 2-2zm6 8.73V7.27l-3.5 1.555v4.35zM1 8v6a1 1 0 0 0 1 1h7.5a1 1 0 0 0 1-1V8a1 1 0 0 0-1-1H2a1 1 0 0 0-1 1"/>
+                            <path d="M9 6a3 3 0 1 0 0-6 3 3 0 0 0 0 6M7 3a2 2 0 1 1 4 0 2 2 0 0 1-4 0"/>
+                        </svg>
+                    </div>
+                    <div class="edit-icon mx-2" role="button" tabindex="0">
+                        <svg xmlns="http://www.w3.org/2000/svg" width="26" height="26" fill="currentColor" class="bi bi-pencil-square" viewBox="0 0 16 16">
+                            <path d="M15.502 1.94a.5.5 0 0 1 0 .706L14.459 3.69l-2-2L13.502.646a.5.5 0 0 1 .707 0l1.293 1.293zm-1.75 2.456-2-2L4.939 9.21a.5.5 0 0 0-.121.196l-.805 2.414a.25.25 0 0 0 .316.316l2.414-.805a.5.5 0 0 0 .196-.12l6.813-6.814z"/>
+                            <path fill-rule="evenodd" d="M1 13.5A1.5 1.5 0 0 0 2.5 15h11a1.5 1.5 0 0 0 1.5-1.5v-6a.5.5 0 0 0-1 0v6a.5.5 0 0 1-.5.5h-11a.5.5 0 0 1-.5-.5v-11a.5.5 0 0 1 .5-.5H9a.5.5 0 0 0 0-1H2.5A1.5 1.5 0 0 0 1 2.5z"/>
+                        </svg>
+                    </div>
                 </div>
-            `;
-            chatBody.prepend(newMessage);
-        }
+            </div>
+        `;
+        place(newMessage);
+    }
 
-        if (video_url) {
-            const newMessage = document.createElement('div');
-            newMessage.className = 'bot-message';
-            newMessage.innerHTML = `
-                <strong>${generator.charAt(0).toUpperCase() + generator.slice(1)}:</strong><br>
-                <div class="bot-video" align="center">
-                    <video controls style="max-width: 100%; height: auto; border-radius: 5px;">
-                        <source src="/static/${video_url}" type="video/mp4">
-                        Your browser does not support the video tag.
-                    </video>
-                </div>
-            `;
-            chatBody.prepend(newMessage);
+    if (video_url) {
+        const newMessage = document.createElement('div');
+        newMessage.className = 'bot-message';
+        newMessage.innerHTML = `
+            <strong>${generator.charAt(0).toUpperCase() + generator.slice(1)}:</strong><br>
+            <div class="bot-video" align="center">
+                <video controls preload="metadata" style="max-width: 100%; height: auto; border-radius: 5px;">
+                    <source src="/media/${video_url}" type="video/mp4">
+                    Your browser does not support the video tag.
+                </video>
+            </div>
+        `;
+        place(newMessage);
+    }
+}
+
+// Function to load conversation history, one page at a time
+async function loadConversationHistory(older = false) {
+    if (loadingHistory || (older && !historyCursor)) {
+        return;
+    }
+    loadingHistory = true;
+    try {
+        const response = await fetch(older ? `/conversation-history?before=${historyCursor}` : '/conversation-history');
+        const page = await response.json();
+        if (!older) {
+            document.getElementById('chatBody').innerHTML = ''; // Clear the chat body before loading history
         }
-    });
+        historyCursor = page.next_cursor;
+        // Pages are oldest first: prepend them in order, or append an older page newest first
+        const entries = older ? page.entries.slice().reverse() : page.entries;
+        entries.forEach(entry => renderHistoryEntry(entry, older));
+    } finally {
+        loadingHistory = false;
+    }
 }
 
+// Load older history when the chat is scrolled to the bottom
+document.getElementById('chatBody').addEventListener('scroll', function() {
+    if (this.scrollTop + this.clientHeight >= this.scrollHeight - 200) {
+        loadConversationHistory(true);
+    }
+});
+
 // Call the function on page load
-window.addEventListener('load', loadConversationHistory);
+window.addEventListener('load', () => loadConversationHistory());
 
 document.addEventListener('DOMContentLoaded', function() {
     // Function to add hover and click events to images
@@ -318,6 +369,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
             // Set the image URL in all modals
             document.getElementById('upscaleImage').src = imageUrl;
+            document.getElementById('upscaleImage').dataset.name = imgElement.dataset.name || imageUrl.split('/').pop();
             document.getElementById('removeBackgroundImage').src = imageUrl;
             document.getElementById('imageMixerImage').src = imageUrl;
 
@@ -334,17 +386,17 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Generate upscale image
     document.getElementById('generateUpscaleBtn').addEventListener('click', async function() {
-        const imagePath = originalImage.src.split('/').pop();
+        const imagePath = originalImage.dataset.name || originalImage.src.split('/').pop();
         const response = await fetch('/upscale-image', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ image_path: imagePath })
         });
 
-        const data = await response.json();
-        if (response.ok) {
+        const data = await waitForJob(await response.json());
+        if (response.ok && !data.error) {
             const newImage = document.createElement('img');
-            newImage.src = `/static/${data.output_url}`; // Correctly construct the URL
+            newImage.src = `/media/${data.output_url}`; // Correctly construct the URL
             newImage.alt = "Upscaled Image";
             newImage.style = "max-width: 100%; height: auto; border-radius: 5px;";
             document.getElementById('newImagePlaceholder').innerHTML = '';
@@ -360,7 +412,7 @@ document.addEventListener('DOMContentLoaded', function() {
             chatMessage.innerHTML = `
                 <strong>Upscaled Image:</strong><br>
                 <div align="center">
-                    <img src="/static/${data.output_url}" alt="Upscaled Image" class="center-image" style="max-width: 100%; height: auto; border-radius: 5px;" align="center">
+                    <img src="/media/${data.output_url}" alt="Upscaled Image" class="center-image" style="max-width: 100%; height: auto; border-radius: 5px;" align="center">
                 </div>
             `;
             // Prepend the new message to the chat body
@@ -470,7 +522,7 @@ document.addEventListener('DOMContentLoaded', function() {
     // Event listener for the "Generate" button in the upscale modal
     document.getElementById('generateUpscaleBtn').addEventListener('click', async function() {
         const originalImage = document.getElementById('upscaleImage');
-        const imagePath = originalImage.src.split('/').pop(); // Extract the image path
+        const imagePath = originalImage.dataset.name || originalImage.src.split('/').pop(); // Extract the image path
         const spinner = document.getElementById('upscaleSpinner');
         const generateBtn = document.getElementById('generateUpscaleBtn');
 
@@ -485,11 +537,11 @@ document.addEventListener('DOMContentLoaded', function() {
                 body: JSON.stringify({ image_path: imagePath })
             });
 
-            const data = await response.json();
-            if (response.ok) {
+            const data = await waitForJob(await response.json());
+            if (response.ok && !data.error) {
                 // Display the upscaled image in the placeholder
                 const newImage = document.createElement('img');
-                newImage.src = `/static/${data.output_url}`;
+                newImage.src = `/media/${data.output_url}`;
                 newImage.alt = "Upscaled Image";
                 newImage.style = "max-width: 100%; height: auto; border-radius: 5px;";
                 const placeholder = document.getElementById('newImagePlaceholder');
@@ -514,7 +566,7 @@ document.addEventListener('DOMContentLoaded', function() {
     document.addEventListener('click', function(event) {
         if (event.target.closest('.camera-icon')) {
             const imgElement = event.target.closest('.bot-image').querySelector('img');
-            const imagePath = imgElement.src.split('/').pop(); // Extract the file name from the URL
+            const imagePath = imgElement.dataset.name || imgElement.src.split('/').pop(); // Media name of the full-size image
 
             // Show the video generation modal
             const videoModal = new bootstrap.Modal(document.getElementById('videoModal'));
@@ -527,6 +579,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 body: JSON.stringify({ image_url: imagePath })
             })
             .then(response => response.json())
+            .then(waitForJob)
             .then(data => {
                 if (data.video_url) {
                     // Append the video to the chat
@@ -567,7 +620,7 @@ async function regenerateImage(prompt, generator, regenerateBtnId, regenerateSpi
         const data = await response.json();
 
         if (response.ok) {
-            appendToChat('image', data.image_url, generator);
+            (data.images || [data.image_url]).forEach(name => appendToChat('image', name, data.generator || generator));
         } else {
             alert('Error: ' + data.error);
         }
@@ -0,0 +1,134 @@
+"""
+Backends holding the bytes of stored media.
+
+The media store keeps its index in a database and addresses blobs and derivatives by
+relative keys (ab/cd/<hash>.png, derivatives/ab/<hash>-thumb.webp). LocalStorage
+keeps them under a directory on this host. S3Storage keeps them in an
+S3-compatible bucket shared by every host (AWS, or a local stand-in such as
+MinIO through endpoint_url), and hands out presigned URLs, so clients fetch
+the bytes from the bucket rather than through an app worker. boto3 is only
+needed for S3Storage.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Keys are derived from content hashes, so whatever is stored under one never changes
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put_file(self, tmp_path, key, content_type=None):
+        """Moves a finished temp file (on the same filesystem) to key."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    @contextmanager
+    def local_file(self, key):
+        """Yields a path on this host holding the object's bytes."""
+        yield self.path(key)
+
+    def url(self, key, content_type=None, download_name=None, as_attachment=False):
+        """Local files are served by the app (or the front server through X-Sendfile), so there is no URL."""
+        return None
+
+    def list(self, prefix):
+        """Yields (key, modified timestamp) for every object under prefix."""
+        base = self.path(prefix)
+        for directory, _, files in os.walk(base):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                try:
+                    modified = os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, "/"), modified
+
+
+class S3Storage:
+    def __init__(self, bucket, prefix="", temp_dir=None, url_ttl=3600, client=None, endpoint_url=None,
+                 region_name=None):
+        """
+        prefix is prepended to every key, so one bucket can hold several deployments. Presigned
+        URLs stay valid for url_ttl seconds; temp_dir receives objects downloaded for local use.
+        """
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("S3 media storage needs boto3 (pip install boto3)")
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region_name)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.temp_dir = temp_dir
+        self.url_ttl = url_ttl
+
+    def put_file(self, tmp_path, key, content_type=None):
+        """Uploads a finished temp file to key and removes the temp file."""
+        extra_args = {"CacheControl": IMMUTABLE_CACHE_CONTROL}
+        if content_type:
+            extra_args["ContentType"] = content_type
+        self.client.upload_file(tmp_path, self.bucket, self.prefix + key, ExtraArgs=extra_args)
+        os.remove(tmp_path)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    @contextmanager
+    def local_file(self, key):
+        """Downloads the object to a temp file and yields its path; the file is removed afterwards."""
+        fd, path = tempfile.mkstemp(dir=self.temp_dir, prefix=".tmp-")
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.prefix + key, path)
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def url(self, key, content_type=None, download_name=None, as_attachment=False):
+        """A presigned GET URL for the object, valid for url_ttl seconds."""
+        params = {"Bucket": self.bucket, "Key": self.prefix + key}
+        if content_type:
+            params["ResponseContentType"] = content_type
+        if download_name:
+            disposition = "attachment" if as_attachment else "inline"
+            params["ResponseContentDisposition"] = f'{disposition}; filename="{download_name}"'
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.url_ttl)
+
+    def list(self, prefix):
+        """Yields (key, modified timestamp) for every object under prefix."""
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):], item["LastModified"].timestamp()
@@ -0,0 +1,518 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from auth_cache import TokenCache
+from conversation_store import ConversationStore
+from generators import CircuitBreaker, Generator, GeneratorRegistry, GeneratorUnavailable, ModelLoading
+from jobs import JobInterrupted, JobLimitExceeded, JobManager, JobStore, run_prediction
+from media_store import MediaStore
+from scheduler import RateLimited, TokenBucket
+from storage import LocalStorage
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=self.clock)
+
+    def trip(self):
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "closed")
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 30)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+
+    def test_released_probe_allows_another(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertTrue(self.breaker.allow())
+
+
+class GeneratorRegistryBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.outcomes = []
+
+    def call(self, prompt, seed, size, count, wait_for_model):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def registry(self, *generators):
+        return GeneratorRegistry(generators, max_wait_for_model=0)
+
+    def generator(self, name, call, fallbacks=()):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=self.clock)
+        return Generator(name, call, fallbacks=fallbacks, breaker=breaker, clock=self.clock)
+
+    def open_breaker(self, registry, name):
+        self.outcomes += [RuntimeError("boom"), RuntimeError("boom")]
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                registry.generate(name, "a cat")
+        with self.assertRaises(GeneratorUnavailable):
+            registry.generate(name, "a cat")
+        self.clock.now += 30
+
+    def test_rate_limited_probe_does_not_wedge_breaker(self):
+        primary = self.generator("primary", self.call)
+        registry = self.registry(primary)
+        self.open_breaker(registry, "primary")
+        self.outcomes.append(RateLimited("slow down", 1))
+        with self.assertRaises(RateLimited):
+            registry.generate("primary", "a cat")
+        self.assertEqual(primary.breaker.state, "half_open")
+        self.outcomes.append(b"image")
+        self.assertEqual(registry.generate("primary", "a cat"), (b"image", "primary"))
+        self.assertEqual(primary.breaker.state, "closed")
+
+    def test_loading_probe_with_fallback_does_not_wedge_breaker(self):
+        primary = self.generator("primary", self.call, fallbacks=("backup",))
+        backup = self.generator("backup", lambda *args: b"backup")
+        registry = self.registry(primary, backup)
+        self.open_breaker(registry, "primary")
+        self.outcomes.append(ModelLoading("loading", 20))
+        self.assertEqual(registry.generate("primary", "a cat", allow_fallback=True), (b"backup", "backup"))
+        self.assertEqual(primary.breaker.state, "half_open")
+        self.clock.now += 20
+        self.outcomes.append(b"image")
+        self.assertEqual(registry.generate("primary", "a cat", allow_fallback=True), (b"image", "primary"))
+        self.assertEqual(primary.breaker.state, "closed")
+
+
+class TokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TokenCache(ttl=60, negative_ttl=5, clock=self.clock)
+
+    def test_concurrent_misses_share_one_load(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "user"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.cache.get_or_load("token", loader)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(self.cache.get_or_load("token", loader)))
+                     for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        wait_until(lambda: self.cache.stats()["coalesced"] == 3)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+        self.assertEqual(results, ["user"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.get_or_load("token", loader), "user")
+        self.assertEqual(len(calls), 1)
+
+    def test_failed_load_is_not_cached(self):
+        def loader():
+            raise LookupError("auth backend down")
+
+        with self.assertRaises(LookupError):
+            self.cache.get_or_load("token", loader)
+        self.assertEqual(self.cache.get_or_load("token", lambda: "user"), "user")
+
+    def test_negative_results_expire_sooner(self):
+        self.cache.get_or_load("bad", lambda: None, is_positive=lambda value: value is not None)
+        self.cache.get_or_load("good", lambda: "user")
+        self.clock.now += 5
+        self.assertEqual(self.cache.get_or_load("bad", lambda: "retried"), "retried")
+        self.assertEqual(self.cache.get_or_load("good", lambda: "reloaded"), "user")
+        self.clock.now += 55
+        self.assertEqual(self.cache.get_or_load("good", lambda: "reloaded"), "reloaded")
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_paced(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, burst=2, clock=clock)
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0, 0, 0.5, 1.0])
+        clock.now += 1.0
+        self.assertEqual(bucket.reserve(), 0.5)
+
+    def test_refill_is_capped_at_burst(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1, burst=2, clock=clock)
+        clock.now += 100
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 1.0])
+
+    def test_zero_rate_never_waits(self):
+        bucket = TokenBucket(rate=0, burst=1)
+        self.assertEqual([bucket.reserve() for _ in range(5)], [0] * 5)
+
+
+class ConversationStorePageTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ConversationStore(os.path.join(self.root, "conversations.sqlite3"))
+        self.ids = [self.store.append("c1", "alice", "video" if i % 3 == 0 else "image", f"prompt {i}", "flux",
+                                      f"media_{i}.png") for i in range(7)]
+        self.store.append("c2", "bob", "image", "other", "flux", "other.png")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def ids_of(self, entries):
+        return [entry["id"] for entry in entries]
+
+    def test_pages_backwards_from_newest(self):
+        pages = []
+        entries, cursor = self.store.page("c1", limit=3)
+        pages.append(self.ids_of(entries))
+        while cursor is not None:
+            entries, cursor = self.store.page("c1", before=cursor, limit=3)
+            pages.append(self.ids_of(entries))
+        self.assertEqual(pages, [self.ids[4:], self.ids[1:4], self.ids[:1]])
+
+    def test_exact_page_has_no_cursor(self):
+        entries, cursor = self.store.page("c1", limit=7)
+        self.assertEqual(self.ids_of(entries), self.ids)
+        self.assertIsNone(cursor)
+
+    def test_since_returns_newer_entries_oldest_first(self):
+        entries, cursor = self.store.page("c1", since=self.ids[2], limit=2)
+        self.assertEqual(self.ids_of(entries), self.ids[3:5])
+        entries, cursor = self.store.page("c1", since=cursor, limit=2)
+        self.assertEqual(self.ids_of(entries), self.ids[5:7])
+        self.assertIsNone(cursor)
+        self.assertEqual(self.store.page("c1", since=self.store.latest_id("c1")), ([], None))
+
+    def test_kind_filter(self):
+        entries, cursor = self.store.page("c1", kind="video", limit=2)
+        self.assertEqual(self.ids_of(entries), [self.ids[3], self.ids[6]])
+        entries, cursor = self.store.page("c1", kind="video", before=cursor, limit=2)
+        self.assertEqual(self.ids_of(entries), [self.ids[0]])
+        self.assertIsNone(cursor)
+
+
+class HookedStorage(LocalStorage):
+    """Local storage that runs a callback in the middle of the next upload."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.during_upload = None
+
+    def put_file(self, tmp_path, key, content_type=None):
+        super().put_file(tmp_path, key, content_type)
+        hook, self.during_upload = self.during_upload, None
+        if hook is not None:
+            hook()
+
+
+class MediaStoreDeleteRaceTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = HookedStorage(os.path.join(self.root, "media"))
+        self.store = MediaStore(os.path.join(self.root, "media"), os.path.join(self.root, "media.sqlite3"),
+                                storage=self.storage)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def release_without_purge(self, name):
+        purge, self.store.purge_pending_deletes = self.store.purge_pending_deletes, lambda keys=None: 0
+        try:
+            self.store.release(name)
+        finally:
+            self.store.purge_pending_deletes = purge
+
+    def test_release_deletes_the_last_reference(self):
+        first = self.store.put_bytes(b"image", ".png")
+        second = self.store.put_bytes(b"image", ".png")
+        self.assertEqual(self.store.release(first["name"]), 0)
+        self.assertTrue(self.storage.exists(first["key"]))
+        self.assertEqual(self.store.release(second["name"]), len(b"image"))
+        self.assertFalse(self.storage.exists(first["key"]))
+
+    def test_store_between_release_and_delete_keeps_the_object(self):
+        old = self.store.put_bytes(b"image", ".png")
+        self.release_without_purge(old["name"])
+        new = self.store.put_bytes(b"image", ".png")
+        self.assertEqual(self.store.purge_pending_deletes([old["key"]]), 0)
+        self.assertIsNotNone(self.store.resolve(new["name"]))
+        self.assertTrue(self.storage.exists(new["key"]))
+
+    def test_delete_during_upload_is_held_back(self):
+        old = self.store.put_bytes(b"image", ".png")
+        self.release_without_purge(old["name"])
+        # The pending delete runs while the same bytes are being uploaded again
+        self.storage.during_upload = lambda: self.assertEqual(self.store.purge_pending_deletes(), 0)
+        new = self.store.put_bytes(b"image", ".png")
+        self.assertTrue(self.storage.exists(new["key"]))
+        self.assertEqual(self.store.purge_pending_deletes(), 0)
+        self.assertTrue(self.storage.exists(new["key"]))
+
+    def test_derivative_of_a_blob_released_during_its_upload_is_deleted(self):
+        record = self.store.put_bytes(b"image", ".png")
+        tmp_path = self.store.temp_path()
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(b"thumb")
+        self.storage.during_upload = lambda: self.store.release(record["name"])
+        self.assertIsNone(self.store.put_derivative(record["hash"], "thumb", tmp_path, ".webp", 1, 1))
+        self.assertFalse(self.storage.exists(self.store.derivative_key(record["hash"], "thumb", ".webp")))
+        self.assertFalse(self.storage.exists(record["key"]))
+
+    def test_stray_object_being_uploaded_is_kept(self):
+        record = self.store.put_bytes(b"image", ".png")
+        self.store.release(record["name"])
+        self.storage.during_upload = lambda: self.assertFalse(
+            self.store.delete_stray(record["key"], record["hash"]))
+        new = self.store.put_bytes(b"image", ".png")
+        self.assertTrue(self.storage.exists(new["key"]))
+        self.assertFalse(self.store.delete_stray(new["key"], new["hash"]))
+
+
+class FakePrediction:
+    def __init__(self, prediction_id, statuses):
+        self.id = prediction_id
+        self.status = "starting"
+        self.output = None
+        self.error = None
+        self._statuses = list(statuses)
+
+    def reload(self):
+        if self._statuses:
+            self.status = self._statuses.pop(0)
+        if self.status == "succeeded":
+            self.output = f"https://example.com/{self.id}.png"
+
+
+class FakePredictions:
+    """Replicate's predictions API; every prediction steps through statuses, one per poll (None polls forever)."""
+
+    def __init__(self, statuses=("processing", "succeeded")):
+        self.statuses = statuses
+        self.created = {}
+
+    def create(self, **kwargs):
+        prediction = FakePrediction(f"p{len(self.created) + 1}",
+                                    self.statuses if self.statuses is not None else ())
+        if self.statuses is None:
+            prediction.status = "processing"
+        self.created[prediction.id] = prediction
+        return prediction
+
+    def get(self, prediction_id):
+        if prediction_id not in self.created:
+            raise LookupError(prediction_id)
+        return self.created[prediction_id]
+
+
+class FakeReplicate:
+    def __init__(self, statuses=("processing", "succeeded")):
+        self.predictions = FakePredictions(statuses)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+
+class JobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = JobStore(os.path.join(self.root, "jobs.sqlite3"))
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.shutdown()
+        shutil.rmtree(self.root)
+
+    def manager(self, client, **options):
+        manager = None
+
+        def handler(job, report):
+            prediction = run_prediction(client, job, report, lambda: client.predictions.create(input={}),
+                                        poll_interval=0.01, stop=manager.stopping)
+            return {"status": prediction.status, "output": prediction.output}
+
+        manager = JobManager(self.store, {"video": handler}, lease_seconds=3, **options)
+        self.managers.append(manager)
+        return manager
+
+
+class RunPredictionTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeReplicate(statuses=("processing", "processing", "succeeded"))
+        self.reports = []
+
+    def report(self, **fields):
+        self.reports.append(fields)
+
+    def run_job(self, job):
+        return run_prediction(self.client, job, self.report, lambda: self.client.predictions.create(input={}),
+                              poll_interval=0)
+
+    def test_creates_and_polls_to_completion(self):
+        prediction = self.run_job({})
+        self.assertEqual((prediction.id, prediction.status), ("p1", "succeeded"))
+        self.assertEqual(self.reports, [{"prediction_id": "p1", "progress": {"status": "starting"}},
+                                        {"progress": {"status": "processing"}},
+                                        {"progress": {"status": "succeeded"}}])
+
+    def test_reattaches_to_the_recorded_prediction(self):
+        existing = self.client.predictions.create(input={})
+        prediction = self.run_job({"prediction_id": existing.id})
+        self.assertIs(prediction, existing)
+        self.assertEqual(len(self.client.predictions.created), 1)
+        self.assertNotIn("prediction_id", self.reports[0])
+
+    def test_unknown_prediction_is_recreated(self):
+        prediction = self.run_job({"prediction_id": "gone"})
+        self.assertEqual(prediction.id, "p1")
+        self.assertEqual(self.reports[0]["prediction_id"], "p1")
+
+    def test_stop_interrupts_polling(self):
+        stop = threading.Event()
+        stop.set()
+        with self.assertRaises(JobInterrupted):
+            run_prediction(self.client, {}, self.report, lambda: self.client.predictions.create(input={}), stop=stop)
+        self.assertEqual(self.client.predictions.created, {})
+
+
+class JobStoreTest(JobTestCase):
+    def test_per_user_and_global_caps(self):
+        self.store.create("alice", "video", {}, "w1", max_per_user=2, max_active=3)
+        job = self.store.create("alice", "video", {}, "w1", max_per_user=2, max_active=3)
+        with self.assertRaises(JobLimitExceeded):
+            self.store.create("alice", "video", {}, "w1", max_per_user=2, max_active=3)
+        self.store.create("bob", "video", {}, "w1", max_per_user=2, max_active=3)
+        with self.assertRaises(JobLimitExceeded):
+            self.store.create("carol", "video", {}, "w1", max_per_user=2, max_active=3)
+        # Finished jobs no longer count
+        self.store.update(job["id"], status="succeeded")
+        self.store.create("alice", "video", {}, "w1", max_per_user=2, max_active=3)
+        self.assertEqual(self.store.counts(), {"queued": 3, "succeeded": 1})
+
+    def test_claim_stale_takes_only_abandoned_unfinished_jobs(self):
+        stale = self.store.create("alice", "video", {}, "w1", 5, 10)
+        fresh = self.store.create("alice", "video", {}, "w1", 5, 10)
+        done = self.store.create("alice", "video", {}, "w1", 5, 10)
+        self.store.update(done["id"], status="succeeded")
+        self.store.release([stale["id"], done["id"]], "w1")
+        self.assertEqual(self.store.claim_stale("w2", lease_seconds=60), [stale["id"]])
+        self.assertEqual(self.store.get(stale["id"])["worker"], "w2")
+        # Claimed jobs are heartbeated again, so a second claimer gets nothing
+        self.assertEqual(self.store.claim_stale("w3", lease_seconds=60), [])
+        self.assertEqual(self.store.get(fresh["id"])["worker"], "w1")
+
+
+class JobManagerTest(JobTestCase):
+    def test_submitted_job_runs_to_success(self):
+        client = FakeReplicate()
+        manager = self.manager(client)
+        job = manager.submit("video", "alice", {"image": "a.png"})
+        wait_until(lambda: manager.get(job["id"])["status"] == "succeeded")
+        finished = manager.get(job["id"])
+        self.assertEqual(finished["prediction_id"], "p1")
+        self.assertEqual(finished["result"], {"status": "succeeded", "output": "https://example.com/p1.png"})
+        self.assertEqual(finished["payload"], {"image": "a.png"})
+
+    def test_per_user_cap(self):
+        manager = self.manager(FakeReplicate(statuses=None), max_per_user=1)
+        manager.submit("video", "alice", {})
+        with self.assertRaises(JobLimitExceeded):
+            manager.submit("video", "alice", {})
+        manager.submit("video", "bob", {})
+
+    def test_stale_job_is_resumed_on_its_prediction(self):
+        client = FakeReplicate()
+        prediction = client.predictions.create(input={})
+        job = self.store.create("alice", "video", {}, "dead-worker", 5, 10)
+        self.store.update(job["id"], status="running", prediction_id=prediction.id)
+        self.store.release([job["id"]], "dead-worker")
+        manager = self.manager(client)
+        manager.start()
+        wait_until(lambda: manager.get(job["id"])["status"] == "succeeded", timeout=10)
+        self.assertEqual(len(client.predictions.created), 1)
+
+
+class JobShutdownTest(JobTestCase):
+    def test_shutdown_hands_back_queued_and_polling_jobs(self):
+        stuck = FakeReplicate(statuses=None)
+        manager = self.manager(stuck, max_workers=1)
+        running = manager.submit("video", "alice", {})
+        queued = manager.submit("video", "bob", {})
+        wait_until(lambda: self.store.get(running["id"])["prediction_id"] is not None)
+        manager.shutdown()
+
+        for job_id in (running["id"], queued["id"]):
+            job = self.store.get(job_id)
+            self.assertIn(job["status"], ("queued", "running"))
+            self.assertEqual(job["heartbeat"], 0)
+        self.assertEqual(len(stuck.predictions.created), 1)
+
+        # Another process resumes both at once; the running one re-attaches to its prediction
+        client = FakeReplicate()
+        client.predictions.created = stuck.predictions.created
+        stuck.predictions.created["p1"]._statuses = ["succeeded"]
+        successor = self.manager(client)
+        for job_id in self.store.claim_stale(successor.worker_id, successor.lease_seconds):
+            successor._schedule(job_id)
+        wait_until(lambda: all(self.store.get(job_id)["status"] == "succeeded"
+                               for job_id in (running["id"], queued["id"])))
+        self.assertEqual(self.store.get(running["id"])["prediction_id"], "p1")
+        self.assertEqual(len(client.predictions.created), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()